@@ -0,0 +1,87 @@
+import os
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Альбом (несколько фото в одном сообщении) приходит отдельными апдейтами с общим media_group_id.
+# Собираем их столько секунд после первого элемента и обрабатываем одной пачкой.
+ALBUM_WINDOW = float(os.getenv("ALBUM_WINDOW", "1.0"))
+
+
+class Album:
+    __slots__ = ("user_id", "chat_id", "user_data", "messages", "on_complete", "job")
+
+    def __init__(self, user_id: int, chat_id: int, user_data: dict, on_complete):
+        self.user_id = user_id
+        self.chat_id = chat_id
+        self.user_data = user_data
+        self.messages = []
+        self.on_complete = on_complete
+        self.job = None
+
+
+_albums = {}
+_lock = threading.Lock()
+# Альбомы, которые уже забраны из _albums и сейчас обрабатываются: user_id -> число
+_in_progress = {}
+_done = threading.Condition(_lock)
+# Сколько секунд flush ждёт обработки альбома, начатой по таймеру
+ALBUM_FLUSH_TIMEOUT = 30.0
+
+
+def collect(update, context, on_complete) -> bool:
+    """Если сообщение — часть альбома, отложить его и вернуть True.
+    on_complete(bot, album) вызывается один раз для всего альбома; album.messages упорядочены
+    и содержат все элементы альбома (фото и видео) — обработчик сам выбирает нужные."""
+    message = update.message
+    group_id = message.media_group_id
+    if not group_id:
+        return False
+    with _lock:
+        album = _albums.get(group_id)
+        if album is None:
+            album = Album(update.effective_user.id, message.chat_id, context.user_data, on_complete)
+            _albums[group_id] = album
+            album.job = context.job_queue.run_once(_on_timer, ALBUM_WINDOW, context=group_id)
+        album.messages.append(message)
+    return True
+
+
+def _complete(bot, group_id):
+    with _lock:
+        album = _albums.pop(group_id, None)
+        if album is None:
+            return
+        _in_progress[album.user_id] = _in_progress.get(album.user_id, 0) + 1
+    album.messages.sort(key=lambda m: m.message_id)
+    try:
+        album.on_complete(bot, album)
+    except Exception:
+        logger.exception("Не удалось обработать альбом %s от %s", group_id, album.user_id)
+    finally:
+        with _lock:
+            left = _in_progress[album.user_id] - 1
+            if left:
+                _in_progress[album.user_id] = left
+            else:
+                del _in_progress[album.user_id]
+            _done.notify_all()
+
+
+def _on_timer(context):
+    _complete(context.bot, context.job.context)
+
+
+def flush(bot, user_id: int):
+    """Обработать недособранные альбомы пользователя сейчас (например, по кнопке «Готово»)
+    и дождаться альбомов, которые уже обрабатываются по таймеру."""
+    with _lock:
+        pending = [(group_id, album.job) for group_id, album in _albums.items() if album.user_id == user_id]
+    for group_id, job in pending:
+        if job is not None:
+            job.schedule_removal()
+        _complete(bot, group_id)
+    with _lock:
+        if not _done.wait_for(lambda: user_id not in _in_progress, ALBUM_FLUSH_TIMEOUT):
+            logger.warning("Альбом пользователя %s не обработан за %.0fс", user_id, ALBUM_FLUSH_TIMEOUT)
@@ -7,6 +7,11 @@ Create Date: 2025-09-03 18:00:00
 from alembic import op
 import sqlalchemy as sa
 
+revision = "0001"
+down_revision = None
+branch_labels = None
+depends_on = None
+
 def upgrade():
     # users
     op.execute(
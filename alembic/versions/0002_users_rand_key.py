@@ -0,0 +1,25 @@
+"""users.rand_key for indexed random sampling
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-18 12:00:00
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0002"
+down_revision = "0001"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS rand_key DOUBLE PRECISION NOT NULL DEFAULT random();")
+    op.execute("CREATE INDEX IF NOT EXISTS idx_users_rand_key ON users(rand_key) WHERE blocked = FALSE;")
+    op.execute("CREATE INDEX IF NOT EXISTS idx_users_rand_key_vip ON users(rand_key) WHERE blocked = FALSE AND vip = TRUE;")
+
+
+def downgrade():
+    op.execute("DROP INDEX IF EXISTS idx_users_rand_key_vip;")
+    op.execute("DROP INDEX IF EXISTS idx_users_rand_key;")
+    op.execute("ALTER TABLE users DROP COLUMN IF EXISTS rand_key;")
@@ -0,0 +1,21 @@
+"""views(viewer_id, created_at) index for seen-profile exclusion
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-18 13:00:00
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0003"
+down_revision = "0002"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute("CREATE INDEX IF NOT EXISTS idx_views_viewer_created ON views(viewer_id, created_at);")
+
+
+def downgrade():
+    op.execute("DROP INDEX IF EXISTS idx_views_viewer_created;")
@@ -0,0 +1,62 @@
+"""partial composite indexes for the matching query, normalized_city backfill
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-18 14:00:00
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0004"
+down_revision = "0003"
+branch_labels = None
+depends_on = None
+
+BATCH_SIZE = 5000
+
+
+def normalize_city(s):
+    # Копия db.normalize_city_str: значение считается в Python, а не через lower() в SQL —
+    # тот зависит от LC_CTYPE базы и при локали C не меняет регистр кириллицы
+    if not s:
+        return None
+    s = s.strip().lower().replace("ё", "е")
+    return " ".join(s.split())
+
+
+INDEXES = {
+    "idx_users_match_city": "users(normalized_city, gender, age) WHERE blocked = FALSE",
+    "idx_users_match_gender_age": "users(gender, age) WHERE blocked = FALSE",
+    "idx_users_match_age": "users(age) WHERE blocked = FALSE",
+}
+
+
+def upgrade():
+    # CREATE INDEX CONCURRENTLY не работает внутри транзакции; пачки backfill коммитятся по отдельности
+    with op.get_context().autocommit_block():
+        bind = op.get_bind()
+        max_id = bind.execute(sa.text("SELECT COALESCE(MAX(id), 0) FROM users")).scalar()
+        for lo in range(0, max_id + 1, BATCH_SIZE):
+            rows = bind.execute(
+                sa.text("SELECT id, city FROM users WHERE id >= :lo AND id < :hi AND normalized_city IS NULL"),
+                {"lo": lo, "hi": lo + BATCH_SIZE},
+            ).fetchall()
+            rows = [(r[0], r[1], normalize_city(r[1])) for r in rows if normalize_city(r[1]) is not None]
+            if not rows:
+                continue
+            bind.execute(
+                sa.text(
+                    "UPDATE users u SET normalized_city = v.norm "
+                    "FROM unnest(CAST(:ids AS int[]), CAST(:cities AS text[]), CAST(:norms AS text[])) AS v(id, city, norm) "
+                    "WHERE u.id = v.id AND u.city IS NOT DISTINCT FROM v.city AND u.normalized_city IS NULL"
+                ),
+                {"ids": [r[0] for r in rows], "cities": [r[1] for r in rows], "norms": [r[2] for r in rows]},
+            )
+        for name, definition in INDEXES.items():
+            op.execute(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {definition};")
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for name in INDEXES:
+            op.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name};")
@@ -0,0 +1,47 @@
+"""users.interests_mask: interests as a bitmask over utils.INTERESTS_LIST
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-18 15:00:00
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0005"
+down_revision = "0004"
+branch_labels = None
+depends_on = None
+
+BATCH_SIZE = 5000
+
+# Копия utils.INTERESTS_LIST на момент миграции: бит i соответствует элементу i
+INTERESTS_LIST = [
+    "🎵 Музыка", "✈️ Путешествие", "📚 Чтение", "🎨 Дизайн", "📝 Блогинг",
+    "🚗 Машины", "🧵 Рукоделие", "☦️ Религия", "🈷️ Изучение языков", "💼 Работа",
+    "🏋️‍♂️ Спорт", "🎮 Игры", "💃 Танцы", "🎬 Кино и Сериалы", "🍳 Кулинария",
+    "🖌️ Рисование", "🤝 Волонтерство"
+]
+
+MASK_SQL = (
+    "(SELECT COALESCE(bit_or(1 << (array_position(CAST(:names AS text[]), i) - 1)), 0) "
+    "FROM unnest(interests) i)"
+)
+
+
+def upgrade():
+    op.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS interests_mask INTEGER NOT NULL DEFAULT 0;")
+    with op.get_context().autocommit_block():
+        bind = op.get_bind()
+        max_id = bind.execute(sa.text("SELECT COALESCE(MAX(id), 0) FROM users")).scalar()
+        for lo in range(0, max_id + 1, BATCH_SIZE):
+            bind.execute(
+                sa.text(
+                    f"UPDATE users SET interests_mask = {MASK_SQL} "
+                    "WHERE id >= :lo AND id < :hi AND interests_mask = 0 AND cardinality(interests) > 0"
+                ),
+                {"lo": lo, "hi": lo + BATCH_SIZE, "names": INTERESTS_LIST},
+            )
+
+
+def downgrade():
+    op.execute("ALTER TABLE users DROP COLUMN IF EXISTS interests_mask;")
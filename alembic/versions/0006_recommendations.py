@@ -0,0 +1,55 @@
+"""recommendations table and users.updated_at for incremental recomputation
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2026-10-18 16:00:00
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0006"
+down_revision = "0005"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute(
+        """
+        CREATE TABLE IF NOT EXISTS recommendations (
+            user_id BIGINT NOT NULL,
+            position SMALLINT NOT NULL,
+            candidate_id BIGINT NOT NULL,
+            score REAL NOT NULL,
+            created_at TIMESTAMP DEFAULT NOW(),
+            PRIMARY KEY (user_id, position)
+        );
+        """
+    )
+    op.execute("CREATE INDEX IF NOT EXISTS idx_recommendations_candidate ON recommendations(candidate_id);")
+    op.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP DEFAULT NOW();")
+    op.execute(
+        """
+        CREATE OR REPLACE FUNCTION users_touch_updated_at() RETURNS trigger AS $$
+        BEGIN
+            NEW.updated_at := NOW();
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql;
+        """
+    )
+    op.execute(
+        """
+        CREATE OR REPLACE TRIGGER trg_users_updated_at
+        BEFORE UPDATE OF age, gender, gender_interest, normalized_city, interests_mask, vip, blocked,
+            age_min_preference, age_max_preference, city_filter_enabled
+        ON users FOR EACH ROW EXECUTE FUNCTION users_touch_updated_at();
+        """
+    )
+
+
+def downgrade():
+    op.execute("DROP TRIGGER IF EXISTS trg_users_updated_at ON users;")
+    op.execute("DROP FUNCTION IF EXISTS users_touch_updated_at();")
+    op.execute("ALTER TABLE users DROP COLUMN IF EXISTS updated_at;")
+    op.execute("DROP TABLE IF EXISTS recommendations;")
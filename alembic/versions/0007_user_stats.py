@@ -0,0 +1,43 @@
+"""user_stats: incremental likes/views received counters and desirability score
+
+Revision ID: 0007
+Revises: 0006
+Create Date: 2026-10-18 17:00:00
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0007"
+down_revision = "0006"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute(
+        """
+        CREATE TABLE IF NOT EXISTS user_stats (
+            telegram_id BIGINT PRIMARY KEY,
+            likes_received INTEGER NOT NULL DEFAULT 0,
+            views_received INTEGER NOT NULL DEFAULT 0,
+            desirability REAL GENERATED ALWAYS AS ((likes_received + 1)::real / (views_received + 10)) STORED
+        );
+        """
+    )
+    # Однократное начальное заполнение из истории; дальше счётчики растут инкрементально
+    op.execute(
+        """
+        INSERT INTO user_stats (telegram_id, likes_received, views_received)
+        SELECT tid, SUM(l), SUM(v) FROM (
+            SELECT to_user AS tid, COUNT(*) AS l, 0 AS v FROM likes GROUP BY to_user
+            UNION ALL
+            SELECT viewed_id, 0, COUNT(*) FROM views GROUP BY viewed_id
+        ) s
+        GROUP BY tid
+        ON CONFLICT (telegram_id) DO NOTHING;
+        """
+    )
+
+
+def downgrade():
+    op.execute("DROP TABLE IF EXISTS user_stats;")
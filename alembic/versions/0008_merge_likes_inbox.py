@@ -0,0 +1,68 @@
+"""merge likes_inbox into likes: one edge row with seen and mutual flags
+
+Revision ID: 0008
+Revises: 0007
+Create Date: 2026-10-18 18:00:00
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0008"
+down_revision = "0007"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute("ALTER TABLE likes ADD COLUMN IF NOT EXISTS seen BOOLEAN NOT NULL DEFAULT FALSE;")
+    op.execute("ALTER TABLE likes ADD COLUMN IF NOT EXISTS mutual BOOLEAN NOT NULL DEFAULT FALSE;")
+    # Входящие без ребра в likes добавляем; seen берём из likes_inbox,
+    # рёбра, которых во входящих не было, считаем уже просмотренными
+    op.execute(
+        """
+        INSERT INTO likes (from_user, to_user, created_at, seen)
+        SELECT from_user, to_user, created_at, COALESCE(seen, FALSE) FROM likes_inbox
+        ON CONFLICT (from_user, to_user) DO NOTHING;
+        """
+    )
+    op.execute(
+        """
+        UPDATE likes l SET seen = COALESCE(
+            (SELECT i.seen FROM likes_inbox i WHERE i.to_user = l.to_user AND i.from_user = l.from_user), TRUE);
+        """
+    )
+    op.execute(
+        """
+        UPDATE likes l SET mutual = TRUE
+        WHERE EXISTS (SELECT 1 FROM likes r WHERE r.from_user = l.to_user AND r.to_user = l.from_user);
+        """
+    )
+    op.execute("CREATE INDEX IF NOT EXISTS idx_likes_to_user_created ON likes(to_user, created_at);")
+    op.execute("CREATE INDEX IF NOT EXISTS idx_likes_inbox_unseen ON likes(to_user, created_at) WHERE seen = FALSE;")
+    op.execute("DROP TABLE IF EXISTS likes_inbox;")
+
+
+def downgrade():
+    op.execute(
+        """
+        CREATE TABLE IF NOT EXISTS likes_inbox (
+            id SERIAL PRIMARY KEY,
+            to_user BIGINT NOT NULL,
+            from_user BIGINT NOT NULL,
+            created_at TIMESTAMP DEFAULT NOW(),
+            seen BOOLEAN DEFAULT FALSE,
+            UNIQUE (to_user, from_user)
+        );
+        """
+    )
+    op.execute(
+        """
+        INSERT INTO likes_inbox (to_user, from_user, created_at, seen)
+        SELECT to_user, from_user, created_at, seen FROM likes
+        ON CONFLICT (to_user, from_user) DO NOTHING;
+        """
+    )
+    op.execute("DROP INDEX IF EXISTS idx_likes_inbox_unseen;")
+    op.execute("DROP INDEX IF EXISTS idx_likes_to_user_created;")
+    op.execute("ALTER TABLE likes DROP COLUMN IF EXISTS mutual;")
+    op.execute("ALTER TABLE likes DROP COLUMN IF EXISTS seen;")
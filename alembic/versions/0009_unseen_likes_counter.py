@@ -0,0 +1,28 @@
+"""user_stats.unseen_likes: maintained counter of unseen incoming likes
+
+Revision ID: 0009
+Revises: 0008
+Create Date: 2026-10-18 19:00:00
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0009"
+down_revision = "0008"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute("ALTER TABLE user_stats ADD COLUMN IF NOT EXISTS unseen_likes INTEGER NOT NULL DEFAULT 0;")
+    op.execute(
+        """
+        INSERT INTO user_stats (telegram_id, unseen_likes)
+        SELECT to_user, COUNT(*) FROM likes WHERE seen = FALSE GROUP BY to_user
+        ON CONFLICT (telegram_id) DO UPDATE SET unseen_likes = EXCLUDED.unseen_likes;
+        """
+    )
+
+
+def downgrade():
+    op.execute("ALTER TABLE user_stats DROP COLUMN IF EXISTS unseen_likes;")
@@ -0,0 +1,23 @@
+"""users.username and users.username_refreshed_at: cached Telegram usernames
+
+Revision ID: 0010
+Revises: 0009
+Create Date: 2026-10-18 20:00:00
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0010"
+down_revision = "0009"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS username TEXT;")
+    op.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS username_refreshed_at TIMESTAMP;")
+
+
+def downgrade():
+    op.execute("ALTER TABLE users DROP COLUMN IF EXISTS username_refreshed_at;")
+    op.execute("ALTER TABLE users DROP COLUMN IF EXISTS username;")
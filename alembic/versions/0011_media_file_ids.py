@@ -0,0 +1,33 @@
+"""media: Telegram file_id per stored photo/video for re-sending without upload
+
+Revision ID: 0011
+Revises: 0010
+Create Date: 2026-10-18 21:00:00
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0011"
+down_revision = "0010"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute(
+        """
+        CREATE TABLE IF NOT EXISTS media (
+            path TEXT PRIMARY KEY,
+            telegram_id BIGINT NOT NULL,
+            kind TEXT NOT NULL,
+            file_id TEXT,
+            file_unique_id TEXT,
+            created_at TIMESTAMP DEFAULT NOW()
+        );
+        """
+    )
+    op.execute("CREATE INDEX IF NOT EXISTS idx_media_telegram_id ON media(telegram_id);")
+
+
+def downgrade():
+    op.execute("DROP TABLE IF EXISTS media;")
@@ -0,0 +1,66 @@
+"""media_blobs: content-addressed media storage with refcounts from users.photos/videos
+
+Revision ID: 0012
+Revises: 0011
+Create Date: 2026-10-18 22:00:00
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0012"
+down_revision = "0011"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute("ALTER TABLE media ADD COLUMN IF NOT EXISTS stored_path TEXT;")
+    op.execute("CREATE INDEX IF NOT EXISTS idx_media_stored_path ON media(stored_path);")
+    op.execute(
+        """
+        CREATE TABLE IF NOT EXISTS media_blobs (
+            hash TEXT PRIMARY KEY,
+            path TEXT NOT NULL UNIQUE,
+            size BIGINT NOT NULL,
+            refcount INTEGER NOT NULL DEFAULT 0,
+            touched_at TIMESTAMP DEFAULT NOW()
+        );
+        """
+    )
+    op.execute("CREATE INDEX IF NOT EXISTS idx_media_blobs_unreferenced ON media_blobs(touched_at) WHERE refcount <= 0;")
+    op.execute(
+        """
+        CREATE OR REPLACE FUNCTION users_media_refcount() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP <> 'INSERT' THEN
+                UPDATE media_blobs b SET refcount = b.refcount - d.n
+                FROM (SELECT p, COUNT(*) AS n FROM unnest(OLD.photos || OLD.videos) AS p GROUP BY p) d
+                WHERE b.path = d.p;
+            END IF;
+            IF TG_OP <> 'DELETE' THEN
+                UPDATE media_blobs b SET refcount = b.refcount + d.n
+                FROM (SELECT p, COUNT(*) AS n FROM unnest(NEW.photos || NEW.videos) AS p GROUP BY p) d
+                WHERE b.path = d.p;
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql;
+        """
+    )
+    op.execute(
+        """
+        CREATE OR REPLACE TRIGGER trg_users_media_refcount
+        AFTER INSERT OR DELETE OR UPDATE OF photos, videos
+        ON users FOR EACH ROW EXECUTE FUNCTION users_media_refcount();
+        """
+    )
+    op.execute("CREATE INDEX IF NOT EXISTS idx_users_media ON users USING GIN ((photos || videos));")
+
+
+def downgrade():
+    op.execute("DROP INDEX IF EXISTS idx_users_media;")
+    op.execute("DROP TRIGGER IF EXISTS trg_users_media_refcount ON users;")
+    op.execute("DROP FUNCTION IF EXISTS users_media_refcount();")
+    op.execute("DROP TABLE IF EXISTS media_blobs;")
+    op.execute("DROP INDEX IF EXISTS idx_media_stored_path;")
+    op.execute("ALTER TABLE media DROP COLUMN IF EXISTS stored_path;")
@@ -0,0 +1,43 @@
+"""Пакетное заполнение users.normalized_city для существующих строк.
+
+Запуск: python backfill_city.py --batch 1000 [--restart]
+
+Каждая пачка из --batch строк обрабатывается отдельной транзакцией, а последний обработанный id
+сохраняется в app_settings, поэтому прерванный запуск продолжается с того же места.
+"""
+import argparse
+import logging
+
+import db
+
+CHECKPOINT_KEY = "backfill_city_last_id"
+
+logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--batch", type=int, default=1000)
+    parser.add_argument("--restart", action="store_true", help="начать с первой строки, игнорируя сохранённую позицию")
+    args = parser.parse_args()
+
+    last_id = 0 if args.restart else int(db.get_checkpoint(CHECKPOINT_KEY, "0"))
+    scanned_total = updated_total = 0
+    logger.info("Старт с id > %s, пачка %s", last_id, args.batch)
+    try:
+        while True:
+            last_id, scanned, updated = db.backfill_normalized_city(last_id, args.batch)
+            if not scanned:
+                break
+            scanned_total += scanned
+            updated_total += updated
+            db.set_checkpoint(CHECKPOINT_KEY, str(last_id))
+            logger.info("id <= %s: просмотрено %s, обновлено %s", last_id, scanned_total, updated_total)
+    finally:
+        db.close_pool()
+    logger.info("Готово: просмотрено %s, обновлено %s", scanned_total, updated_total)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""Сравнение стратегий выбора анкеты: ORDER BY RANDOM() против выборки по индексу rand_key.
+
+Запуск: python bench_sampling.py --users 200000 --rounds 200
+
+Данные генерируются во временной таблице users текущей сессии (она перекрывает
+public.users только для этого соединения), поэтому рабочая база не затрагивается.
+"""
+import argparse
+import random
+import statistics
+import time
+
+import db
+
+CITIES = ["москва", "санкт-петербург", "казань", "новосибирск", "екатеринбург", "самара", "омск", "пермь"]
+
+
+def seed(cur, n: int):
+    cur.execute("CREATE TEMP TABLE users (LIKE public.users INCLUDING ALL)")
+    cur.execute(
+        """
+        INSERT INTO users (telegram_id, name, age, city, normalized_city, gender, gender_interest, interests, vip)
+        SELECT -g,
+               'bench' || g,
+               18 + (g * 7919) %% 40,
+               (%(cities)s::text[])[1 + g %% array_length(%(cities)s::text[], 1)],
+               (%(cities)s::text[])[1 + g %% array_length(%(cities)s::text[], 1)],
+               CASE WHEN g %% 2 = 0 THEN 'Парень' ELSE 'Девушка' END,
+               'Без разницы',
+               '{}',
+               g %% 50 = 0
+        FROM generate_series(1, %(n)s) g
+        """,
+        {"n": n, "cities": CITIES},
+    )
+    cur.execute("ANALYZE users")
+
+
+def run(cur, pick, rounds: int) -> list:
+    timings = []
+    for _ in range(rounds):
+        params = {
+            "me": -random.randint(1, 1000),
+            "min_age": 20,
+            "max_age": 26,
+            "norm_city": random.choice(CITIES),
+            "gender": random.choice(["Парень", "Девушка", None]),
+            "city_enabled": True,
+        }
+        started = time.perf_counter()
+        for _, where in db._search_tiers(params):
+            if pick(cur, where, params, 1):
+                break
+        timings.append((time.perf_counter() - started) * 1000)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=100000)
+    parser.add_argument("--rounds", type=int, default=200)
+    args = parser.parse_args()
+
+    conn = db._connect()
+    try:
+        with conn.cursor() as cur:
+            seed(cur, args.users)
+            print(f"Пользователей: {args.users}, запросов на стратегию: {args.rounds}")
+            for name, pick in (("random", db._batch_random), ("indexed", db._batch_indexed)):
+                run(cur, pick, 10)  # прогрев кэша
+                t = sorted(run(cur, pick, args.rounds))
+                print(
+                    f"{name:8s} avg={statistics.mean(t):.2f}ms "
+                    f"p50={t[len(t) // 2]:.2f}ms p95={t[int(len(t) * 0.95) - 1]:.2f}ms max={t[-1]:.2f}ms"
+                )
+    finally:
+        conn.rollback()
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
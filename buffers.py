@@ -0,0 +1,193 @@
+import time
+import queue
+import logging
+import threading
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehindBuffer:
+    """Буфер отложенной записи: события копятся в ограниченной очереди и пишутся в БД пачками
+    фоновым потоком — по достижении batch_size или раз в interval секунд.
+    При переполнении очереди новые события отбрасываются и учитываются в счётчике dropped.
+    Пачка, которую не удалось записать, повторяется до max_retries раз, затем учитывается в failed."""
+
+    def __init__(self, name: str, flush_fn, max_size: int, batch_size: int, interval: float, max_retries: int = 3):
+        self.name = name
+        self._flush_fn = flush_fn
+        self._batch_size = max(1, batch_size)
+        self._interval = interval
+        self._queue = queue.Queue(maxsize=max_size)
+        self._max_retries = max_retries
+        self._retries = deque()  # (пачка, номер попытки) для повторной записи
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+        self.stats = {"enqueued": 0, "written": 0, "batches": 0, "dropped": 0, "failed": 0, "retried": 0}
+
+    def _count(self, key: str, n: int = 1):
+        with self._lock:
+            self.stats[key] += n
+
+    def _ensure_thread(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None and not self._stop.is_set():
+                    self._thread = threading.Thread(target=self._run, name=f"{self.name}-flusher", daemon=True)
+                    self._thread.start()
+
+    def put(self, item):
+        self._ensure_thread()
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            self._count("dropped")
+            return False
+        self._count("enqueued")
+        return True
+
+    def _take_batch(self, wait: bool) -> list:
+        batch = []
+        deadline = time.monotonic() + self._interval
+        while len(batch) < self._batch_size:
+            try:
+                if wait:
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    batch.append(self._queue.get(timeout=timeout))
+                else:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, batch: list, attempt: int = 0):
+        try:
+            self._flush_fn(batch)
+        except Exception:
+            if attempt < self._max_retries:
+                # вернём пачку на повтор, как CoalescingTracker возвращает несохранённые ключи
+                with self._lock:
+                    self._retries.append((batch, attempt + 1))
+                    self.stats["retried"] += len(batch)
+                logger.exception("Не удалось записать пачку %s (%d шт.), попытка %d", self.name, len(batch), attempt + 1)
+            else:
+                self._count("failed", len(batch))
+                logger.exception("Пачка %s (%d шт.) отброшена после %d попыток", self.name, len(batch), attempt + 1)
+            return
+        self._count("written", len(batch))
+        self._count("batches")
+
+    def _take_retry(self):
+        with self._lock:
+            return self._retries.popleft() if self._retries else None
+
+    def _run(self):
+        while not self._stop.is_set():
+            retry = self._take_retry()
+            if retry is not None:
+                # пауза перед повтором, чтобы не долбить недоступную БД
+                if self._stop.wait(self._interval):
+                    with self._lock:
+                        self._retries.appendleft(retry)
+                    return
+                self._write(*retry)
+                continue
+            batch = self._take_batch(wait=True)
+            if batch:
+                self._write(batch)
+
+    def flush(self):
+        """Синхронно записать всё, что накопилось в очереди (и пачки, ждущие повтора, — ещё по одной попытке)."""
+        pending = []
+        while True:
+            retry = self._take_retry()
+            if retry is None:
+                break
+            pending.append(retry)
+        for batch, attempt in pending:
+            self._write(batch, attempt)
+        while True:
+            batch = self._take_batch(wait=False)
+            if not batch:
+                return
+            self._write(batch)
+
+    def close(self, timeout: float = 5.0):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self.flush()
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            data = dict(self.stats)
+        data["queued"] = self._queue.qsize()
+        with self._lock:
+            data["retrying"] = sum(len(batch) for batch, _ in self._retries)
+        return data
+
+
+class CoalescingTracker:
+    """Копит последнее значение по ключу (например, время активности пользователя)
+    и раз в interval секунд отдаёт все изменившиеся ключи одной пачкой в flush_fn."""
+
+    def __init__(self, name: str, flush_fn, interval: float):
+        self.name = name
+        self._flush_fn = flush_fn
+        self._interval = interval
+        self._dirty = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.stats = {"marked": 0, "written": 0, "batches": 0, "failed": 0}
+
+    def _ensure_thread(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None and not self._stop.is_set():
+                    self._thread = threading.Thread(target=self._run, name=f"{self.name}-flusher", daemon=True)
+                    self._thread.start()
+
+    def mark(self, key, value):
+        self._ensure_thread()
+        with self._lock:
+            self._dirty[key] = value
+            self.stats["marked"] += 1
+
+    def _run(self):
+        while not self._stop.wait(self._interval):
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            dirty, self._dirty = self._dirty, {}
+        if not dirty:
+            return
+        try:
+            self._flush_fn(dirty)
+        except Exception:
+            with self._lock:
+                self.stats["failed"] += len(dirty)
+                # вернём несохранённое, если за это время не пришло более свежих значений
+                for key, value in dirty.items():
+                    self._dirty.setdefault(key, value)
+            logger.exception("Не удалось записать пачку %s (%d шт.)", self.name, len(dirty))
+            return
+        with self._lock:
+            self.stats["written"] += len(dirty)
+            self.stats["batches"] += 1
+
+    def close(self, timeout: float = 5.0):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self.flush()
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            data = dict(self.stats)
+            data["pending"] = len(self._dirty)
+        return data
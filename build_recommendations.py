@@ -0,0 +1,277 @@
+"""Офлайн-расчёт рекомендаций: top-K подходящих анкет для каждого пользователя.
+
+Запуск: python build_recommendations.py [--full] [--k 50] [--chunk 256] [--candidate-chunk 50000] [--workers 4]
+
+Признаки всех незаблокированных анкет собираются в массивы NumPy: маска интересов, возраст, город, пол,
+привлекательность из user_stats (сглаженная доля лайков среди просмотров). Оценки считаются блоками «пользователи × кандидаты»,
+поэтому память ограничена размером блока, а не числом анкет. Результат пишется в таблицу recommendations,
+откуда его первым берёт поиск (db.get_candidate_ids_for_user).
+
+Без --full пересчитываются только пользователи, у которых с прошлого запуска изменилась анкета
+(users.updated_at), появились просмотры или лайки, или ещё нет рекомендаций.
+Время прошлого запуска хранится в app_settings.
+"""
+import argparse
+import logging
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import db
+from seen import SEEN_WINDOW_DAYS
+from utils import INTERESTS_LIST
+
+CHECKPOINT_KEY = "recommendations_last_run"
+
+# Веса слагаемых оценки
+W_INTERESTS = 3.0   # косинусная близость масок интересов
+W_CITY = 2.0        # тот же город
+W_AGE = 1.0         # штраф за каждые 10 лет разницы в возрасте
+W_RECIPROCAL = 1.5  # кандидат сам ищет людей такого пола и возраста
+W_POPULARITY = 10.0  # привлекательность кандидата (user_stats.desirability, обычно 0..0.5)
+W_LIKED_ME = 3.0    # кандидат уже лайкнул пользователя
+W_VIP = 0.5
+
+GENDERS = {"Парень": 1, "Девушка": 2}
+
+logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def _wanted_gender(gender_interest) -> int:
+    # Те же правила, что в db._search_params
+    gi = gender_interest or "Без разницы"
+    if gi.startswith("Парни"):
+        return GENDERS["Парень"]
+    if gi.startswith("Девушки"):
+        return GENDERS["Девушка"]
+    return 0
+
+
+def load_features(conn) -> dict:
+    """Признаки незаблокированных анкет, упорядоченных по telegram_id."""
+    ids, age, gender, want, city, mask, vip, min_age, max_age, score = ([] for _ in range(10))
+    cities = {}
+    with conn.cursor(name="rec_users") as cur:
+        cur.itersize = 10000
+        cur.execute(
+            """
+            SELECT u.telegram_id, u.age, u.gender, u.gender_interest, u.normalized_city, u.interests_mask,
+                   COALESCE(u.vip, FALSE) AS vip, u.age_min_preference, u.age_max_preference,
+                   COALESCE(st.desirability, %s) AS desirability
+            FROM users u LEFT JOIN user_stats st ON st.telegram_id = u.telegram_id
+            WHERE u.blocked = FALSE ORDER BY u.telegram_id
+            """,
+            (db.DESIRABILITY_PRIOR,),
+        )
+        for row in cur:
+            my_age = row["age"] or 18
+            ids.append(row["telegram_id"])
+            age.append(my_age)
+            gender.append(GENDERS.get(row["gender"], 0))
+            want.append(_wanted_gender(row["gender_interest"]))
+            city.append(cities.setdefault(row["normalized_city"], len(cities)) if row["normalized_city"] else -1)
+            mask.append(row["interests_mask"] or 0)
+            vip.append(row["vip"])
+            min_age.append(row["age_min_preference"] or max(18, my_age - 3))
+            max_age.append(row["age_max_preference"] or (my_age + 3))
+            score.append(row["desirability"])
+    conn.commit()
+
+    f = {
+        "ids": np.array(ids, dtype=np.int64),
+        "age": np.array(age, dtype=np.float32),
+        "gender": np.array(gender, dtype=np.int8),
+        "want": np.array(want, dtype=np.int8),
+        "city": np.array(city, dtype=np.int32),
+        "vip": np.array(vip, dtype=bool),
+        "min_age": np.array(min_age, dtype=np.float32),
+        "max_age": np.array(max_age, dtype=np.float32),
+        "popularity": np.array(score, dtype=np.float32),
+    }
+    masks = np.array(mask, dtype=np.uint32)
+    f["bits"] = ((masks[:, None] >> np.arange(len(INTERESTS_LIST), dtype=np.uint32)) & 1).astype(np.float32)
+    f["norm"] = np.sqrt(np.maximum(f["bits"].sum(axis=1), 1.0))
+    return f
+
+
+def _positions(ids: np.ndarray, values: np.ndarray):
+    """Индексы values в отсортированном ids и маска тех, что там действительно есть."""
+    pos = np.searchsorted(ids, values)
+    pos = np.minimum(pos, len(ids) - 1)
+    return pos, ids[pos] == values
+
+
+def target_indices(cur, ids: np.ndarray, since) -> np.ndarray:
+    if since is None:
+        return np.arange(len(ids))
+    cur.execute(
+        """
+        SELECT telegram_id AS tid FROM users WHERE updated_at > %(since)s OR created_at > %(since)s
+        UNION SELECT viewer_id FROM views WHERE created_at > %(since)s
+        UNION SELECT from_user FROM likes WHERE created_at > %(since)s
+        UNION SELECT u.telegram_id FROM users u
+              WHERE NOT EXISTS (SELECT 1 FROM recommendations r WHERE r.user_id = u.telegram_id)
+        """,
+        {"since": since},
+    )
+    changed = np.array([r["tid"] for r in cur.fetchall()], dtype=np.int64)
+    if not len(changed) or not len(ids):
+        return np.arange(0)
+    pos, ok = _positions(ids, changed)
+    return np.unique(pos[ok])
+
+
+def load_pairs(cur, ids: np.ndarray, chunk: np.ndarray):
+    """Пары (строка блока, индекс кандидата): уже просмотренные/лайкнутые и лайкнувшие пользователя."""
+    user_ids = ids[chunk].tolist()
+    cur.execute(
+        """
+        SELECT viewer_id AS u, viewed_id AS c FROM views
+        WHERE %(window)s > 0 AND viewer_id = ANY(%(users)s) AND created_at >= NOW() - make_interval(days => %(window)s)
+        UNION SELECT from_user, to_user FROM likes WHERE from_user = ANY(%(users)s)
+        """,
+        {"users": user_ids, "window": SEEN_WINDOW_DAYS},
+    )
+    excluded = _pairs(ids, chunk, cur.fetchall())
+    cur.execute("SELECT to_user AS u, from_user AS c FROM likes WHERE to_user = ANY(%s)", (user_ids,))
+    liked_me = _pairs(ids, chunk, cur.fetchall())
+    return excluded, liked_me
+
+
+def _pairs(ids: np.ndarray, chunk: np.ndarray, rows: list):
+    if not rows:
+        return np.arange(0), np.arange(0)
+    users = np.array([r["u"] for r in rows], dtype=np.int64)
+    cands = np.array([r["c"] for r in rows], dtype=np.int64)
+    row = np.searchsorted(ids[chunk], users)  # chunk отсортирован, как и ids
+    col, ok = _positions(ids, cands)
+    return row[ok], col[ok]
+
+
+_features = None
+
+
+def _init_worker(features: dict):
+    global _features
+    _features = features
+
+
+def _score_block(f: dict, u: np.ndarray, c0: int, c1: int) -> np.ndarray:
+    c = slice(c0, c1)
+    age_u, age_c = f["age"][u][:, None], f["age"][c][None, :]
+    gender_u, gender_c = f["gender"][u][:, None], f["gender"][c][None, :]
+    want_u, want_c = f["want"][u][:, None], f["want"][c][None, :]
+    city_u = f["city"][u][:, None]
+
+    # Жёсткие фильтры — как у первых ступеней поиска: пол и возрастной коридор пользователя
+    ok = (age_c >= f["min_age"][u][:, None]) & (age_c <= f["max_age"][u][:, None])
+    ok &= (want_u == 0) | (gender_c == want_u)
+    ok &= f["ids"][u][:, None] != f["ids"][c][None, :]
+
+    s = W_INTERESTS * (f["bits"][u] @ f["bits"][c].T) / (f["norm"][u][:, None] * f["norm"][c][None, :])
+    s += W_CITY * ((city_u >= 0) & (city_u == f["city"][c][None, :]))
+    s -= W_AGE * np.abs(age_u - age_c) / 10.0
+    reciprocal = ((want_c == 0) | (want_c == gender_u)) & (age_u >= f["min_age"][c][None, :]) & (age_u <= f["max_age"][c][None, :])
+    s += W_RECIPROCAL * reciprocal
+    s += (W_POPULARITY * f["popularity"][c] + W_VIP * f["vip"][c])[None, :]
+    s[~ok] = -np.inf
+    return s.astype(np.float32, copy=False)
+
+
+def score_chunk(chunk: np.ndarray, excluded, liked_me, k: int, candidate_chunk: int):
+    """Top-k кандидатов для пользователей chunk: (chunk, индексы кандидатов, оценки), по убыванию оценки."""
+    f = _features
+    n = len(f["ids"])
+    best_s = np.full((len(chunk), k), -np.inf, dtype=np.float32)
+    best_i = np.full((len(chunk), k), -1, dtype=np.int64)
+    for c0 in range(0, n, candidate_chunk):
+        c1 = min(n, c0 + candidate_chunk)
+        s = _score_block(f, chunk, c0, c1)
+        rows, cols = liked_me
+        sel = (cols >= c0) & (cols < c1)
+        s[rows[sel], cols[sel] - c0] += W_LIKED_ME
+        rows, cols = excluded
+        sel = (cols >= c0) & (cols < c1)
+        s[rows[sel], cols[sel] - c0] = -np.inf
+        # текущий top-k и новый блок: оставляем k лучших
+        all_s = np.concatenate([best_s, s], axis=1)
+        all_i = np.concatenate([best_i, np.broadcast_to(np.arange(c0, c1), s.shape)], axis=1)
+        top = np.argpartition(-all_s, k - 1, axis=1)[:, :k]
+        best_s = np.take_along_axis(all_s, top, axis=1)
+        best_i = np.take_along_axis(all_i, top, axis=1)
+    order = np.argsort(-best_s, axis=1, kind="stable")
+    return chunk, np.take_along_axis(best_i, order, axis=1), np.take_along_axis(best_s, order, axis=1)
+
+
+def store(ids: np.ndarray, chunk: np.ndarray, best_i: np.ndarray, best_s: np.ndarray) -> int:
+    user_ids = ids[chunk]
+    valid = np.isfinite(best_s)
+    r, pos = np.nonzero(valid)
+    rows = list(zip(
+        user_ids[r].tolist(),
+        pos.tolist(),
+        ids[best_i[valid]].tolist(),
+        best_s[valid].tolist(),
+    ))
+    db.store_recommendations(user_ids.tolist(), rows)
+    return len(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--full", action="store_true", help="пересчитать всех, а не только изменившихся")
+    parser.add_argument("--k", type=int, default=50, help="сколько кандидатов хранить на пользователя")
+    parser.add_argument("--chunk", type=int, default=256, help="пользователей в блоке")
+    parser.add_argument("--candidate-chunk", type=int, default=50000, help="кандидатов в блоке")
+    parser.add_argument("--workers", type=int, default=1, help="процессов для расчёта оценок")
+    args = parser.parse_args()
+
+    started = time.monotonic()
+    conn = db._connect()
+    executor = None
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT LOCALTIMESTAMP AS now")
+            run_at = cur.fetchone()["now"]
+            features = load_features(conn)
+            ids = features["ids"]
+            since = None if args.full else db.get_checkpoint(CHECKPOINT_KEY)
+            targets = target_indices(cur, ids, since)
+            conn.commit()
+            logger.info("Анкет: %s, к пересчёту: %s (%s)", len(ids), len(targets), "полный" if since is None else f"с {since}")
+
+            if args.workers > 1:
+                executor = ProcessPoolExecutor(args.workers, initializer=_init_worker, initargs=(features,))
+            else:
+                _init_worker(features)
+            in_flight = deque()
+            users = stored = 0
+            for start in range(0, len(targets), args.chunk):
+                chunk = targets[start:start + args.chunk]
+                excluded, liked_me = load_pairs(cur, ids, chunk)
+                conn.commit()
+                if executor is None:
+                    stored += store(ids, *score_chunk(chunk, excluded, liked_me, args.k, args.candidate_chunk))
+                else:
+                    in_flight.append(executor.submit(score_chunk, chunk, excluded, liked_me, args.k, args.candidate_chunk))
+                    # не больше двух блоков на процесс в очереди, чтобы не копить результаты в памяти
+                    while len(in_flight) >= args.workers * 2:
+                        stored += store(ids, *in_flight.popleft().result())
+                users += len(chunk)
+                logger.info("Обработано пользователей: %s/%s", users, len(targets))
+            while in_flight:
+                stored += store(ids, *in_flight.popleft().result())
+        db.set_checkpoint(CHECKPOINT_KEY, run_at.isoformat())
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        conn.close()
+        db.close_pool()
+    logger.info("Готово: %s рекомендаций за %.1fс", stored, time.monotonic() - started)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+import time
+import threading
+from collections import OrderedDict
+
+_MISSING = object()
+
+
+class LRUCache:
+    """Потокобезопасный LRU-кэш ограниченного размера с необязательным временем жизни записей
+    и счётчиками попаданий, промахов и вытеснений."""
+
+    def __init__(self, maxsize: int, ttl: float = None):
+        self.maxsize = max(1, maxsize)
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (value, время записи)
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key, _MISSING)
+            if item is not _MISSING and self.ttl is not None and time.monotonic() - item[1] > self.ttl:
+                del self._data[key]
+                item = _MISSING
+            if item is _MISSING:
+                self.stats["misses"] += 1
+                return default
+            self._data.move_to_end(key)
+            self.stats["hits"] += 1
+            return item[0]
+
+    def _store(self, key, value):
+        self._data[key] = (value, time.monotonic())
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def set(self, key, value):
+        with self._lock:
+            self._store(key, value)
+
+    def pop(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            data = dict(self.stats)
+            data["size"] = len(self._data)
+        return data
+
+
+class VersionedLRUCache(LRUCache):
+    """LRU-кэш с версиями ключей. Читатель берёт version(key) до чтения из БД и передаёт её в set():
+    если ключ за это время инвалидировали, устаревшее значение в кэш не попадёт."""
+
+    def __init__(self, maxsize: int, ttl: float = None):
+        super().__init__(maxsize, ttl)
+        self._versions = OrderedDict()
+        self._counter = 0
+        self.stats["invalidations"] = 0
+
+    def version(self, key) -> int:
+        with self._lock:
+            return self._versions.get(key, 0)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._counter += 1
+            self._versions[key] = self._counter
+            self._versions.move_to_end(key)
+            while len(self._versions) > self.maxsize:
+                self._versions.popitem(last=False)
+            self._data.pop(key, None)
+            self.stats["invalidations"] += 1
+
+    def set(self, key, value, version: int = None) -> bool:
+        with self._lock:
+            if version is not None and self._versions.get(key, 0) != version:
+                return False
+            self._store(key, value)
+            return True
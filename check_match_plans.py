@@ -0,0 +1,68 @@
+"""Проверка планов поискового запроса: EXPLAIN каждой ступени на засеянной базе.
+
+Запуск: python check_match_plans.py --users 100000 [--sampling indexed|random]
+
+Данные генерируются во временной таблице users (как в bench_sampling.py), рабочая база не затрагивается.
+Скрипт завершается с кодом 1, если хотя бы одна ступень выполняется через Seq Scan.
+Для --sampling random широкие ступени (без города и возраста) всегда читают всех кандидатов —
+это свойство ORDER BY RANDOM(), поэтому по умолчанию проверяется indexed.
+"""
+import argparse
+import json
+import sys
+
+import db
+from bench_sampling import seed, CITIES
+
+
+def _seq_scans(plan: dict) -> list:
+    found = []
+    if plan.get("Node Type") == "Seq Scan":
+        found.append(plan.get("Relation Name"))
+    for child in plan.get("Plans", []):
+        found.extend(_seq_scans(child))
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=100000)
+    parser.add_argument("--sampling", choices=sorted(db.SAMPLE_SQL), default="indexed")
+    parser.add_argument("--limit", type=int, default=20, help="размер пачки кандидатов (DECK_SIZE)")
+    args = parser.parse_args()
+    build_sql = db.SAMPLE_SQL[args.sampling]
+
+    conn = db._connect()
+    failed = False
+    try:
+        with conn.cursor() as cur:
+            seed(cur, args.users)
+            for gender in ("Девушка", None):
+                params = {
+                    "me": -1,
+                    "min_age": 22,
+                    "max_age": 28,
+                    "norm_city": CITIES[0],
+                    "gender": gender,
+                    "city_enabled": True,
+                    "rnd": 0.5,
+                }
+                for tier, where in db._search_tiers(params):
+                    sql = build_sql(where, "telegram_id, rand_key", args.limit)
+                    cur.execute("EXPLAIN (FORMAT JSON) " + sql, params)
+                    raw = cur.fetchone()
+                    plan = (raw["QUERY PLAN"] if isinstance(raw["QUERY PLAN"], list) else json.loads(raw["QUERY PLAN"]))[0]["Plan"]
+                    scans = _seq_scans(plan)
+                    status = "FAIL" if scans else "ok"
+                    failed = failed or bool(scans)
+                    print(f"[{status}] tier {tier}, gender={gender or 'any'}: cost={plan['Total Cost']}")
+                    if scans:
+                        print("       Seq Scan по:", ", ".join(sorted(set(filter(None, scans)))))
+    finally:
+        conn.rollback()
+        conn.close()
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
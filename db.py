@@ -1,8 +1,19 @@
 import os
+import time
+import random
 import logging
+import threading
 from datetime import date, datetime
+from collections import Counter
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2 import extensions
+from psycopg2.extras import RealDictCursor, execute_values
+from psycopg2.pool import PoolError
+
+from buffers import WriteBehindBuffer, CoalescingTracker
+from cache import LRUCache, VersionedLRUCache
+from utils import interests_to_mask
+from seen import get_seen_filter, mark_seen, forget as forget_seen, SEEN_WINDOW_DAYS, SEEN_MAX_ENTRIES
 
 logger = logging.getLogger(__name__)
 
@@ -13,8 +24,61 @@ DB_PASSWORD = os.getenv("PGPASSWORD", "1")
 DB_HOST = os.getenv("PGHOST", "localhost")
 DB_PORT = int(os.getenv("PGPORT", "5432"))
 
-
-def get_connection():
+# Пул соединений: размеры, таймаут ожидания свободного соединения (сек)
+# и интервал простоя, после которого соединение проверяется через SELECT 1
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+DB_POOL_PING_INTERVAL = float(os.getenv("DB_POOL_PING_INTERVAL", "30"))
+
+# Стратегия выбора случайной анкеты: random — ORDER BY RANDOM(), indexed — выборка по индексу rand_key,
+# memory — индекс анкет в памяти процесса (matching.py)
+MATCH_SAMPLING = os.getenv("MATCH_SAMPLING", "random").lower()
+# Как часто перемешивать rand_key (сек), используется только при MATCH_SAMPLING=indexed
+RAND_KEY_RESHUFFLE_INTERVAL = int(os.getenv("RAND_KEY_RESHUFFLE_INTERVAL", "21600"))
+# Во сколько раз больше кандидатов выбирать, чтобы после отсева просмотренных хватило на пачку
+SEEN_OVERFETCH = int(os.getenv("SEEN_OVERFETCH", "3"))
+# Сколько раз перевыбрать кандидатов внутри ступени, если все выбранные уже просмотрены,
+# прежде чем перейти к следующей (более мягкой) ступени
+SEEN_RESAMPLE_ATTEMPTS = int(os.getenv("SEEN_RESAMPLE_ATTEMPTS", "3"))
+
+# Отложенная запись истории просмотров: размер очереди, размер пачки и интервал сброса (сек)
+VIEWS_BUFFER_MAX = int(os.getenv("VIEWS_BUFFER_MAX", "10000"))
+VIEWS_FLUSH_SIZE = int(os.getenv("VIEWS_FLUSH_SIZE", "500"))
+VIEWS_FLUSH_INTERVAL = float(os.getenv("VIEWS_FLUSH_INTERVAL", "2"))
+# Как часто сбрасывать накопленные last_active_at в БД (сек)
+ACTIVITY_FLUSH_INTERVAL = float(os.getenv("ACTIVITY_FLUSH_INTERVAL", "60"))
+# Кэш app_settings: как часто проверять счётчик версии и когда перечитывать таблицу целиком (сек)
+SETTINGS_POLL_INTERVAL = float(os.getenv("SETTINGS_POLL_INTERVAL", "5"))
+SETTINGS_CACHE_TTL = float(os.getenv("SETTINGS_CACHE_TTL", "300"))
+# Кэш статуса блокировки: размер и время жизни записи (сек) — за это время блокировка
+# доходит до остальных процессов
+BLOCKED_CACHE_SIZE = int(os.getenv("BLOCKED_CACHE_SIZE", "50000"))
+BLOCKED_CACHE_TTL = float(os.getenv("BLOCKED_CACHE_TTL", "5"))
+# Кэш анкет по telegram_id: размер и время жизни записи (сек) для изменений из других процессов
+PROFILE_CACHE_SIZE = int(os.getenv("PROFILE_CACHE_SIZE", "20000"))
+PROFILE_CACHE_TTL = float(os.getenv("PROFILE_CACHE_TTL", "60"))
+# Сколько секунд помнить, что пользователь исчерпал дневной лимит просмотров (отказ без колоды и БД)
+VIEW_LIMIT_CACHE_TTL = float(os.getenv("VIEW_LIMIT_CACHE_TTL", "60"))
+# Сглаженная привлекательность анкеты: (лайки + 1) / (просмотры + 10); значение для анкет без статистики
+DESIRABILITY_PRIOR = 0.1
+# Кэш @username по telegram_id (заполняется из входящих апдейтов, хранится в users.username):
+# размер и время жизни записи в памяти (сек), после которого она перечитывается из БД
+USERNAME_CACHE_SIZE = int(os.getenv("USERNAME_CACHE_SIZE", "50000"))
+USERNAME_CACHE_TTL = float(os.getenv("USERNAME_CACHE_TTL", "600"))
+# Через сколько секунд username считается устаревшим и обновляется в фоне через get_chat
+USERNAME_STALE_AFTER = float(os.getenv("USERNAME_STALE_AFTER", "604800"))
+# Кэш Telegram file_id по пути медиафайла (путь уникален, file_id для него не меняется)
+MEDIA_CACHE_SIZE = int(os.getenv("MEDIA_CACHE_SIZE", "100000"))
+# Как часто сверять счётчики непросмотренных лайков с таблицей likes (сек)
+UNSEEN_LIKES_RECONCILE_INTERVAL = int(os.getenv("UNSEEN_LIKES_RECONCILE_INTERVAL", "3600"))
+# Сколько строк user_stats сверка блокирует за одну транзакцию
+UNSEEN_LIKES_RECONCILE_BATCH = int(os.getenv("UNSEEN_LIKES_RECONCILE_BATCH", "1000"))
+# Готовые рекомендации из build_recommendations.py: показывать их раньше случайной выборки по ступеням
+RECOMMENDATIONS_ENABLED = os.getenv("RECOMMENDATIONS_ENABLED", "1").lower() in ("1", "true", "yes")
+
+
+def _connect():
     return psycopg2.connect(
         dbname=DB_NAME,
         user=DB_USER,
@@ -25,6 +89,200 @@ def get_connection():
     )
 
 
+class ConnectionPool:
+    """Потокобезопасный пул соединений с ожиданием при исчерпании и проверкой соединений при выдаче."""
+
+    def __init__(self, minconn: int, maxconn: int, timeout: float, ping_interval: float):
+        self.minconn = max(0, minconn)
+        self.maxconn = max(1, maxconn, self.minconn)
+        self.timeout = timeout
+        self.ping_interval = ping_interval
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(self.maxconn)
+        self._idle = []  # [(conn, время возврата в пул)]
+        self._closed = False
+        self.stats = {
+            "checkouts": 0,
+            "created": 0,
+            "discarded": 0,
+            "exhausted": 0,
+            "timeouts": 0,
+            "wait_total": 0.0,
+            "wait_max": 0.0,
+        }
+        for _ in range(self.minconn):
+            self._idle.append((self._new_conn(), time.monotonic()))
+
+    def _new_conn(self):
+        conn = _connect()
+        with self._lock:
+            self.stats["created"] += 1
+        return conn
+
+    def _healthy(self, conn, idle_for: float) -> bool:
+        if conn.closed:
+            return False
+        if conn.get_transaction_status() == extensions.TRANSACTION_STATUS_UNKNOWN:
+            return False
+        if idle_for < self.ping_interval:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def _discard(self, conn):
+        with self._lock:
+            self.stats["discarded"] += 1
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def getconn(self):
+        if self._closed:
+            raise PoolError("connection pool is closed")
+        started = time.monotonic()
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.stats["exhausted"] += 1
+            if not self._slots.acquire(timeout=self.timeout):
+                with self._lock:
+                    self.stats["timeouts"] += 1
+                raise PoolError("connection pool exhausted")
+        waited = time.monotonic() - started
+        with self._lock:
+            self.stats["checkouts"] += 1
+            self.stats["wait_total"] += waited
+            self.stats["wait_max"] = max(self.stats["wait_max"], waited)
+        try:
+            while True:
+                with self._lock:
+                    item = self._idle.pop() if self._idle else None
+                if item is None:
+                    return self._new_conn()
+                conn, returned_at = item
+                if self._healthy(conn, time.monotonic() - returned_at):
+                    return conn
+                self._discard(conn)
+        except Exception:
+            self._slots.release()
+            raise
+
+    def putconn(self, conn):
+        try:
+            keep = not self._closed and not conn.closed
+            if keep and conn.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+                # незакоммиченная транзакция не должна утечь к следующему пользователю
+                conn.rollback()
+        except Exception:
+            keep = False
+        if keep:
+            with self._lock:
+                self._idle.append((conn, time.monotonic()))
+        else:
+            self._discard(conn)
+        self._slots.release()
+
+    def closeall(self):
+        self._closed = True
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            data = dict(self.stats)
+            data["idle"] = len(self._idle)
+        data["wait_avg"] = data["wait_total"] / data["checkouts"] if data["checkouts"] else 0.0
+        return data
+
+
+class _PooledConnection:
+    """Обёртка над соединением из пула: close() возвращает соединение в пул, а не закрывает его."""
+
+    __slots__ = ("_conn", "_pool")
+
+    def __init__(self, conn, pool: ConnectionPool):
+        self._conn = conn
+        self._pool = pool
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def close(self):
+        conn, self._conn = self._conn, None
+        if conn is not None:
+            self._pool.putconn(conn)
+
+    def __del__(self):
+        # страховка для мест, где close() не вызван из-за исключения
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> ConnectionPool:
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(DB_POOL_MIN, DB_POOL_MAX, DB_POOL_TIMEOUT, DB_POOL_PING_INTERVAL)
+                logger.info("Пул соединений создан: min=%s max=%s", DB_POOL_MIN, DB_POOL_MAX)
+    return _pool
+
+
+def get_connection():
+    """Соединение из общего пула. Вызов close() возвращает его в пул."""
+    pool = get_pool()
+    return _PooledConnection(pool.getconn(), pool)
+
+
+def get_pool_stats() -> dict:
+    """Счётчики пула: число выдач, ожидание (сек), исчерпания и таймауты."""
+    return get_pool().snapshot() if _pool is not None else {}
+
+
+def close_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool = None
+
+
+# Перенос likes_inbox в likes: входящие без ребра добавляются, seen берётся из inbox
+# (рёбра, которых во входящих не было, считаются просмотренными), mutual — по встречному ребру
+_LIKES_INBOX_MERGE_SQL = (
+    """
+    INSERT INTO likes (from_user, to_user, created_at, seen)
+    SELECT from_user, to_user, created_at, COALESCE(seen, FALSE) FROM likes_inbox
+    ON CONFLICT (from_user, to_user) DO NOTHING
+    """,
+    """
+    UPDATE likes l SET seen = COALESCE(
+        (SELECT i.seen FROM likes_inbox i WHERE i.to_user = l.to_user AND i.from_user = l.from_user), TRUE)
+    """,
+    """
+    UPDATE likes l SET mutual = TRUE
+    WHERE EXISTS (SELECT 1 FROM likes r WHERE r.from_user = l.to_user AND r.to_user = l.from_user)
+    """,
+    "DROP TABLE likes_inbox",
+)
+
+
 def init_db():
     conn = get_connection()
     cur = conn.cursor()
@@ -57,7 +315,8 @@ def init_db():
                 last_active_at TIMESTAMP DEFAULT NOW(),
                 age_min_preference INT,
                 age_max_preference INT,
-                city_filter_enabled BOOLEAN DEFAULT TRUE
+                city_filter_enabled BOOLEAN DEFAULT TRUE,
+                rand_key DOUBLE PRECISION NOT NULL DEFAULT random()
             );
             """
         )
@@ -75,7 +334,8 @@ def init_db():
             """
         )
 
-        # Таблица симпатий (лайков)
+        # Таблица симпатий (лайков). Одна строка на ребро: seen — получатель уже видел лайк во входящих,
+        # mutual — есть встречный лайк (выставляется у обоих рёбер)
         cur.execute(
             """
             CREATE TABLE IF NOT EXISTS likes (
@@ -83,24 +343,25 @@ def init_db():
                 from_user BIGINT NOT NULL,
                 to_user BIGINT NOT NULL,
                 created_at TIMESTAMP DEFAULT NOW(),
+                seen BOOLEAN NOT NULL DEFAULT FALSE,
+                mutual BOOLEAN NOT NULL DEFAULT FALSE,
                 UNIQUE (from_user, to_user)
             );
             """
         )
-
-        # Входящие симпатии (очередь на просмотр)
-        cur.execute(
-            """
-            CREATE TABLE IF NOT EXISTS likes_inbox (
-                id SERIAL PRIMARY KEY,
-                to_user BIGINT NOT NULL,
-                from_user BIGINT NOT NULL,
-                created_at TIMESTAMP DEFAULT NOW(),
-                seen BOOLEAN DEFAULT FALSE,
-                UNIQUE (to_user, from_user)
-            );
-            """
-        )
+        cur.execute("ALTER TABLE likes ADD COLUMN IF NOT EXISTS seen BOOLEAN NOT NULL DEFAULT FALSE;")
+        cur.execute("ALTER TABLE likes ADD COLUMN IF NOT EXISTS mutual BOOLEAN NOT NULL DEFAULT FALSE;")
+        # Входящие: все лайки пользователю и очередь непросмотренных
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_likes_to_user_created ON likes(to_user, created_at);")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_likes_inbox_unseen ON likes(to_user, created_at) WHERE seen = FALSE;")
+
+        # Раньше входящие хранились отдельной таблицей likes_inbox — переносим флаги seen и удаляем её
+        # (то же делает миграция 0008)
+        cur.execute("SELECT to_regclass('likes_inbox') IS NOT NULL AS legacy")
+        if cur.fetchone()["legacy"]:
+            for sql in _LIKES_INBOX_MERGE_SQL:
+                cur.execute(sql)
+            logger.info("likes_inbox объединена с likes")
 
         # История просмотров (для админ-панели)
         cur.execute(
@@ -138,6 +399,7 @@ def init_db():
         cur.execute("CREATE INDEX IF NOT EXISTS idx_complaints_reporter_id ON complaints(reporter_id);")
         cur.execute("CREATE INDEX IF NOT EXISTS idx_views_viewer_id ON views(viewer_id);")
         cur.execute("CREATE INDEX IF NOT EXISTS idx_views_viewed_id ON views(viewed_id);")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_views_viewer_created ON views(viewer_id, created_at);")
 
         # Миграции для уже существующей БД (добавление недостающих колонок)
         cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS normalized_city TEXT;")
@@ -149,6 +411,135 @@ def init_db():
         cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS age_max_preference INT;")
         cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS city_filter_enabled BOOLEAN DEFAULT TRUE;")
         cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS vip_until TIMESTAMP;")
+        cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS rand_key DOUBLE PRECISION NOT NULL DEFAULT random();")
+        cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS interests_mask INTEGER NOT NULL DEFAULT 0;")
+        # @username из Telegram и когда он был получен (кэш, чтобы не вызывать get_chat при показе)
+        cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS username TEXT;")
+        cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS username_refreshed_at TIMESTAMP;")
+        # Индексы для случайной выборки по rand_key (MATCH_SAMPLING=indexed)
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_users_rand_key ON users(rand_key) WHERE blocked = FALSE;")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_users_rand_key_vip ON users(rand_key) WHERE blocked = FALSE AND vip = TRUE;")
+        # Составные частичные индексы под ступени поиска (только незаблокированные анкеты)
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_users_match_city ON users(normalized_city, gender, age) WHERE blocked = FALSE;")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_users_match_gender_age ON users(gender, age) WHERE blocked = FALSE;")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_users_match_age ON users(age) WHERE blocked = FALSE;")
+
+        # Рекомендации, рассчитанные офлайн (build_recommendations.py)
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS recommendations (
+                user_id BIGINT NOT NULL,
+                position SMALLINT NOT NULL,
+                candidate_id BIGINT NOT NULL,
+                score REAL NOT NULL,
+                created_at TIMESTAMP DEFAULT NOW(),
+                PRIMARY KEY (user_id, position)
+            );
+            """
+        )
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_recommendations_candidate ON recommendations(candidate_id);")
+
+        # Счётчики полученных лайков и просмотров: увеличиваются в add_like и при записи views,
+        # а не пересчитываются агрегатами. Отдельная узкая таблица, чтобы частые инкременты не раздували users.
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS user_stats (
+                telegram_id BIGINT PRIMARY KEY,
+                likes_received INTEGER NOT NULL DEFAULT 0,
+                views_received INTEGER NOT NULL DEFAULT 0,
+                desirability REAL GENERATED ALWAYS AS ((likes_received + 1)::real / (views_received + 10)) STORED,
+                unseen_likes INTEGER NOT NULL DEFAULT 0
+            );
+            """
+        )
+        # Непросмотренные входящие лайки: +1 в add_like, -1 в mark_inbox_seen, сверка reconcile_unseen_likes
+        cur.execute("ALTER TABLE user_stats ADD COLUMN IF NOT EXISTS unseen_likes INTEGER NOT NULL DEFAULT 0;")
+
+        # Время последнего изменения полей анкеты, от которых зависят рекомендации
+        # (для инкрементального пересчёта). last_active_at, daily_views и т.п. его не трогают.
+        cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP DEFAULT NOW();")
+        cur.execute(
+            """
+            CREATE OR REPLACE FUNCTION users_touch_updated_at() RETURNS trigger AS $$
+            BEGIN
+                NEW.updated_at := NOW();
+                RETURN NEW;
+            END
+            $$ LANGUAGE plpgsql;
+            """
+        )
+        cur.execute(
+            """
+            CREATE OR REPLACE TRIGGER trg_users_updated_at
+            BEFORE UPDATE OF age, gender, gender_interest, normalized_city, interests_mask, vip, blocked,
+                age_min_preference, age_max_preference, city_filter_enabled
+            ON users FOR EACH ROW EXECUTE FUNCTION users_touch_updated_at();
+            """
+        )
+
+        # Telegram file_id для загруженных фото и видео: повторная отправка по file_id
+        # вместо загрузки файла из user_media/. Локальный файл остаётся запасным вариантом.
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS media (
+                path TEXT PRIMARY KEY,
+                telegram_id BIGINT NOT NULL,
+                kind TEXT NOT NULL,
+                file_id TEXT,
+                file_unique_id TEXT,
+                created_at TIMESTAMP DEFAULT NOW()
+            );
+            """
+        )
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_media_telegram_id ON media(telegram_id);")
+        # Путь в хранилище по содержимому (utils.content_path), куда файл переехал после скачивания
+        cur.execute("ALTER TABLE media ADD COLUMN IF NOT EXISTS stored_path TEXT;")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_media_stored_path ON media(stored_path);")
+
+        # Файлы, хранящиеся по sha256 содержимого: одинаковые фото лежат на диске один раз.
+        # refcount — сколько раз путь встречается в users.photos/videos, ведёт триггер ниже.
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS media_blobs (
+                hash TEXT PRIMARY KEY,
+                path TEXT NOT NULL UNIQUE,
+                size BIGINT NOT NULL,
+                refcount INTEGER NOT NULL DEFAULT 0,
+                touched_at TIMESTAMP DEFAULT NOW()
+            );
+            """
+        )
+        cur.execute(
+            "CREATE INDEX IF NOT EXISTS idx_media_blobs_unreferenced ON media_blobs(touched_at) WHERE refcount <= 0;"
+        )
+        cur.execute(
+            """
+            CREATE OR REPLACE FUNCTION users_media_refcount() RETURNS trigger AS $$
+            BEGIN
+                IF TG_OP <> 'INSERT' THEN
+                    UPDATE media_blobs b SET refcount = b.refcount - d.n
+                    FROM (SELECT p, COUNT(*) AS n FROM unnest(OLD.photos || OLD.videos) AS p GROUP BY p) d
+                    WHERE b.path = d.p;
+                END IF;
+                IF TG_OP <> 'DELETE' THEN
+                    UPDATE media_blobs b SET refcount = b.refcount + d.n
+                    FROM (SELECT p, COUNT(*) AS n FROM unnest(NEW.photos || NEW.videos) AS p GROUP BY p) d
+                    WHERE b.path = d.p;
+                END IF;
+                RETURN NULL;
+            END
+            $$ LANGUAGE plpgsql;
+            """
+        )
+        cur.execute(
+            """
+            CREATE OR REPLACE TRIGGER trg_users_media_refcount
+            AFTER INSERT OR DELETE OR UPDATE OF photos, videos
+            ON users FOR EACH ROW EXECUTE FUNCTION users_media_refcount();
+            """
+        )
+        # Поиск анкет с общими фото (одинаковый путь = одинаковое содержимое)
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_users_media ON users USING GIN ((photos || videos));")
 
         # Глобальные настройки приложения
         cur.execute(
@@ -172,14 +563,92 @@ def init_db():
 
 # --- CRUD и сервисные функции ---
 
+_PROFILE_COLUMNS = (
+    "id", "telegram_id", "name", "age", "city", "normalized_city", "gender", "bio",
+    "gender_interest", "interests", "interests_mask", "photos", "videos", "smoking", "drinking", "relationship",
+    "vip", "vip_until", "blocked", "created_at",
+    "age_min_preference", "age_max_preference", "city_filter_enabled",
+)
+_PROFILE_ARRAYS = ("interests", "photos", "videos")
+
+
+class Profile:
+    """Компактная неизменяемая запись анкеты для кэша. Поддерживает чтение как словарь
+    (profile["name"], profile.get("bio")), поэтому подходит везде, где раньше была строка RealDictCursor."""
+
+    __slots__ = _PROFILE_COLUMNS
+
+    def __init__(self, row):
+        for col in _PROFILE_COLUMNS:
+            value = row.get(col)
+            if col in _PROFILE_ARRAYS:
+                value = tuple(value or ())
+            object.__setattr__(self, col, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Profile is read-only")
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def __contains__(self, key) -> bool:
+        return key in _PROFILE_COLUMNS
+
+    def get(self, key, default=None):
+        return getattr(self, key, default) if key in _PROFILE_COLUMNS else default
+
+    def keys(self):
+        return _PROFILE_COLUMNS
+
+
+_profile_cache = VersionedLRUCache(PROFILE_CACHE_SIZE, PROFILE_CACHE_TTL)
+_PROFILE_SELECT = "SELECT " + ", ".join(_PROFILE_COLUMNS) + " FROM users"
+
+
+_user_change_listeners = []
+
+
+def add_user_change_listener(fn):
+    """fn(telegram_id) вызывается после каждой записи в users (регистрация, город, возраст, блокировка, VIP...)."""
+    _user_change_listeners.append(fn)
+
+
+def _invalidate_profile(telegram_id: int):
+    _profile_cache.invalidate(telegram_id)
+    # VIP и прочие поля могли поменяться — лимит пересчитает try_consume_view
+    _view_limit_cache.pop(telegram_id)
+    for fn in _user_change_listeners:
+        try:
+            fn(telegram_id)
+        except Exception:
+            logger.exception("Ошибка обработчика изменения анкеты %s", telegram_id)
+
+
 def get_user(telegram_id: int):
+    cached = _profile_cache.get(telegram_id)
+    if cached is not None:
+        return cached
+    version = _profile_cache.version(telegram_id)
     conn = get_connection()
     try:
         with conn.cursor() as cur:
-            cur.execute("SELECT * FROM users WHERE telegram_id=%s", (telegram_id,))
-            return cur.fetchone()
+            cur.execute(_PROFILE_SELECT + " WHERE telegram_id=%s", (telegram_id,))
+            row = cur.fetchone()
     finally:
         conn.close()
+    if not row:
+        return None
+    profile = Profile(row)
+    _profile_cache.set(telegram_id, profile, version)
+    return profile
+
+
+def get_profile_cache_stats() -> dict:
+    """Счётчики кэша анкет: попадания, промахи, вытеснения, инвалидации."""
+    return _profile_cache.snapshot()
 
 
 def add_user(
@@ -200,15 +669,18 @@ def add_user(
             cur.execute(
                 """
                 INSERT INTO users (
-                    telegram_id, name, age, city, gender, gender_interest, interests, smoking, drinking, relationship
-                ) VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)
+                    telegram_id, name, age, city, normalized_city, gender, gender_interest, interests, interests_mask,
+                    smoking, drinking, relationship
+                ) VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)
                 ON CONFLICT (telegram_id) DO UPDATE SET
                     name=EXCLUDED.name,
                     age=EXCLUDED.age,
                     city=EXCLUDED.city,
+                    normalized_city=EXCLUDED.normalized_city,
                     gender=EXCLUDED.gender,
                     gender_interest=EXCLUDED.gender_interest,
                     interests=EXCLUDED.interests,
+                    interests_mask=EXCLUDED.interests_mask,
                     smoking=EXCLUDED.smoking,
                     drinking=EXCLUDED.drinking,
                     relationship=EXCLUDED.relationship
@@ -218,45 +690,94 @@ def add_user(
                     name,
                     age,
                     city,
+                    normalize_city_str(city),
                     gender,
                     gender_interest,
                     interests,
+                    interests_to_mask(interests),
                     smoking,
                     drinking,
                     relationship,
                 ),
             )
         conn.commit()
+        _invalidate_profile(telegram_id)
         logger.info("User upserted: %s", telegram_id)
     finally:
         conn.close()
 
 
-def update_user_photos(telegram_id: int, photos: list):
+# Пути, уже переехавшие в хранилище по содержимому, заменяются на итоговые (media.stored_path).
+# Файлы хранилища, строки которых в media_blobs уже нет (их удалил сборщик мусора), в анкету не попадают.
+_RESOLVE_MEDIA_SQL = """
+    ARRAY(SELECT r.p FROM (
+              SELECT COALESCE(m.stored_path, a.p) AS p, a.i FROM unnest(%s::text[]) WITH ORDINALITY AS a(p, i)
+              LEFT JOIN media m ON m.path = a.p
+          ) r
+          WHERE EXISTS (SELECT 1 FROM media_blobs b WHERE b.path = r.p)
+             OR NOT EXISTS (SELECT 1 FROM media s WHERE s.stored_path = r.p)
+          ORDER BY r.i)
+"""
+
+
+# Файлы, которые сейчас попадут в анкету, блокируются до коммита: пока анкета заполнялась,
+# ссылок на них из users не было, и сборщик мусора мог считать их ничьими. Он пропускает
+# заблокированные строки, а если уже удаляет файл — запрос дождётся его коммита и строки не увидит.
+_LOCK_MEDIA_BLOBS_SQL = """
+    SELECT b.hash FROM media_blobs b
+    WHERE b.path IN (SELECT COALESCE(m.stored_path, a.p) FROM unnest(%s::text[]) AS a(p) LEFT JOIN media m ON m.path = a.p)
+    ORDER BY b.hash
+    FOR SHARE OF b
+"""
+
+
+def _store_user_media(telegram_id: int, column: str, paths: list) -> list:
     conn = get_connection()
     try:
         with conn.cursor() as cur:
-            cur.execute("UPDATE users SET photos=%s WHERE telegram_id=%s", (photos, telegram_id))
+            cur.execute(_LOCK_MEDIA_BLOBS_SQL, (paths,))
+            cur.execute(
+                f"UPDATE users SET {column}={_RESOLVE_MEDIA_SQL} WHERE telegram_id=%s RETURNING {column}",
+                (paths, telegram_id),
+            )
+            row = cur.fetchone()
         conn.commit()
-        logger.info("Updated photos for %s: %d items", telegram_id, len(photos or []))
     finally:
         conn.close()
+    _invalidate_profile(telegram_id)
+    stored = row[column] if row else []
+    if row and len(stored) < len(paths):
+        logger.warning("%s у %s: %d файлов уже удалены сборщиком мусора и убраны из анкеты", column, telegram_id, len(paths) - len(stored))
+    return stored
+
+
+def update_user_photos(telegram_id: int, photos: list):
+    stored = _store_user_media(telegram_id, "photos", photos or [])
+    logger.info("Updated photos for %s: %d items", telegram_id, len(stored))
 
 
 def update_user_videos(telegram_id: int, videos: list):
+    stored = _store_user_media(telegram_id, "videos", videos or [])
+    logger.info("Updated videos for %s: %d items", telegram_id, len(stored))
+
+
+_blocked_cache = LRUCache(BLOCKED_CACHE_SIZE, BLOCKED_CACHE_TTL)
+
+
+def is_blocked(telegram_id: int) -> bool:
+    cached = _blocked_cache.get(telegram_id)
+    if cached is not None:
+        return cached
     conn = get_connection()
     try:
         with conn.cursor() as cur:
-            cur.execute("UPDATE users SET videos=%s WHERE telegram_id=%s", (videos, telegram_id))
-        conn.commit()
-        logger.info("Updated videos for %s: %d items", telegram_id, len(videos or []))
+            cur.execute("SELECT blocked FROM users WHERE telegram_id=%s", (telegram_id,))
+            row = cur.fetchone()
     finally:
         conn.close()
-
-
-def is_blocked(telegram_id: int) -> bool:
-    user = get_user(telegram_id)
-    return bool(user and user.get("blocked"))
+    blocked = bool(row and row.get("blocked"))
+    _blocked_cache.set(telegram_id, blocked)
+    return blocked
 
 
 def set_vip(telegram_id: int, vip: bool):
@@ -265,6 +786,7 @@ def set_vip(telegram_id: int, vip: bool):
         with conn.cursor() as cur:
             cur.execute("UPDATE users SET vip=%s WHERE telegram_id=%s", (vip, telegram_id))
         conn.commit()
+        _invalidate_profile(telegram_id)
         logger.info("Set VIP=%s for %s", vip, telegram_id)
     finally:
         conn.close()
@@ -276,6 +798,7 @@ def set_vip_until(telegram_id: int, until_dt: datetime):
         with conn.cursor() as cur:
             cur.execute("UPDATE users SET vip_until=%s, vip=TRUE WHERE telegram_id=%s", (until_dt, telegram_id))
         conn.commit()
+        _invalidate_profile(telegram_id)
         logger.info("Set VIP until %s for %s", until_dt, telegram_id)
     finally:
         conn.close()
@@ -332,236 +855,886 @@ def set_blocked(telegram_id: int, blocked: bool):
         with conn.cursor() as cur:
             cur.execute("UPDATE users SET blocked=%s WHERE telegram_id=%s", (blocked, telegram_id))
         conn.commit()
+        _invalidate_profile(telegram_id)
+        _blocked_cache.set(telegram_id, bool(blocked))
         logger.info("Set BLOCKED=%s for %s", blocked, telegram_id)
     finally:
         conn.close()
 
 
-def reset_daily_views_if_needed(telegram_id: int):
+def _bump_stats(cur, counts: dict, column: str):
+    # Инкремент счётчиков user_stats; ключи по порядку, чтобы параллельные пачки не ловили deadlock
+    execute_values(
+        cur,
+        f"""
+        INSERT INTO user_stats (telegram_id, {column}) VALUES %s
+        ON CONFLICT (telegram_id) DO UPDATE SET {column} = user_stats.{column} + EXCLUDED.{column}
+        """,
+        sorted(counts.items()),
+    )
+
+
+def _write_views(rows: list):
     conn = get_connection()
     try:
         with conn.cursor() as cur:
-            cur.execute("SELECT daily_views, last_view, vip FROM users WHERE telegram_id=%s", (telegram_id,))
-            row = cur.fetchone()
-            if not row:
-                return
-            if row["vip"]:
-                return
-            today = date.today()
-            if row["last_view"] is None or row["last_view"] < today:
-                cur.execute(
-                    "UPDATE users SET daily_views=0, last_view=%s WHERE telegram_id=%s",
-                    (today, telegram_id),
+            # время просмотра — часы БД (с ними сравнивается окно SEEN_WINDOW_DAYS), а не часы бота
+            execute_values(
+                cur,
+                "INSERT INTO views (viewer_id, viewed_id, created_at) VALUES %s",
+                rows,
+                template="(%s, %s, NOW())",
+                page_size=len(rows),
+            )
+            _bump_stats(cur, Counter(viewed_id for _, viewed_id in rows), "views_received")
+        conn.commit()
+    finally:
+        conn.close()
+
+
+_views_buffer = WriteBehindBuffer("views", _write_views, VIEWS_BUFFER_MAX, VIEWS_FLUSH_SIZE, VIEWS_FLUSH_INTERVAL)
+
+
+def record_view(viewer_id: int, viewed_id: int):
+    """Ставит просмотр в очередь на запись. Таблица views читается только админкой,
+    поэтому строки пишутся пачками в фоне, а не отдельным INSERT на каждый свайп."""
+    mark_seen(viewer_id, viewed_id)
+    _views_buffer.put((viewer_id, viewed_id))
+
+
+def flush_views():
+    _views_buffer.flush()
+
+
+def get_views_buffer_stats() -> dict:
+    """Счётчики буфера просмотров, в т.ч. dropped — сколько событий отброшено из-за переполнения."""
+    return _views_buffer.snapshot()
+
+
+def close_write_buffers():
+    """Дописать отложенные данные при остановке бота."""
+    _views_buffer.close()
+    _activity.close()
+    _usernames.close()
+
+
+# telegram_id -> дата, на которую try_consume_view отказал по лимиту
+_view_limit_cache = LRUCache(BLOCKED_CACHE_SIZE, VIEW_LIMIT_CACHE_TTL)
+
+
+def view_limit_reached(viewer_id: int) -> bool:
+    """Дневной лимит уже исчерпан по последнему отказу try_consume_view (без запроса к БД).
+    False не гарантирует, что просмотр разрешён, — окончательно решает try_consume_view."""
+    return _view_limit_cache.get(viewer_id) == date.today() and not is_limits_disabled()
+
+
+def try_consume_view(viewer_id: int, viewed_id: int, max_per_day: int = 10) -> dict:
+    """Атомарно списывает один просмотр из дневного лимита и пишет его в историю.
+
+    Одним запросом: сброс счётчика при новом дне, проверка глобального отключения лимитов,
+    VIP и vip_until и инкремент daily_views; сам просмотр уходит в буфер record_view. Возвращает
+    {"allowed": bool, "remaining": int | None (None — без лимита), "vip": bool}.
+    Два быстрых нажатия не пройдут лимит оба: UPDATE перепроверяет условие под блокировкой строки.
+    """
+    conn = get_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                WITH me AS (
+                    SELECT
+                        telegram_id,
+                        COALESCE(vip, FALSE) AS vip,
+                        COALESCE(vip, FALSE)
+                            OR COALESCE(vip_until > NOW(), FALSE)
+                            OR %(limits_disabled)s AS unlimited
+                    FROM users WHERE telegram_id = %(viewer)s
+                ),
+                upd AS (
+                    UPDATE users u SET
+                        daily_views = CASE WHEN u.last_view IS NULL OR u.last_view < CURRENT_DATE
+                                           THEN 1 ELSE COALESCE(u.daily_views, 0) + 1 END,
+                        last_view = CURRENT_DATE
+                    FROM me
+                    WHERE u.telegram_id = me.telegram_id
+                      AND (
+                        me.unlimited
+                        OR CASE WHEN u.last_view IS NULL OR u.last_view < CURRENT_DATE
+                                THEN 0 ELSE COALESCE(u.daily_views, 0) END < %(max)s
+                      )
+                    RETURNING u.daily_views
                 )
+                SELECT
+                    EXISTS (SELECT 1 FROM upd) AS allowed,
+                    (SELECT daily_views FROM upd) AS used,
+                    COALESCE((SELECT unlimited FROM me), FALSE) AS unlimited,
+                    COALESCE((SELECT vip FROM me), FALSE) AS vip
+                """,
+                {"viewer": viewer_id, "max": max_per_day, "limits_disabled": is_limits_disabled()},
+            )
+            row = cur.fetchone()
         conn.commit()
     finally:
         conn.close()
+    allowed = bool(row["allowed"])
+    if allowed:
+        record_view(viewer_id, viewed_id)
+    else:
+        _view_limit_cache.set(viewer_id, date.today())
+    if row["unlimited"]:
+        remaining = None
+    else:
+        remaining = max(0, max_per_day - (row["used"] or max_per_day)) if allowed else 0
+    return {"allowed": allowed, "remaining": remaining, "vip": bool(row["vip"])}
+
+
+def _search_params(current_user_id: int):
+    """Предпочтения ищущего пользователя в виде параметров запроса или None, если анкеты нет.
+    Читаются из кэша анкет, поэтому обычно не требуют обращения к БД."""
+    me = get_user(current_user_id)
+    if not me or me.get("blocked"):
+        return None
+    # normalized_city заполняется при каждой записи города и backfill_city.py;
+    # для ещё не обработанной строки нормализуем в памяти, без UPDATE в поисковой транзакции
+    my_norm_city = me.get("normalized_city") or normalize_city_str(me.get("city"))
+
+    # Возрастной коридор по умолчанию: возраст ±3, но не младше 18
+    my_age = me.get("age") or 18
+    min_age = me.get("age_min_preference") or max(18, my_age - 3)
+    max_age = me.get("age_max_preference") or (my_age + 3)
+    city_enabled = bool(me.get("city_filter_enabled") if me.get("city_filter_enabled") is not None else True)
+
+    # Фильтр по полу искомого партнёра
+    gi = (me.get("gender_interest") or "Без разницы")
+    gender_filter = None
+    if gi.startswith("Парни"):
+        gender_filter = "Парень"
+    elif gi.startswith("Девушки"):
+        gender_filter = "Девушка"
+
+    return {
+        "me": current_user_id,
+        "min_age": min_age,
+        "max_age": max_age,
+        "norm_city": my_norm_city or None,
+        "gender": gender_filter,
+        "city_enabled": city_enabled,
+        "mask": me.get("interests_mask") or 0,
+    }
+
+
+def _search_tiers(params: dict) -> list:
+    """Ступени поиска (от самой строгой к самой мягкой): пары (имя ступени, условие WHERE)."""
+    base = ["telegram_id <> %(me)s", "blocked = FALSE"]
+    if params["gender"]:
+        base.append("gender = %(gender)s")
+    age = ["age BETWEEN %(min_age)s AND %(max_age)s"]
+    tiers = []
+    # 1) тот же город + возрастной фильтр
+    if params["city_enabled"] and params["norm_city"]:
+        tiers.append(("city", base + age + ["normalized_city = %(norm_city)s"]))
+    # 2) другие города + возрастной фильтр
+    tiers.append(("age", base + age))
+    # 3) любой подходящий пользователь без возрастного фильтра как последний шанс
+    tiers.append(("any", list(base)))
+    return [(name, " AND ".join(t)) for name, t in tiers]
+
+
+def _indexed_sample_sql(where: str, columns: str, limit: int) -> str:
+    # Случайная точка на оси rand_key: берём ближайших кандидатов справа от неё,
+    # а если справа не хватает — с начала оси. VIP по-прежнему идут первыми.
+    # Каждая ветка — короткий проход по индексу rand_key, без сортировки всей выборки.
+    branches = []
+    for order, (vip_cond, key_cond) in enumerate([
+        ("vip = TRUE", "rand_key >= %(rnd)s"),
+        ("vip = TRUE", "rand_key < %(rnd)s"),
+        ("vip IS NOT TRUE", "rand_key >= %(rnd)s"),
+        ("vip IS NOT TRUE", "rand_key < %(rnd)s"),
+    ]):
+        branches.append(
+            f"(SELECT {columns}, {order} AS _branch FROM users "
+            f"WHERE {where} AND {vip_cond} AND {key_cond} ORDER BY rand_key LIMIT {int(limit)})"
+        )
+    return "SELECT * FROM (" + " UNION ALL ".join(branches) + f") s ORDER BY _branch, rand_key LIMIT {int(limit)}"
+
 
+def _random_sample_sql(where: str, columns: str, limit: int) -> str:
+    return f"SELECT {columns} FROM users WHERE {where} ORDER BY vip DESC, RANDOM() LIMIT {int(limit)}"
 
-def can_increment_view(telegram_id: int, max_per_day: int = 10) -> bool:
-    # Если глобально отключены ограничения — всегда можно
-    if is_limits_disabled():
+
+def _ranked_sql(sample_sql: str, params: dict) -> str:
+    # Отобранную случайную пачку упорядочиваем в том же запросе: VIP первыми, затем по числу
+    # общих интересов (popcount пересечения масок), затем по привлекательности из user_stats.
+    # Сортируется и соединяется по первичному ключу только сама пачка, а не вся ступень.
+    overlap = "bit_count((c.interests_mask & %(mask)s)::bit(32)) DESC, " if params.get("mask") else ""
+    return (
+        f"SELECT c.telegram_id FROM ({sample_sql}) c "
+        "LEFT JOIN user_stats st ON st.telegram_id = c.telegram_id "
+        f"ORDER BY c.vip IS TRUE DESC, {overlap}COALESCE(st.desirability, {DESIRABILITY_PRIOR}) DESC"
+    )
+
+
+def _batch_random(cur, where: str, params: dict, limit: int) -> list:
+    cur.execute(_ranked_sql(_random_sample_sql(where, "telegram_id, vip, interests_mask", limit), params), params)
+    return [r["telegram_id"] for r in cur.fetchall()]
+
+
+def _batch_indexed(cur, where: str, params: dict, limit: int) -> list:
+    sql = _indexed_sample_sql(where, "telegram_id, rand_key, vip, interests_mask", limit)
+    cur.execute(_ranked_sql(sql, params), dict(params, rnd=random.random()))
+    return [r["telegram_id"] for r in cur.fetchall()]
+
+
+_SAMPLERS = {
+    "random": _batch_random,
+    "indexed": _batch_indexed,
+}
+
+# Построители SQL тех же стратегий (для EXPLAIN в check_match_plans.py)
+SAMPLE_SQL = {
+    "random": _random_sample_sql,
+    "indexed": _indexed_sample_sql,
+}
+
+
+def _load_seen_ids(cur, viewer_id: int) -> list:
+    cur.execute(
+        """
+        SELECT viewed_id FROM views
+        WHERE viewer_id=%s AND created_at >= NOW() - make_interval(days => %s)
+        ORDER BY created_at DESC LIMIT %s
+        """,
+        (viewer_id, SEEN_WINDOW_DAYS, SEEN_MAX_ENTRIES),
+    )
+    return [r["viewed_id"] for r in cur.fetchall()]
+
+
+class _LazyCursor:
+    """Курсор, который берёт соединение из пула только при первом запросе:
+    при выборке из памяти (MATCH_SAMPLING=memory) поиск может вовсе не обращаться к БД."""
+
+    def __init__(self):
+        self._conn = None
+        self._cur = None
+
+    def execute(self, *args):
+        if self._cur is None:
+            self._conn = get_connection()
+            self._cur = self._conn.cursor()
+        return self._cur.execute(*args)
+
+    def fetchone(self):
+        return self._cur.fetchone()
+
+    def commit(self):
+        if self._conn is not None:
+            self._conn.commit()
+
+    def fetchall(self):
+        return self._cur.fetchall()
+
+    def close(self):
+        if self._conn is not None:
+            self._cur.close()
+            self._conn.close()
+
+
+_match_engine = None
+
+
+def set_match_engine(engine):
+    """Подключить движок выборки в памяти (matching.MatchEngine) для MATCH_SAMPLING=memory."""
+    global _match_engine
+    _match_engine = engine
+
+
+def _tier_matches(tier: str, params: dict, row: dict) -> bool:
+    # Условие ступени _search_tiers для уже прочитанной анкеты (пол и блокировка проверены при чтении)
+    if tier == "any":
         return True
-    reset_daily_views_if_needed(telegram_id)
+    age = row["age"]
+    if age is None or not params["min_age"] <= age <= params["max_age"]:
+        return False
+    return tier != "city" or row["normalized_city"] == params["norm_city"]
+
+
+def _candidate_ids(cur, params: dict, limit: int, recommended: list = ()) -> list:
+    # Рекомендации (строки _load_recommendations) идут первыми, но только в своей ступени:
+    # анкета из другого города не обгонит непросмотренных кандидатов из своего.
+    # Берём первую ступень, где есть непросмотренные анкеты. Кандидатов выбираем с запасом
+    # и отсеиваем просмотренные по фильтру в памяти, без NOT IN по таблице views.
+    # Если в выборке все уже просмотрены, ступень перевыбирается до SEEN_RESAMPLE_ATTEMPTS раз
+    # (выборка случайная) — иначе активных пользователей уводило бы в другие города и возрасты,
+    # пока в своём городе ещё есть непросмотренные анкеты.
+    # Если непросмотренных нет нигде — показываем уже виденные из первой непустой ступени.
+    engine = _match_engine if MATCH_SAMPLING == "memory" and _match_engine is not None and _match_engine.ready else None
+    # пока движок в памяти не построен, выбираем по индексу rand_key
+    batch = _SAMPLERS.get(MATCH_SAMPLING, _batch_indexed if MATCH_SAMPLING == "memory" else _batch_random)
+    seen = None
+    if SEEN_WINDOW_DAYS > 0:
+        seen = get_seen_filter(params["me"], lambda: _load_seen_ids(cur, params["me"]))
+    fetch = limit * SEEN_OVERFETCH if seen is not None else limit
+    fallback = []
+    for tier, where in _search_tiers(params):
+        recs = [
+            r["candidate_id"] for r in recommended
+            if _tier_matches(tier, params, r) and (seen is None or r["candidate_id"] not in seen)
+        ]
+        if len(recs) >= limit:
+            return recs[:limit]
+        fresh = list(recs)
+        for _ in range(max(1, SEEN_RESAMPLE_ATTEMPTS)):
+            if engine is not None:
+                ids = engine.sample(params, tier, fetch)
+            else:
+                ids = batch(cur, where, params, fetch)
+            if not ids:
+                break
+            if seen is None:
+                return (fresh + [i for i in ids if i not in fresh])[:limit]
+            if not fallback:
+                fallback = ids[:limit]
+            fresh += [i for i in ids if i not in seen and i not in fresh]
+            # неполная выборка — в ступени меньше анкет, чем запрошено: перевыбор ничего нового не даст
+            if len(fresh) > len(recs) or len(ids) < fetch:
+                break
+        if fresh:
+            return fresh[:limit]
+    return fallback
+
+
+def get_candidate_ids_for_user(current_user_id: int, limit: int) -> list:
+    """Пачка telegram_id кандидатов для поиска. Ступени (_search_tiers) идут от строгой к мягкой:
+    тот же город и возрастной фильтр (если фильтр по городу включён), затем любой город с возрастным
+    фильтром, затем любой незаблокированный пользователь подходящего пола. Берётся первая ступень
+    с непросмотренными анкетами, VIP идут первыми; готовые рекомендации этой ступени — раньше
+    случайной выборки. Выданные рекомендации удаляются."""
+    params = _search_params(current_user_id)
+    if not params:
+        return []
+    cur = _LazyCursor()
+    try:
+        recommended = _load_recommendations(cur, params) if RECOMMENDATIONS_ENABLED else []
+        ids = _candidate_ids(cur, params, limit, recommended)
+        served = [i for i in ids if i in {r["candidate_id"] for r in recommended}]
+        if served:
+            # выданная рекомендация больше не повторяется (в том числе при SEEN_WINDOW_DAYS=0)
+            cur.execute(
+                "DELETE FROM recommendations WHERE user_id = %s AND candidate_id = ANY(%s)",
+                (params["me"], served),
+            )
+            cur.commit()
+        return ids
+    finally:
+        cur.close()
+
+
+def _load_recommendations(cur, params: dict) -> list:
+    # Рекомендации могли устареть с прошлого запуска: блокировку и фильтр пола перепроверяем при чтении,
+    # возраст и город — по ступеням в _candidate_ids, просмотренные отсеиваются там же
+    cur.execute(
+        """
+        SELECT r.candidate_id, u.age, u.normalized_city FROM recommendations r
+        JOIN users u ON u.telegram_id = r.candidate_id
+        WHERE r.user_id = %(me)s AND u.blocked = FALSE
+          AND (%(gender)s::text IS NULL OR u.gender = %(gender)s)
+        ORDER BY r.position
+        """,
+        params,
+    )
+    return cur.fetchall()
+
+
+def store_recommendations(user_ids: list, rows: list):
+    """Заменить рекомендации пользователей user_ids строками (user_id, position, candidate_id, score)."""
     conn = get_connection()
     try:
         with conn.cursor() as cur:
-            cur.execute("SELECT vip, vip_until, daily_views FROM users WHERE telegram_id=%s", (telegram_id,))
-            row = cur.fetchone()
-            if not row:
-                return False
-            # Активный VIP — либо флаг vip, либо vip_until в будущем
-            if row["vip"]:
-                return True
-            if row.get("vip_until") is not None:
-                try:
-                    # сравнение по времени в БД
-                    cur.execute("SELECT NOW() < %s AS active", (row["vip_until"],))
-                    active = cur.fetchone()["active"]
-                    if active:
-                        return True
-                except Exception:
-                    pass
-            return (row["daily_views"] or 0) < max_per_day
+            cur.execute("DELETE FROM recommendations WHERE user_id = ANY(%s)", (list(user_ids),))
+            if rows:
+                execute_values(
+                    cur,
+                    "INSERT INTO recommendations (user_id, position, candidate_id, score) VALUES %s",
+                    rows,
+                    page_size=1000,
+                )
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def load_match_entries(telegram_id: int = None) -> list:
+    """Поля, по которым строится индекс движка выборки в памяти: все незаблокированные анкеты
+    или одна анкета (пустой список, если её нет или она заблокирована)."""
+    conn = get_connection()
+    try:
+        with conn.cursor() as cur:
+            sql = (
+                "SELECT u.telegram_id, u.gender, u.city, u.normalized_city, u.age, COALESCE(u.vip, FALSE) AS vip, "
+                f"u.interests_mask, COALESCE(st.desirability, {DESIRABILITY_PRIOR}) AS desirability "
+                "FROM users u LEFT JOIN user_stats st ON st.telegram_id = u.telegram_id WHERE u.blocked = FALSE"
+            )
+            if telegram_id is None:
+                cur.execute(sql)
+            else:
+                cur.execute(sql + " AND u.telegram_id=%s", (telegram_id,))
+            rows = cur.fetchall()
+    finally:
+        conn.close()
+    for row in rows:
+        if not row["normalized_city"]:
+            row["normalized_city"] = normalize_city_str(row["city"]) or None
+    return rows
+
+
+def reshuffle_random_keys(batch_size: int = 5000) -> int:
+    """Перемешивает rand_key пачками по id, чтобы выборка не залипала на одних и тех же анкетах."""
+    conn = get_connection()
+    updated = 0
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT COALESCE(MAX(id), 0) AS max_id FROM users")
+            max_id = cur.fetchone()["max_id"]
+            for lo in range(0, max_id + 1, batch_size):
+                cur.execute(
+                    "UPDATE users SET rand_key = random() WHERE id >= %s AND id < %s",
+                    (lo, lo + batch_size),
+                )
+                updated += cur.rowcount
+                conn.commit()
+        logger.info("Reshuffled rand_key for %d users", updated)
+        return updated
     finally:
         conn.close()
 
+# --- Вспомогательные функции настроек и нормализации ---
+
+def normalize_city_str(s: str) -> str:
+    if not s:
+        return None
+    s = s.strip().lower()
+    # простая нормализация: ё->е, множественные пробелы
+    s = s.replace("ё", "е")
+    s = " ".join(s.split())
+    return s
 
-def increment_view(telegram_id: int):
+def _write_last_active(dirty: dict):
+    # Время берём из БД, как и DEFAULT NOW() у колонки: часы и часовой пояс хоста бота могут отличаться.
+    # Отметка запаздывает не больше чем на ACTIVITY_FLUSH_INTERVAL.
+    ids = sorted(dirty)
     conn = get_connection()
     try:
         with conn.cursor() as cur:
             cur.execute(
-                "UPDATE users SET daily_views = COALESCE(daily_views,0) + 1, last_view = %s WHERE telegram_id=%s",
-                (date.today(), telegram_id),
+                "UPDATE users SET last_active_at = NOW() WHERE telegram_id = ANY(%s::bigint[])",
+                (ids,),
             )
         conn.commit()
     finally:
         conn.close()
 
 
-def record_view(viewer_id: int, viewed_id: int):
+_activity = CoalescingTracker("last_active", _write_last_active, ACTIVITY_FLUSH_INTERVAL)
+
+
+def touch_last_active(telegram_id: int):
+    # Запоминаем в памяти, в БД уходит одним UPDATE раз в ACTIVITY_FLUSH_INTERVAL
+    _activity.mark(telegram_id, True)
+
+
+def _write_usernames(dirty: dict):
+    ids = sorted(dirty)
     conn = get_connection()
     try:
         with conn.cursor() as cur:
             cur.execute(
-                "INSERT INTO views (viewer_id, viewed_id) VALUES (%s,%s)",
-                (viewer_id, viewed_id),
+                """
+                UPDATE users u SET username = NULLIF(v.username, ''), username_refreshed_at = NOW()
+                FROM unnest(%s::bigint[], %s::text[]) AS v(telegram_id, username)
+                WHERE u.telegram_id = v.telegram_id
+                """,
+                (ids, [dirty[i] for i in ids]),
             )
         conn.commit()
     finally:
         conn.close()
 
 
-def get_next_profile_for_user(current_user_id: int):
-    """Выдаёт следующий профиль с учётом возрастных и городских фильтров сFallback."""
+# telegram_id -> (username или "" если его нет, когда он был получен от Telegram — по time.monotonic()).
+# В БД username_refreshed_at пишется по часам БД; при чтении он переводится в возраст, посчитанный там же,
+# поэтому часы и часовой пояс хоста бота ни с чем не сравниваются.
+_username_cache = LRUCache(USERNAME_CACHE_SIZE, USERNAME_CACHE_TTL)
+_usernames = CoalescingTracker("usernames", _write_usernames, ACTIVITY_FLUSH_INTERVAL)
+_username_refresher = None
+
+
+def set_username_refresher(fn):
+    """fn(telegram_id) ставит username в очередь фонового обновления через get_chat (usernames.UsernameRefresher)."""
+    global _username_refresher
+    _username_refresher = fn
+
+
+def remember_username(telegram_id: int, username):
+    """Запомнить @username, пришедший от Telegram (None — у пользователя его нет).
+    В users.username пишется пачкой, только если значение изменилось или пора обновить username_refreshed_at.
+    В кэше хранится время username_refreshed_at из БД, а не время последнего апдейта, — иначе запись
+    у активного пользователя никогда не выглядела бы устаревшей."""
+    username = username or ""
+    cached = _username_cache.get(telegram_id)
+    if cached is None:
+        cached = _load_usernames([telegram_id]).get(telegram_id)
+    now = time.monotonic()
+    if cached is not None and cached[0] == username and now - cached[1] <= USERNAME_STALE_AFTER / 2:
+        _username_cache.set(telegram_id, cached)
+        return
+    _username_cache.set(telegram_id, (username, now))
+    _usernames.mark(telegram_id, username)
+
+
+def _load_usernames(telegram_ids: list) -> dict:
+    # telegram_id -> (username или "", username_refreshed_at по time.monotonic()) для анкет, где username уже получали
     conn = get_connection()
     try:
         with conn.cursor() as cur:
-            # Получим предпочтения текущего пользователя
             cur.execute(
                 """
-                SELECT age, city, normalized_city, age_min_preference, age_max_preference, city_filter_enabled, gender_interest
-                FROM users WHERE telegram_id=%s AND blocked=FALSE
+                SELECT telegram_id, username, EXTRACT(EPOCH FROM NOW() - username_refreshed_at) AS age
+                FROM users WHERE telegram_id = ANY(%s) AND username_refreshed_at IS NOT NULL
                 """,
-                (current_user_id,),
-            )
-            me = cur.fetchone()
-            if not me:
-                return None
-            # Нормализуем город пользователя при необходимости
-            my_norm_city = me.get("normalized_city")
-            if not my_norm_city and me.get("city"):
-                my_norm_city = normalize_city_str(me.get("city"))
-                cur.execute("UPDATE users SET normalized_city=%s WHERE telegram_id=%s", (my_norm_city, current_user_id))
-
-            # Возрастной коридор по умолчанию: возраст ±3, но не младше 18
-            my_age = me.get("age") or 18
-            min_age = me.get("age_min_preference") or max(18, my_age - 3)
-            max_age = me.get("age_max_preference") or (my_age + 3)
-            city_enabled = bool(me.get("city_filter_enabled") if me.get("city_filter_enabled") is not None else True)
-
-            # Фильтр по полу искомого партнёра
-            gi = (me.get("gender_interest") or "Без разницы")
-            gender_filter = None
-            if gi.startswith("Парни"):
-                gender_filter = "Парень"
-            elif gi.startswith("Девушки"):
-                gender_filter = "Девушка"
-
-            params = {
-                "me": current_user_id,
-                "min_age": min_age,
-                "max_age": max_age,
-                "norm_city": my_norm_city or None,
-                "gender": gender_filter,
-            }
-
-            # 1) тот же город + возрастной фильтр
-            if city_enabled and my_norm_city:
-                if gender_filter:
-                    cur.execute(
-                        """
-                        SELECT * FROM users
-                        WHERE telegram_id <> %(me)s
-                          AND blocked = FALSE
-                          AND age BETWEEN %(min_age)s AND %(max_age)s
-                          AND COALESCE(normalized_city, LOWER(city)) = %(norm_city)s
-                          AND gender = %(gender)s
-                        ORDER BY vip DESC, RANDOM() LIMIT 1
-                        """,
-                        params,
-                    )
-                else:
-                    cur.execute(
-                        """
-                        SELECT * FROM users
-                        WHERE telegram_id <> %(me)s
-                          AND blocked = FALSE
-                          AND age BETWEEN %(min_age)s AND %(max_age)s
-                          AND COALESCE(normalized_city, LOWER(city)) = %(norm_city)s
-                        ORDER BY vip DESC, RANDOM() LIMIT 1
-                        """,
-                        params,
-                    )
-                row = cur.fetchone()
-                if row:
-                    return row
-
-            # 2) другие города + возрастной фильтр
-            if gender_filter:
-                cur.execute(
-                    """
-                    SELECT * FROM users
-                    WHERE telegram_id <> %(me)s
-                      AND blocked = FALSE
-                      AND age BETWEEN %(min_age)s AND %(max_age)s
-                      AND gender = %(gender)s
-                    ORDER BY vip DESC, RANDOM() LIMIT 1
-                    """,
-                    params,
-                )
-            else:
+                (list(telegram_ids),),
+            )
+            rows = cur.fetchall()
+    finally:
+        conn.close()
+    now = time.monotonic()
+    return {r["telegram_id"]: (r["username"] or "", now - float(r["age"])) for r in rows}
+
+
+def _request_username_refresh(telegram_id: int):
+    if _username_refresher is not None:
+        _username_refresher(telegram_id)
+
+
+def get_usernames(telegram_ids) -> dict:
+    """username по telegram_id ("" — username нет) из кэша, а для промахов — одним запросом к users.
+    Неизвестные и устаревшие (старше USERNAME_STALE_AFTER) отдаются в фоновое обновление;
+    неизвестных в ответе нет. Сетевых запросов к Telegram здесь не бывает."""
+    now = time.monotonic()
+    found, missing = {}, []
+    for tid in telegram_ids:
+        item = _username_cache.get(tid)
+        if item is None:
+            missing.append(tid)
+            continue
+        found[tid] = item[0]
+        if now - item[1] > USERNAME_STALE_AFTER:
+            _request_username_refresh(tid)
+    if missing:
+        rows = _load_usernames(missing)
+        for tid in missing:
+            item = rows.get(tid)
+            if item is None:
+                _request_username_refresh(tid)
+                continue
+            found[tid] = item[0]
+            _username_cache.set(tid, item)
+            if now - item[1] > USERNAME_STALE_AFTER:
+                _request_username_refresh(tid)
+    return found
+
+
+def get_username(telegram_id: int):
+    """username пользователя, "" если его нет, None если он пока неизвестен."""
+    return get_usernames([telegram_id]).get(telegram_id)
+
+
+# путь медиафайла -> file_id
+_media_cache = LRUCache(MEDIA_CACHE_SIZE)
+
+
+def save_media_file_id(telegram_id: int, path: str, kind: str, file_id: str, file_unique_id: str = None):
+    """Запомнить Telegram file_id для сохранённого фото/видео (kind: 'photo' или 'video')."""
+    save_media_file_ids(telegram_id, [(path, kind, file_id, file_unique_id)])
+
+
+def save_media_file_ids(telegram_id: int, items):
+    """То же для нескольких файлов одним запросом; items — [(path, kind, file_id, file_unique_id)]."""
+    rows = [(path, telegram_id, kind, file_id, file_unique_id) for path, kind, file_id, file_unique_id in items if path and file_id]
+    if not rows:
+        return
+    conn = get_connection()
+    try:
+        with conn.cursor() as cur:
+            execute_values(
+                cur,
+                """
+                INSERT INTO media (path, telegram_id, kind, file_id, file_unique_id) VALUES %s
+                ON CONFLICT (path) DO UPDATE SET file_id = EXCLUDED.file_id, file_unique_id = EXCLUDED.file_unique_id
+                """,
+                rows,
+            )
+        conn.commit()
+    finally:
+        conn.close()
+    for path, _, _, file_id, _ in rows:
+        _media_cache.set(path, file_id)
+
+
+def get_media_file_ids(paths) -> dict:
+    """file_id по путям медиафайлов (исходным или в хранилище по содержимому): из кэша,
+    а для промахов — одним запросом к media. Пути без сохранённого file_id в ответ не попадают."""
+    found, missing = {}, []
+    for path in paths:
+        file_id = _media_cache.get(path)
+        if file_id is None:
+            missing.append(path)
+        else:
+            found[path] = file_id
+    if missing:
+        conn = get_connection()
+        try:
+            with conn.cursor() as cur:
                 cur.execute(
                     """
-                    SELECT * FROM users
-                    WHERE telegram_id <> %(me)s
-                      AND blocked = FALSE
-                      AND age BETWEEN %(min_age)s AND %(max_age)s
-                    ORDER BY vip DESC, RANDOM() LIMIT 1
+                    SELECT path, stored_path, file_id FROM media
+                    WHERE (path = ANY(%(p)s) OR stored_path = ANY(%(p)s)) AND file_id IS NOT NULL
                     """,
-                    params,
+                    {"p": missing},
                 )
-            row = cur.fetchone()
-            if row:
-                return row
+                rows = cur.fetchall()
+        finally:
+            conn.close()
+        wanted = set(missing)
+        for row in rows:
+            for key in (row["path"], row["stored_path"]):
+                if key in wanted:
+                    found[key] = row["file_id"]
+                    _media_cache.set(key, row["file_id"])
+    return found
+
+
+def forget_media_file_ids(paths):
+    """Сбросить file_id, который Telegram больше не принимает: следующая отправка пойдёт из локального файла."""
+    paths = list(paths)
+    if not paths:
+        return
+    for path in paths:
+        _media_cache.pop(path)
+    conn = get_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                "UPDATE media SET file_id = NULL, file_unique_id = NULL WHERE path = ANY(%(p)s) OR stored_path = ANY(%(p)s)",
+                {"p": paths},
+            )
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def remove_user_media(telegram_id: int, path: str):
+    """Убрать файл из photos/videos пользователя и из media одной транзакцией (файл не удалось скачать)."""
+    conn = get_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                UPDATE users SET photos = array_remove(photos, %(path)s), videos = array_remove(videos, %(path)s)
+                WHERE telegram_id = %(tid)s AND %(path)s = ANY(photos || videos)
+                """,
+                {"tid": telegram_id, "path": path},
+            )
+            cur.execute("DELETE FROM media WHERE path=%s", (path,))
+        conn.commit()
+    finally:
+        conn.close()
+    _media_cache.pop(path)
+    _invalidate_profile(telegram_id)
+
+
+# Первый ключ advisory-блокировки файла хранилища (второй — hashtext(hash)): её берут
+# register_media_blob и удаление файла с диска в collect_media_garbage
+_MEDIA_BLOB_LOCK = 25
+
+
+def register_media_blob(digest: str, path: str, size: int):
+    """Отметить файл в хранилище по содержимому (новый или уже существующий).
+    touched_at обновляется, чтобы сборщик не удалил файл, пока на него ещё не сослалась анкета.
+    Если сборщик как раз удаляет этот файл, запрос ждёт, пока тот удалит строку и сам файл, и создаёт
+    строку заново — поэтому наличие файла проверяется только после этого вызова."""
+    conn = get_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_advisory_xact_lock(%s, hashtext(%s))", (_MEDIA_BLOB_LOCK, digest))
+            cur.execute(
+                """
+                INSERT INTO media_blobs (hash, path, size) VALUES (%s, %s, %s)
+                ON CONFLICT (hash) DO UPDATE SET touched_at = NOW()
+                """,
+                (digest, path, size),
+            )
+        conn.commit()
+    finally:
+        conn.close()
+
 
-            # 3) любой подходящий пользователь без возрастного фильтра как последний шанс
-            if gender_filter:
+def resolve_media_path(telegram_id: int, path: str, stored_path: str):
+    """Файл path скачан и лежит в хранилище как stored_path: записать это в media и заменить
+    путь в photos/videos пользователя одной транзакцией (refcount обновит триггер)."""
+    conn = get_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("UPDATE media SET stored_path=%s WHERE path=%s", (stored_path, path))
+            cur.execute(
+                """
+                UPDATE users SET photos = array_replace(photos, %(path)s, %(stored)s),
+                                 videos = array_replace(videos, %(path)s, %(stored)s)
+                WHERE telegram_id = %(tid)s AND %(path)s = ANY(photos || videos)
+                """,
+                {"tid": telegram_id, "path": path, "stored": stored_path},
+            )
+            changed = cur.rowcount
+        conn.commit()
+    finally:
+        conn.close()
+    if changed:
+        _invalidate_profile(telegram_id)
+
+
+def collect_media_garbage(grace_seconds: float, remove_file, limit: int = 1000) -> int:
+    """Удалить файлы хранилища без ссылок из анкет, не трогавшиеся grace_seconds и не загруженные
+    заново за это время. Сначала удаляются строки media_blobs (под блокировкой строк, занятые
+    сохранением анкеты пропускаются), и только после коммита — сами файлы: remove_file(path)
+    вызывается под advisory-блокировкой файла, и только если register_media_blob не создал строку заново.
+    Заодно дописывает итоговые пути в анкеты, сохранённые раньше, чем файл переехал в хранилище.
+    Возвращает число удалённых файлов."""
+    conn = get_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT m.telegram_id, m.path, m.stored_path FROM media m
+                JOIN users u ON u.telegram_id = m.telegram_id
+                WHERE m.stored_path IS NOT NULL AND m.created_at > NOW() - make_interval(secs => %s)
+                  AND m.path = ANY(u.photos || u.videos)
+                """,
+                (grace_seconds * 2,),
+            )
+            stale = cur.fetchall()
+            for row in stale:
                 cur.execute(
                     """
-                    SELECT * FROM users
-                    WHERE telegram_id <> %(me)s
-                      AND blocked = FALSE
-                      AND gender = %(gender)s
-                    ORDER BY vip DESC, RANDOM() LIMIT 1
+                    UPDATE users SET photos = array_replace(photos, %(path)s, %(stored)s),
+                                     videos = array_replace(videos, %(path)s, %(stored)s)
+                    WHERE telegram_id = %(tid)s
                     """,
-                    params,
+                    {"tid": row["telegram_id"], "path": row["path"], "stored": row["stored_path"]},
                 )
-            else:
-                cur.execute(
-                    """
-                    SELECT * FROM users
-                    WHERE telegram_id <> %(me)s
-                      AND blocked = FALSE
-                    ORDER BY vip DESC, RANDOM() LIMIT 1
-                    """,
-                    params,
+            cur.execute(
+                """
+                DELETE FROM media_blobs WHERE hash IN (
+                    SELECT hash FROM media_blobs b
+                    WHERE refcount <= 0 AND touched_at < NOW() - make_interval(secs => %(grace)s)
+                      AND NOT EXISTS (
+                          SELECT 1 FROM media m
+                          WHERE m.stored_path = b.path AND m.created_at > NOW() - make_interval(secs => %(grace)s)
+                      )
+                    ORDER BY touched_at LIMIT %(limit)s
+                    FOR UPDATE SKIP LOCKED
                 )
-            return cur.fetchone()
+                RETURNING hash, path
+                """,
+                {"grace": grace_seconds, "limit": limit},
+            )
+            rows = sorted(cur.fetchall(), key=lambda r: r["hash"])
+        conn.commit()
+        for row in stale:
+            _invalidate_profile(row["telegram_id"])
+        if not rows:
+            return 0
+        # Файлы удаляем только после коммита: при ошибке выше строка media_blobs остаётся вместе с файлом.
+        # Блокировка не даёт register_media_blob того же содержимого проскочить между проверкой и удалением:
+        # если он успел создать строку заново, файл снова нужен и остаётся на диске.
+        with conn.cursor() as cur:
+            for row in rows:
+                cur.execute("SELECT pg_advisory_xact_lock(%s, hashtext(%s))", (_MEDIA_BLOB_LOCK, row["hash"]))
+            cur.execute("SELECT hash FROM media_blobs WHERE hash = ANY(%s)", ([r["hash"] for r in rows],))
+            revived = {r["hash"] for r in cur.fetchall()}
+            removed = 0
+            for row in rows:
+                if row["hash"] not in revived:
+                    remove_file(row["path"])
+                    removed += 1
+        conn.commit()
+        return removed
     finally:
         conn.close()
 
-# --- Вспомогательные функции настроек и нормализации ---
 
-def normalize_city_str(s: str) -> str:
-    if not s:
-        return None
-    s = s.strip().lower()
-    # простая нормализация: ё->е, множественные пробелы
-    s = s.replace("ё", "е")
-    s = " ".join(s.split())
-    return s
+def find_duplicate_media(telegram_id: int, limit: int = 20) -> list:
+    """Другие анкеты с теми же фото/видео (одинаковое содержимое = одинаковый путь в хранилище).
+    Строки: telegram_id, name, blocked, shared — число общих файлов."""
+    conn = get_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT o.telegram_id, o.name, o.blocked,
+                       cardinality(ARRAY(SELECT unnest(o.photos || o.videos)
+                                         INTERSECT SELECT unnest(u.photos || u.videos))) AS shared
+                FROM users u
+                JOIN users o ON (o.photos || o.videos) && (u.photos || u.videos) AND o.telegram_id <> u.telegram_id
+                WHERE u.telegram_id = %s
+                ORDER BY shared DESC, o.telegram_id
+                LIMIT %s
+                """,
+                (telegram_id, limit),
+            )
+            return cur.fetchall()
+    finally:
+        conn.close()
 
-def touch_last_active(telegram_id: int):
+
+def backfill_normalized_city(after_id: int, batch_size: int = 1000):
+    """Заполняет normalized_city для пачки из batch_size строк с id > after_id одной транзакцией.
+    Возвращает (последний обработанный id, число просмотренных строк, число обновлённых)."""
     conn = get_connection()
     try:
         with conn.cursor() as cur:
-            cur.execute("UPDATE users SET last_active_at=NOW() WHERE telegram_id=%s", (telegram_id,))
+            cur.execute(
+                "SELECT id, telegram_id, city, normalized_city FROM users WHERE id > %s ORDER BY id LIMIT %s",
+                (after_id, batch_size),
+            )
+            rows = cur.fetchall()
+            if not rows:
+                return after_id, 0, 0
+            changed = [
+                (r["id"], r["city"], normalize_city_str(r["city"]))
+                for r in rows
+                if r["normalized_city"] != normalize_city_str(r["city"])
+            ]
+            updated = []
+            if changed:
+                # город могли изменить после чтения пачки — такую строку не трогаем,
+                # иначе свежий normalized_city затёрся бы значением старого города
+                cur.execute(
+                    """
+                    UPDATE users u SET normalized_city = v.norm
+                    FROM unnest(%s::int[], %s::text[], %s::text[]) AS v(id, city, norm)
+                    WHERE u.id = v.id AND u.city IS NOT DISTINCT FROM v.city
+                    RETURNING u.telegram_id
+                    """,
+                    ([c[0] for c in changed], [c[1] for c in changed], [c[2] for c in changed]),
+                )
+                updated = [r["telegram_id"] for r in cur.fetchall()]
         conn.commit()
+        for telegram_id in updated:
+            _invalidate_profile(telegram_id)
+        return rows[-1]["id"], len(rows), len(updated)
     finally:
         conn.close()
 
+
 def set_age_preference(telegram_id: int, min_age: int, max_age: int):
     conn = get_connection()
     try:
@@ -571,6 +1744,7 @@ def set_age_preference(telegram_id: int, min_age: int, max_age: int):
                 (min_age, max_age, telegram_id),
             )
         conn.commit()
+        _invalidate_profile(telegram_id)
     finally:
         conn.close()
 
@@ -580,6 +1754,7 @@ def set_city_filter_enabled(telegram_id: int, enabled: bool):
         with conn.cursor() as cur:
             cur.execute("UPDATE users SET city_filter_enabled=%s WHERE telegram_id=%s", (enabled, telegram_id))
         conn.commit()
+        _invalidate_profile(telegram_id)
     finally:
         conn.close()
 
@@ -590,20 +1765,124 @@ def set_user_city(telegram_id: int, city: str):
         with conn.cursor() as cur:
             cur.execute("UPDATE users SET city=%s, normalized_city=%s WHERE telegram_id=%s", (city, norm, telegram_id))
         conn.commit()
+        _invalidate_profile(telegram_id)
     finally:
         conn.close()
 
+_SETTINGS_VERSION_KEY = "_version"
+
+
+class _SettingsCache:
+    """Копия app_settings в памяти. Чтение — поиск в словаре без обращения к БД.
+    Фоновый поток раз в SETTINGS_POLL_INTERVAL сверяет счётчик версии (строка _version),
+    который увеличивает каждый set_app_setting, и перечитывает таблицу при его изменении
+    или по истечении SETTINGS_CACHE_TTL."""
+
+    def __init__(self, poll_interval: float, ttl: float):
+        self.poll_interval = poll_interval
+        self.ttl = ttl
+        self.values = None
+        self.version = None
+        self.loaded_at = 0.0
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def _reload(self):
+        conn = get_connection()
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT key, value FROM app_settings")
+                rows = cur.fetchall()
+        finally:
+            conn.close()
+        values = {r["key"]: r["value"] for r in rows}
+        with self._lock:
+            self.version = values.pop(_SETTINGS_VERSION_KEY, None)
+            self.values = values
+            self.loaded_at = time.monotonic()
+
+    def _current_version(self):
+        conn = get_connection()
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT value FROM app_settings WHERE key=%s", (_SETTINGS_VERSION_KEY,))
+                row = cur.fetchone()
+                return row["value"] if row else None
+        finally:
+            conn.close()
+
+    def _poll(self):
+        while True:
+            time.sleep(self.poll_interval)
+            try:
+                if time.monotonic() - self.loaded_at > self.ttl or self._current_version() != self.version:
+                    self._reload()
+            except Exception:
+                logger.exception("Не удалось обновить кэш настроек")
+
+    def get(self, key: str):
+        if self.values is None:
+            self._reload()
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._poll, name="settings-poller", daemon=True)
+                    self._thread.start()
+        return self.values.get(key)
+
+    def put(self, key: str, value: str):
+        # Своё изменение видно сразу, а версию сбрасываем: следующий опрос перечитает таблицу целиком.
+        # Номер версии из своей записи не присваиваем — он мог скрыть параллельное изменение другого процесса.
+        with self._lock:
+            if self.values is not None:
+                self.values[key] = value
+                self.version = None
+
+
+_settings_cache = _SettingsCache(SETTINGS_POLL_INTERVAL, SETTINGS_CACHE_TTL)
+
+
 def get_app_setting(key: str, default: str = None) -> str:
+    return _settings_cache.get(key) or default
+
+def set_app_setting(key: str, value: str):
+    conn = get_connection()
+    try:
+        with conn.cursor() as cur:
+            # Значение и счётчик версии меняются одним запросом, чтобы другие процессы увидели изменение
+            cur.execute(
+                """
+                WITH s AS (
+                    INSERT INTO app_settings(key,value) VALUES(%s,%s)
+                    ON CONFLICT(key) DO UPDATE SET value=EXCLUDED.value
+                )
+                INSERT INTO app_settings(key,value) VALUES(%s,'1')
+                ON CONFLICT(key) DO UPDATE SET value=(app_settings.value::bigint + 1)::text
+                """,
+                (key, value, _SETTINGS_VERSION_KEY),
+            )
+        conn.commit()
+    finally:
+        conn.close()
+    _settings_cache.put(key, value)
+
+
+def get_checkpoint(key: str, default: str = None) -> str:
+    """Позиция служебного скрипта (backfill_city.py, build_recommendations.py) из app_settings —
+    напрямую из БД, мимо кэша настроек."""
     conn = get_connection()
     try:
         with conn.cursor() as cur:
             cur.execute("SELECT value FROM app_settings WHERE key=%s", (key,))
             row = cur.fetchone()
-            return (row and row.get("value")) or default
+            return row["value"] if row else default
     finally:
         conn.close()
 
-def set_app_setting(key: str, value: str):
+
+def set_checkpoint(key: str, value: str):
+    """Сохранить позицию служебного скрипта. В отличие от set_app_setting не увеличивает версию
+    настроек: частые записи контрольной точки не заставляют все процессы бота перечитывать настройки."""
     conn = get_connection()
     try:
         with conn.cursor() as cur:
@@ -620,43 +1899,81 @@ def is_limits_disabled() -> bool:
     return str(v).lower() in ("1", "true", "yes")
 
 
-def add_like(from_user: int, to_user: int) -> bool:
-    """Возвращает True, если получилась взаимная симпатия."""
+def add_like(from_user: int, to_user: int) -> tuple:
+    """Ставит лайк одной транзакцией. Возвращает (inserted, mutual, unseen_count):
+    inserted — лайк новый (а не повторный), mutual — есть встречный лайк,
+    unseen_count — сколько непросмотренных лайков теперь во входящих у получателя."""
     conn = get_connection()
     try:
         with conn.cursor() as cur:
-            try:
-                cur.execute("INSERT INTO likes (from_user, to_user) VALUES (%s,%s)", (from_user, to_user))
-            except Exception:
-                # дубликат — игнорируем
-                pass
-            # Добавим запись во входящие для получателя лайка (если ещё нет)
-            try:
-                cur.execute(
-                    "INSERT INTO likes_inbox (to_user, from_user) VALUES (%s,%s) ON CONFLICT (to_user, from_user) DO NOTHING",
-                    (to_user, from_user),
+            # Встречные лайки одной пары выполняются по очереди: без блокировки два одновременных
+            # лайка не видят незакоммиченных строк друг друга и оба сохраняются с mutual = FALSE.
+            # Снимок следующего запроса берётся уже после того, как встречная транзакция закоммичена.
+            cur.execute(
+                "SELECT pg_advisory_xact_lock(hashint8(LEAST(%(a)s, %(b)s)::bigint), hashint8(GREATEST(%(a)s, %(b)s)::bigint))",
+                {"a": from_user, "b": to_user},
+            )
+            # Одним запросом: ребро (дубликат игнорируется), флаг mutual у обоих рёбер
+            # и счётчик лайков получателя — только для новой записи
+            cur.execute(
+                """
+                WITH back AS (
+                    SELECT id FROM likes WHERE from_user = %(to)s AND to_user = %(from)s
+                ), ins AS (
+                    INSERT INTO likes (from_user, to_user, mutual)
+                    VALUES (%(from)s, %(to)s, EXISTS (SELECT 1 FROM back))
+                    ON CONFLICT (from_user, to_user) DO NOTHING
+                    RETURNING id
+                ), upd AS (
+                    UPDATE likes SET mutual = TRUE
+                    WHERE id IN (SELECT id FROM back) AND EXISTS (SELECT 1 FROM ins)
+                ), stats AS (
+                    INSERT INTO user_stats (telegram_id, likes_received, unseen_likes)
+                    SELECT %(to)s, 1, 1 FROM ins
+                    ON CONFLICT (telegram_id) DO UPDATE SET
+                        likes_received = user_stats.likes_received + 1,
+                        unseen_likes = user_stats.unseen_likes + 1
+                    RETURNING unseen_likes
                 )
-            except Exception:
-                pass
-            cur.execute("SELECT 1 FROM likes WHERE from_user=%s AND to_user=%s", (to_user, from_user))
-            mutual = cur.fetchone() is not None
+                SELECT EXISTS (SELECT 1 FROM ins) AS inserted,
+                       EXISTS (SELECT 1 FROM back) AS mutual,
+                       COALESCE(
+                           (SELECT unseen_likes FROM stats),
+                           (SELECT unseen_likes FROM user_stats WHERE telegram_id = %(to)s),
+                           0
+                       ) AS unseen
+                """,
+                {"from": from_user, "to": to_user},
+            )
+            row = cur.fetchone()
         conn.commit()
+        inserted, mutual, unseen = row["inserted"], row["mutual"], int(row["unseen"])
         if mutual:
             logger.info("Mutual like between %s and %s", from_user, to_user)
         else:
             logger.info("Like from %s to %s", from_user, to_user)
-        return mutual
+        return inserted, mutual, unseen
     finally:
         conn.close()
 
 
-def get_new_likes(telegram_id: int) -> list:
+def get_likes_page(telegram_id: int, before=None, limit: int = 10) -> list:
+    """Страница входящих лайков от новых к старым вместе с именами отправителей — один запрос.
+    before — (created_at, from_user) последней строки предыдущей страницы (keyset-пагинация)."""
     conn = get_connection()
     try:
         with conn.cursor() as cur:
+            ts, from_user = before if before else (None, None)
             cur.execute(
-                "SELECT from_user, created_at FROM likes WHERE to_user=%s ORDER BY created_at DESC LIMIT 50",
-                (telegram_id,),
+                """
+                SELECT l.from_user, l.created_at, u.name
+                FROM likes l LEFT JOIN users u ON u.telegram_id = l.from_user
+                WHERE l.to_user = %(me)s
+                  AND (%(ts)s::timestamp IS NULL OR (l.created_at, l.from_user) < (%(ts)s::timestamp, %(from_user)s))
+                ORDER BY l.created_at DESC, l.from_user DESC
+                LIMIT %(limit)s
+                """,
+                {"me": telegram_id, "ts": ts, "from_user": from_user, "limit": limit},
             )
             return cur.fetchall()
     finally:
@@ -669,7 +1986,7 @@ def get_unseen_likes(telegram_id: int) -> list:
     try:
         with conn.cursor() as cur:
             cur.execute(
-                "SELECT from_user, created_at FROM likes_inbox WHERE to_user=%s AND seen=FALSE ORDER BY created_at ASC",
+                "SELECT from_user, created_at FROM likes WHERE to_user=%s AND seen=FALSE ORDER BY created_at ASC",
                 (telegram_id,),
             )
             return cur.fetchall()
@@ -682,21 +1999,71 @@ def mark_inbox_seen(to_user: int, from_user: int):
     try:
         with conn.cursor() as cur:
             cur.execute(
-                "UPDATE likes_inbox SET seen=TRUE WHERE to_user=%s AND from_user=%s",
-                (to_user, from_user),
+                """
+                WITH s AS (
+                    UPDATE likes SET seen=TRUE WHERE to_user=%(to)s AND from_user=%(from)s AND seen=FALSE
+                    RETURNING to_user
+                )
+                UPDATE user_stats SET unseen_likes = GREATEST(unseen_likes - 1, 0)
+                WHERE telegram_id = %(to)s AND EXISTS (SELECT 1 FROM s)
+                """,
+                {"to": to_user, "from": from_user},
             )
         conn.commit()
     finally:
         conn.close()
 
 
-def count_unseen_likes(telegram_id: int) -> int:
+def reconcile_unseen_likes() -> int:
+    """Сверяет счётчики unseen_likes с таблицей likes (поправляет расхождения после сбоев и гонок).
+    Возвращает число исправленных строк."""
     conn = get_connection()
     try:
+        fixed = 0
         with conn.cursor() as cur:
-            cur.execute("SELECT COUNT(*) AS c FROM likes_inbox WHERE to_user=%s AND seen=FALSE", (telegram_id,))
-            row = cur.fetchone()
-            return int(row["c"]) if row else 0
+            # Строки для получателей, у которых есть лайки, но ещё нет счётчика
+            cur.execute(
+                """
+                INSERT INTO user_stats (telegram_id)
+                SELECT DISTINCT to_user FROM likes WHERE seen = FALSE
+                ON CONFLICT (telegram_id) DO NOTHING
+                """
+            )
+            conn.commit()
+            last_id = 0
+            while True:
+                # Сначала блокируем строки счётчиков — те же, что меняют add_like и mark_inbox_seen,
+                # и только потом считаем: снимок UPDATE берётся после коммита транзакций, державших
+                # блокировку, поэтому их лайк учтён ровно один раз, а не затёрт старым подсчётом.
+                cur.execute(
+                    """
+                    SELECT telegram_id FROM user_stats WHERE telegram_id > %s
+                    ORDER BY telegram_id LIMIT %s FOR UPDATE
+                    """,
+                    (last_id, UNSEEN_LIKES_RECONCILE_BATCH),
+                )
+                ids = [r["telegram_id"] for r in cur.fetchall()]
+                if not ids:
+                    break
+                cur.execute(
+                    """
+                    UPDATE user_stats st SET unseen_likes = COALESCE(d.n, 0)
+                    FROM unnest(%(ids)s::bigint[]) AS b(telegram_id)
+                    LEFT JOIN (
+                        SELECT to_user, COUNT(*) AS n FROM likes
+                        WHERE seen = FALSE AND to_user = ANY(%(ids)s::bigint[])
+                        GROUP BY to_user
+                    ) d ON d.to_user = b.telegram_id
+                    WHERE st.telegram_id = b.telegram_id AND st.unseen_likes <> COALESCE(d.n, 0)
+                    """,
+                    {"ids": ids},
+                )
+                fixed += cur.rowcount
+                conn.commit()
+                last_id = ids[-1]
+        if fixed:
+            logger.info("Исправлено счётчиков непросмотренных лайков: %s", fixed)
+        return fixed
     finally:
         conn.close()
 
@@ -777,8 +2144,15 @@ def update_user_field(telegram_id: int, field: str, value):
     conn = get_connection()
     try:
         with conn.cursor() as cur:
-            cur.execute(f"UPDATE users SET {field}=%s WHERE telegram_id=%s", (value, telegram_id))
+            if field == "city":
+                cur.execute(
+                    "UPDATE users SET city=%s, normalized_city=%s WHERE telegram_id=%s",
+                    (value, normalize_city_str(value), telegram_id),
+                )
+            else:
+                cur.execute(f"UPDATE users SET {field}=%s WHERE telegram_id=%s", (value, telegram_id))
         conn.commit()
+        _invalidate_profile(telegram_id)
         logger.info("Updated %s for %s", field, telegram_id)
     finally:
         conn.close()
@@ -788,8 +2162,12 @@ def update_user_interests(telegram_id: int, interests: list):
     conn = get_connection()
     try:
         with conn.cursor() as cur:
-            cur.execute("UPDATE users SET interests=%s WHERE telegram_id=%s", (interests, telegram_id))
+            cur.execute(
+                "UPDATE users SET interests=%s, interests_mask=%s WHERE telegram_id=%s",
+                (interests, interests_to_mask(interests), telegram_id),
+            )
         conn.commit()
+        _invalidate_profile(telegram_id)
         logger.info("Updated interests for %s: %d items", telegram_id, len(interests or []))
     finally:
         conn.close()
@@ -799,13 +2177,29 @@ def delete_user(telegram_id: int):
     conn = get_connection()
     try:
         with conn.cursor() as cur:
-            # удалить связанные записи
+            # удалить связанные записи; непросмотренные лайки пользователя уходят из счётчиков получателей
+            cur.execute(
+                """
+                UPDATE user_stats st SET unseen_likes = GREATEST(st.unseen_likes - d.n, 0)
+                FROM (SELECT to_user, COUNT(*) AS n FROM likes WHERE from_user=%s AND seen=FALSE GROUP BY to_user) d
+                WHERE st.telegram_id = d.to_user
+                """,
+                (telegram_id,),
+            )
             cur.execute("DELETE FROM likes WHERE from_user=%s OR to_user=%s", (telegram_id, telegram_id))
             cur.execute("DELETE FROM complaints WHERE reporter_id=%s OR reported_id=%s", (telegram_id, telegram_id))
             cur.execute("DELETE FROM views WHERE viewer_id=%s OR viewed_id=%s", (telegram_id, telegram_id))
+            cur.execute("DELETE FROM recommendations WHERE user_id=%s OR candidate_id=%s", (telegram_id, telegram_id))
+            cur.execute("DELETE FROM user_stats WHERE telegram_id=%s", (telegram_id,))
+            cur.execute("DELETE FROM media WHERE telegram_id=%s RETURNING path", (telegram_id,))
+            for row in cur.fetchall():
+                _media_cache.pop(row["path"])
             # очистить пользователя
             cur.execute("DELETE FROM users WHERE telegram_id=%s", (telegram_id,))
         conn.commit()
+        _invalidate_profile(telegram_id)
+        forget_seen(telegram_id)
+        _blocked_cache.pop(telegram_id)
         logger.info("Deleted user %s", telegram_id)
     finally:
         conn.close()
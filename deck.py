@@ -0,0 +1,115 @@
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+from db import get_candidate_ids_for_user, get_user
+
+logger = logging.getLogger(__name__)
+
+# Колода кандидатов: сколько id берём за один запрос, при каком остатке
+# подгружаем следующую пачку в фоне, сколько живёт колода (сек)
+# и для скольких пользователей держим колоды в памяти
+DECK_SIZE = int(os.getenv("DECK_SIZE", "20"))
+DECK_REFILL_AT = int(os.getenv("DECK_REFILL_AT", "5"))
+DECK_TTL = int(os.getenv("DECK_TTL", "600"))
+DECK_MAX_USERS = int(os.getenv("DECK_MAX_USERS", "10000"))
+
+
+class _Deck:
+    __slots__ = ("ids", "created_at", "refilling", "exhausted")
+
+    def __init__(self):
+        self.ids = deque()
+        self.created_at = time.monotonic()
+        self.refilling = False
+        # последняя пачка оказалась неполной — подходящих анкет меньше DECK_SIZE,
+        # фоновая подгрузка ничего нового не даст
+        self.exhausted = False
+
+
+_decks = OrderedDict()
+_lock = threading.Lock()
+_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="deck-refill")
+
+
+def _get_deck(user_id: int) -> _Deck:
+    with _lock:
+        deck = _decks.get(user_id)
+        if deck is None or time.monotonic() - deck.created_at > DECK_TTL:
+            deck = _Deck()
+            _decks[user_id] = deck
+        _decks.move_to_end(user_id)
+        while len(_decks) > DECK_MAX_USERS:
+            _decks.popitem(last=False)
+        return deck
+
+
+def _fill(user_id: int, deck: _Deck):
+    ids = get_candidate_ids_for_user(user_id, DECK_SIZE)
+    with _lock:
+        # колоду могли сбросить, пока шёл запрос, — тогда пачка устарела
+        if _decks.get(user_id) is not deck:
+            return
+        known = set(deck.ids)
+        deck.ids.extend(i for i in ids if i not in known)
+        deck.exhausted = len(ids) < DECK_SIZE
+
+
+def _refill_in_background(user_id: int, deck: _Deck):
+    try:
+        _fill(user_id, deck)
+    except Exception:
+        logger.exception("Не удалось пополнить колоду для %s", user_id)
+    finally:
+        with _lock:
+            deck.refilling = False
+
+
+def next_profile(user_id: int):
+    """Следующая анкета для пользователя из его колоды кандидатов.
+    Поисковый запрос выполняется только при пустой колоде; полная анкета читается по telegram_id."""
+    deck = _get_deck(user_id)
+    for _ in range(DECK_SIZE + 1):
+        with _lock:
+            cid = deck.ids.popleft() if deck.ids else None
+        if cid is None:
+            deck = _get_deck(user_id)
+            _fill(user_id, deck)
+            with _lock:
+                cid = deck.ids.popleft() if deck.ids else None
+            if cid is None:
+                return None
+        with _lock:
+            need_refill = (
+                len(deck.ids) <= DECK_REFILL_AT and not deck.refilling and not deck.exhausted
+            )
+            if need_refill:
+                deck.refilling = True
+        if need_refill:
+            _executor.submit(_refill_in_background, user_id, deck)
+        profile = get_user(cid)
+        # анкету могли удалить или заблокировать после того, как она попала в колоду
+        if profile and not profile.get("blocked"):
+            return profile
+    return None
+
+
+def return_profile(user_id: int, telegram_id: int):
+    """Вернуть анкету в начало колоды (её так и не показали, например из-за лимита просмотров)."""
+    with _lock:
+        deck = _decks.get(user_id)
+        if deck is not None:
+            deck.ids.appendleft(telegram_id)
+
+
+def invalidate_deck(user_id: int):
+    """Сбросить колоду пользователя (после смены фильтров поиска)."""
+    with _lock:
+        _decks.pop(user_id, None)
+
+
+def shutdown():
+    _executor.shutdown(wait=False)
@@ -1,31 +1,40 @@
 import os
 import json
+import logging
 import base64
 import requests
 from datetime import datetime, timedelta
 from telegram import (
     Update, ReplyKeyboardMarkup, InputMediaPhoto, InputMediaVideo, InlineKeyboardMarkup, InlineKeyboardButton
 )
+from telegram.error import BadRequest
 from telegram.ext import CallbackContext
 from db import (
     get_connection,
-    get_next_profile_for_user,
-    can_increment_view,
-    increment_view,
-    record_view,
+    try_consume_view,
+    view_limit_reached,
+    flush_views,
     add_like,
     add_complaint,
-    get_new_likes,
+    get_likes_page,
     get_unseen_likes,
     mark_inbox_seen,
-    count_unseen_likes,
     list_users_for_csv,
     list_complaints,
+    get_user,
     is_blocked as db_is_blocked,
+    set_blocked,
     list_active_user_ids,
     set_app_setting,
     is_limits_disabled,
     touch_last_active,
+    remember_username,
+    get_usernames,
+    get_username,
+    get_media_file_ids,
+    save_media_file_id,
+    forget_media_file_ids,
+    find_duplicate_media,
     create_payment_record,
     update_payment_status,
     set_vip_until,
@@ -38,6 +47,10 @@ from utils import (
     get_vip_inline_keyboard,
 )
 from telegram import LabeledPrice
+from deck import next_profile as deck_next_profile, return_profile as deck_return_profile
+from media_ingest import get_stats as get_media_ingest_stats
+
+logger = logging.getLogger(__name__)
 
 # Папки для хранения медиа
 PHOTO_DIR = "photos"
@@ -52,12 +65,23 @@ ADMIN_IDS = set(_parsed_ids) if _parsed_ids else {825042510}
 # Набор модераторов (можно вынести в БД/настройки). По умолчанию включает всех админов
 MODERATOR_IDS = set(ADMIN_IDS)
 MAX_DAILY_VIEWS = 10
+# Симпатии: строк на странице
+LIKES_PAGE_SIZE = 10
 
 if not os.path.exists(PHOTO_DIR):
     os.mkdir(PHOTO_DIR)
 if not os.path.exists(VIDEO_DIR):
     os.mkdir(VIDEO_DIR)
 
+def track_username(update: Update, context: CallbackContext):
+    # Для каждого входящего апдейта запоминаем @username отправителя (кэш в памяти + users.username)
+    user = update.effective_user
+    if user:
+        try:
+            remember_username(user.id, user.username)
+        except Exception:
+            pass
+
 def start(update: Update, context: CallbackContext):
     if db_is_blocked(update.effective_user.id):
         update.message.reply_text("Ваш аккаунт заблокирован и не может пользоваться ботом.")
@@ -109,12 +133,7 @@ def menu_handler(update: Update, context: CallbackContext):
         except ValueError:
             update.message.reply_text("ID должен быть числом. Повторите выбор через меню.", reply_markup=(get_admin_menu() if is_admin else get_moderator_menu()))
             return
-        conn = get_connection()
-        cur = conn.cursor()
-        cur.execute("UPDATE users SET blocked = TRUE WHERE telegram_id = %s", (target_id,))
-        conn.commit()
-        cur.close()
-        conn.close()
+        set_blocked(target_id, True)
         update.message.reply_text(f"Пользователь {target_id} заблокирован.", reply_markup=(get_admin_menu() if is_admin else get_moderator_menu()))
         return
 
@@ -125,12 +144,7 @@ def menu_handler(update: Update, context: CallbackContext):
         except ValueError:
             update.message.reply_text("ID должен быть числом. Повторите выбор через меню.", reply_markup=(get_admin_menu() if is_admin else get_moderator_menu()))
             return
-        conn = get_connection()
-        cur = conn.cursor()
-        cur.execute("UPDATE users SET blocked = FALSE WHERE telegram_id = %s", (target_id,))
-        conn.commit()
-        cur.close()
-        conn.close()
+        set_blocked(target_id, False)
         update.message.reply_text(f"Пользователь {target_id} разблокирован.", reply_markup=(get_admin_menu() if is_admin else get_moderator_menu()))
         return
 
@@ -200,22 +214,15 @@ def menu_handler(update: Update, context: CallbackContext):
         if not to_user:
             show_next_profile(update, context)
             return
-        mutual = add_like(user_id, to_user)
+        inserted, mutual, cnt = add_like(user_id, to_user)
         if mutual:
-            try:
-                u1 = context.bot.get_chat(user_id); u1n = f"@{u1.username}" if getattr(u1, 'username', None) else str(user_id)
-            except Exception:
-                u1n = str(user_id)
-            try:
-                u2 = context.bot.get_chat(to_user); u2n = f"@{u2.username}" if getattr(u2, 'username', None) else str(to_user)
-            except Exception:
-                u2n = str(to_user)
+            u1n = _contact(user_id, str(user_id))
+            u2n = _contact(to_user, str(to_user))
             context.bot.send_message(chat_id=user_id, text=f"Взаимная симпатия с {u2n}!")
             context.bot.send_message(chat_id=to_user, text=f"Взаимная симпатия с {u1n}!")
-        # уведомление получателю лайка (коротко)
+        # уведомление получателю лайка (коротко); на повторный лайк не шлём
         try:
-            cnt = count_unseen_likes(to_user)
-            if cnt > 0:
+            if inserted and cnt > 0:
                 note = f"Вам поставили симпатии: {cnt}." if cnt > 1 else "Вам поставили симпатию."
                 kb = InlineKeyboardMarkup([[InlineKeyboardButton("Посмотреть", callback_data="see_likes")]])
                 context.bot.send_message(chat_id=to_user, text=note, reply_markup=kb)
@@ -241,15 +248,7 @@ def show_profile(update: Update, context: CallbackContext):
     if db_is_blocked(user_id):
         update.message.reply_text("Ваш аккаунт заблокирован и не может пользоваться ботом.")
         return
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute(
-        "SELECT name, age, city, gender_interest, interests, photos, videos, vip FROM users WHERE telegram_id=%s",
-        (user_id,),
-    )
-    user = cur.fetchone()
-    cur.close()
-    conn.close()
+    user = get_user(user_id)
     if not user:
         update.message.reply_text("Анкета не найдена. Нажмите /start чтобы создать.", reply_markup=get_main_menu())
         return
@@ -273,29 +272,7 @@ def show_profile(update: Update, context: CallbackContext):
         + (f"Описание: {bio}\n" if bio else "") +
         f"VIP: {vip_status}"
     )
-    media = []
-    for p in photos:
-        if p and os.path.exists(p):
-            media.append(InputMediaPhoto(open(p, 'rb')))
-    for v in videos:
-        if v and os.path.exists(v):
-            media.append(InputMediaVideo(open(v, 'rb')))
-    if not media:
-        update.message.reply_text(text)
-    elif len(media) == 1:
-        first = media[0]
-        if isinstance(first, InputMediaPhoto):
-            update.message.reply_photo(photo=first.media, caption=text)
-        else:
-            update.message.reply_video(video=first.media, caption=text)
-    else:
-        # Вставляем текст как caption к первому медиа, чтобы было одно сообщение-группа
-        first = media[0]
-        if isinstance(first, InputMediaPhoto):
-            media[0] = InputMediaPhoto(first.media, caption=text)
-        else:
-            media[0] = InputMediaVideo(first.media, caption=text)
-        update.message.reply_media_group(media)
+    _send_profile_media(context.bot, update.effective_chat.id, user_id, text, photos, videos)
 
     update.message.reply_text("Для жалобы на пользователя используйте кнопку под анкетой во время поиска или команду /complain <telegram_id>.", reply_markup=get_main_menu())
 
@@ -312,11 +289,34 @@ def _profile_inline_kb(profile_telegram_id: int) -> InlineKeyboardMarkup:
     )
 
 
+def _send_view_limit_upsell(update: Update):
+    upsell = (
+        "✨ Твой личный лимит знакомств почти исчерпан! ✨\n"
+        "Сегодня ты просмотрел(а) *10 из 10* доступных анкет.\n"
+        "Хочешь продолжать поиски своей идеальной пары?\n\n"
+        "\n💎 VIP-статус — твой ключ к успешным знакомствам! 💎\n"
+        "🔥 Хочешь выйти за рамки ограничений? 🔥\n"
+        "С VIP ты получаешь:\n"
+        "✅ Безлимитный доступ — смотри анкеты без ограничений в день.\n"
+        "✅ Прямые контакты — видишь @юзернеймы людей и можешь написать им напрямую, не дожидаясь взаимного лайка!\n"
+        "(Работает, если у человека есть юзернейм и он не скрыл его в настройках приватности)\n\n"
+        "🚀 Не упусти возможность знакомиться первым!\n"
+        "Чем раньше ты станешь VIP — тем быстрее найдёшь того, кто тебе по-настоящему подходит.\n"
+        "💬 P.S. Самые интересные люди часто скрываются за анонимностью — но с VIP ты сможешь увидеть их первым!\n"
+        "✨ Активируй VIP сейчас и открой все двери к новым знакомствам! ✨"
+    )
+    (update.message or update.callback_query.message).reply_text(upsell, reply_markup=get_vip_inline_keyboard())
+
+
 def show_next_profile(update: Update, context: CallbackContext):
     user_id = update.effective_user.id
     if db_is_blocked(user_id):
         update.message.reply_text("Ваш аккаунт заблокирован и не может пользоваться ботом.")
         return
+    # лимит уже исчерпан — отказываем, не трогая колоду и БД
+    if view_limit_reached(user_id):
+        _send_view_limit_upsell(update)
+        return
     # Проверим наличие своей анкеты для корректной работы поиска
     conn = get_connection()
     cur = conn.cursor()
@@ -327,133 +327,147 @@ def show_next_profile(update: Update, context: CallbackContext):
     if not has_me:
         update.message.reply_text("Сначала создайте анкету через /start.")
         return
-    if not can_increment_view(user_id):
-        upsell = (
-            "✨ Твой личный лимит знакомств почти исчерпан! ✨\n"
-            "Сегодня ты просмотрел(а) *10 из 10* доступных анкет.\n"
-            "Хочешь продолжать поиски своей идеальной пары?\n\n"
-            "\n💎 VIP-статус — твой ключ к успешным знакомствам! 💎\n"
-            "🔥 Хочешь выйти за рамки ограничений? 🔥\n"
-            "С VIP ты получаешь:\n"
-            "✅ Безлимитный доступ — смотри анкеты без ограничений в день.\n"
-            "✅ Прямые контакты — видишь @юзернеймы людей и можешь написать им напрямую, не дожидаясь взаимного лайка!\n"
-            "(Работает, если у человека есть юзернейм и он не скрыл его в настройках приватности)\n\n"
-            "🚀 Не упусти возможность знакомиться первым!\n"
-            "Чем раньше ты станешь VIP — тем быстрее найдёшь того, кто тебе по-настоящему подходит.\n"
-            "💬 P.S. Самые интересные люди часто скрываются за анонимностью — но с VIP ты сможешь увидеть их первым!\n"
-            "✨ Активируй VIP сейчас и открой все двери к новым знакомствам! ✨"
-        )
-        (update.message or update.callback_query.message).reply_text(upsell, reply_markup=get_vip_inline_keyboard())
-        return
-    profile = get_next_profile_for_user(user_id)
+    profile = deck_next_profile(user_id)
     if not profile:
         (update.message or update.callback_query.message).reply_text("Пока нет анкет для просмотра.", reply_markup=get_main_menu())
         return
-    increment_view(user_id)
-    record_view(user_id, profile["telegram_id"])
+    # Одним запросом: проверка лимита, списание просмотра и запись в историю
+    view = try_consume_view(user_id, profile["telegram_id"], MAX_DAILY_VIEWS)
+    if not view["allowed"]:
+        # анкету не показали — возвращаем её в колоду
+        deck_return_profile(user_id, profile["telegram_id"])
+        _send_view_limit_upsell(update)
+        return
     # сохранить текущий профиль для reply-кнопок
     context.user_data['current_profile'] = profile["telegram_id"]
     # Формируем текст анкеты. Для VIP показываем @username, если доступен
-    try:
-        # Узнаем, VIP ли текущий пользователь
-        conn = get_connection(); cur = conn.cursor()
-        cur.execute("SELECT vip FROM users WHERE telegram_id=%s", (user_id,))
-        row = cur.fetchone(); cur.close(); conn.close()
-        viewer_is_vip = bool(row and row.get('vip'))
-    except Exception:
-        viewer_is_vip = False
-    uname = ""
-    if viewer_is_vip:
-        try:
-            chat = context.bot.get_chat(profile["telegram_id"]) ; uname = f"@{chat.username}" if getattr(chat, 'username', None) else ""
-        except Exception:
-            uname = ""
+    viewer_is_vip = view["vip"]
+    uname = _contact(profile["telegram_id"]) if viewer_is_vip else ""
     # базовый текст
     text = format_profile(profile)
     if viewer_is_vip and uname:
         text = f"{text}\nКонтакт: {uname}"
     # отправляем медиа группой с caption на первом элементе, если есть
-    media = []
-    for p in profile.get("photos", []) or []:
-        if p and os.path.exists(p):
-            media.append(InputMediaPhoto(open(p, 'rb')))
-    for v in profile.get("videos", []) or []:
-        if v and os.path.exists(v):
-            media.append(InputMediaVideo(open(v, 'rb')))
-    if not media:
-        (update.message or update.callback_query.message).reply_text(text, reply_markup=get_main_menu())
-    elif len(media) == 1:
-        first = media[0]
-        if isinstance(first, InputMediaPhoto):
-            (update.message or update.callback_query.message).reply_photo(photo=first.media, caption=text)
-        else:
-            (update.message or update.callback_query.message).reply_video(video=first.media, caption=text)
-    else:
-        first = media[0]
-        if isinstance(first, InputMediaPhoto):
-            media[0] = InputMediaPhoto(first.media, caption=text)
-        else:
-            media[0] = InputMediaVideo(first.media, caption=text)
-        (update.message or update.callback_query.message).reply_media_group(media)
+    _send_profile_media(
+        context.bot, update.effective_chat.id, profile["telegram_id"], text,
+        profile.get("photos"), profile.get("videos"), reply_markup=get_main_menu(),
+    )
     # кнопки под анкетой (reply)
     (update.message or update.callback_query.message).reply_text("Выберите действие:", reply_markup=get_profile_actions_keyboard())
 
 
-def show_likes(update: Update, context: CallbackContext):
+def _sent_file(message, kind: str):
+    # (file_id, file_unique_id) загруженного файла из ответа Telegram
+    item = message.photo[-1] if kind == "photo" and message.photo else message.video
+    return (item.file_id, item.file_unique_id) if item else (None, None)
+
+
+def _send_media(bot, chat_id: int, text: str, items: list, file_ids: dict, reply_markup=None):
+    # items: [(kind, path)]; файл без file_id открывается с диска и закрывается после отправки
+    media, handles = [], []
+    try:
+        for kind, path in items:
+            source = file_ids.get(path)
+            if source is None:
+                if not os.path.exists(path):
+                    continue
+                source = open(path, 'rb')
+                handles.append(source)
+            media.append((kind, path, source))
+        if not media:
+            bot.send_message(chat_id=chat_id, text=text, reply_markup=reply_markup)
+            return []
+        if len(media) == 1:
+            kind, _, source = media[0]
+            if kind == "photo":
+                sent = [bot.send_photo(chat_id=chat_id, photo=source, caption=text)]
+            else:
+                sent = [bot.send_video(chat_id=chat_id, video=source, caption=text)]
+        else:
+            # caption на первом элементе, чтобы было одно сообщение-группа
+            group = [
+                (InputMediaPhoto if kind == "photo" else InputMediaVideo)(source, caption=text if i == 0 else None)
+                for i, (kind, _, source) in enumerate(media)
+            ]
+            sent = bot.send_media_group(chat_id=chat_id, media=group)
+    finally:
+        for f in handles:
+            f.close()
+    return list(zip(media, sent))
+
+
+def _is_file_id_error(error: BadRequest) -> bool:
+    # Только ошибки про сам file_id («Wrong file identifier/http url specified», «wrong remote file
+    # identifier specified» и т.п.); длинная подпись или недоступный чат от повтора с диска не исправятся
+    message = str(error).lower()
+    return "file identifier" in message or "file_id" in message
+
+
+def _send_profile_media(bot, chat_id: int, owner_id: int, text: str, photos, videos, reply_markup=None):
+    """Анкета с фото/видео одним сообщением. Медиа отправляются по сохранённому file_id;
+    файл из user_media/ загружается, только если file_id ещё нет, и file_id из ответа запоминается."""
+    items = [("photo", p) for p in (photos or []) if p] + [("video", v) for v in (videos or []) if v]
+    file_ids = get_media_file_ids([path for _, path in items]) if items else {}
+    try:
+        sent = _send_media(bot, chat_id, text, items, file_ids, reply_markup)
+    except BadRequest as e:
+        if not file_ids or not _is_file_id_error(e):
+            raise
+        # Telegram не принял file_id (например, сменился токен бота) — повторяем с локальными файлами
+        forget_media_file_ids(file_ids)
+        sent = _send_media(bot, chat_id, text, items, {}, reply_markup)
+    for (kind, path, source), message in sent:
+        if isinstance(source, str):
+            continue
+        file_id, file_unique_id = _sent_file(message, kind)
+        try:
+            save_media_file_id(owner_id, path, kind, file_id, file_unique_id)
+        except Exception:
+            logger.exception("Не удалось сохранить file_id для %s", path)
+
+
+def _contact(telegram_id: int, default: str = "") -> str:
+    # @username из кэша (users.username), без запроса к Telegram
+    uname = get_username(telegram_id)
+    return f"@{uname}" if uname else default
+
+
+def show_likes(update: Update, context: CallbackContext, before=None):
+    """Страница входящих симпатий: отправители и их имена одним запросом к БД, @username из кэша
+    (неизвестные обновятся в фоне, пока показываем имя)."""
     user_id = update.effective_user.id
-    rows = get_new_likes(user_id)
+    reply = (update.message or update.callback_query.message).reply_text
+    rows = get_likes_page(user_id, before, LIKES_PAGE_SIZE + 1)
     if not rows:
-        update.message.reply_text("Новых симпатий нет.", reply_markup=get_main_menu())
+        reply("Новых симпатий нет.", reply_markup=get_main_menu())
         return
-    text_lines = ["Новые симпатии:"]
-    # Соберём уникальные from_user и получим их username или имя
+    has_more = len(rows) > LIKES_PAGE_SIZE
+    rows = rows[:LIKES_PAGE_SIZE]
+    usernames = get_usernames([r['from_user'] for r in rows])
+    text_lines = ["Новые симпатии:" if before is None else "Ещё симпатии:"]
     for r in rows:
-        from_id = r['from_user'] if isinstance(r, dict) else r[0]
-        created = r['created_at'] if isinstance(r, dict) else r[1]
-        try:
-            chat = context.bot.get_chat(from_id)
-            uname = f"@{chat.username}" if getattr(chat, 'username', None) else None
-        except Exception:
-            uname = None
-        display = uname
-        if not display:
-            # fallback к имени из профиля в БД
-            try:
-                from db import get_user
-                u = get_user(from_id)
-                display = u.get('name') if u else str(from_id)
-            except Exception:
-                display = str(from_id)
-        text_lines.append(f"От: {display} ({created})")
-    update.message.reply_text("\n".join(text_lines), reply_markup=get_main_menu())
+        from_id = r['from_user']
+        uname = usernames.get(from_id)
+        # fallback к имени из профиля, пришедшему тем же запросом
+        display = f"@{uname}" if uname else (r['name'] or str(from_id))
+        text_lines.append(f"От: {display} ({r['created_at']})")
+    markup = get_main_menu()
+    if has_more:
+        last = rows[-1]
+        cursor = f"{last['created_at'].isoformat()}:{last['from_user']}"
+        markup = InlineKeyboardMarkup([[InlineKeyboardButton("Ещё ▶️", callback_data=f"likes_page:{cursor}")]])
+    reply("\n".join(text_lines), reply_markup=markup)
 
 def _send_full_profile(context: CallbackContext, chat_id: int, profile_user_id: int):
-    # Получаем профиль из БД
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        SELECT name, age, city, gender_interest, interests, photos, videos,
-               vip, bio, smoking, drinking, relationship
-        FROM users WHERE telegram_id=%s
-        """,
-        (profile_user_id,),
-    )
-    user = cur.fetchone()
-    cur.close()
-    conn.close()
+    # Получаем профиль (из кэша анкет или БД)
+    user = get_user(profile_user_id)
     if not user:
         try:
             context.bot.send_message(chat_id=chat_id, text="Анкета пользователя не найдена")
         except Exception:
             pass
         return
-    # Попробуем получить @username
-    try:
-        chat = context.bot.get_chat(profile_user_id)
-        uname = f"@{chat.username}" if getattr(chat, 'username', None) else ""
-    except Exception:
-        uname = ""
+    uname = _contact(profile_user_id)
     bio = (user.get('bio') or '').strip()
     smoking = (user.get('smoking') or '').strip()
     drinking = (user.get('drinking') or '').strip()
@@ -477,51 +491,17 @@ def _send_full_profile(context: CallbackContext, chat_id: int, profile_user_id:
         lines.append(f"Отношения: {relationship}")
     lines.append(f"VIP: {'Да' if user.get('vip') else 'Нет'}")
     text = "\n".join(lines)
-    media = []
-    for p in (user.get('photos') or []):
-        if p and os.path.exists(p):
-            media.append(InputMediaPhoto(open(p, 'rb')))
-    for v in (user.get('videos') or []):
-        if v and os.path.exists(v):
-            media.append(InputMediaVideo(open(v, 'rb')))
     try:
-        if not media:
-            context.bot.send_message(chat_id=chat_id, text=text)
-        elif len(media) == 1:
-            first = media[0]
-            if isinstance(first, InputMediaPhoto):
-                context.bot.send_photo(chat_id=chat_id, photo=first.media, caption=text)
-            else:
-                context.bot.send_video(chat_id=chat_id, video=first.media, caption=text)
-        else:
-            first = media[0]
-            if isinstance(first, InputMediaPhoto):
-                media[0] = InputMediaPhoto(first.media, caption=text)
-            else:
-                media[0] = InputMediaVideo(first.media, caption=text)
-            context.bot.send_media_group(chat_id=chat_id, media=media)
+        _send_profile_media(context.bot, chat_id, profile_user_id, text, user.get('photos'), user.get('videos'))
     except Exception:
         pass
 
 
 def _send_profile_without_username(context: CallbackContext, chat_id: int, profile_user_id: int):
-    # Получаем профиль из БД. Для VIP-пользователя (viewer=chat_id) показываем @username, для обычного — скрываем.
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        SELECT name, age, city, gender_interest, interests, photos, videos,
-               vip, bio, smoking, drinking, relationship
-        FROM users WHERE telegram_id=%s
-        """,
-        (profile_user_id,),
-    )
-    user = cur.fetchone()
+    # Получаем профиль (из кэша анкет или БД). Для VIP-пользователя (viewer=chat_id) показываем @username, для обычного — скрываем.
+    user = get_user(profile_user_id)
     # узнаем VIP статус смотрящего
-    cur.execute("SELECT vip FROM users WHERE telegram_id=%s", (chat_id,))
-    viewer_row = cur.fetchone()
-    cur.close()
-    conn.close()
+    viewer_row = get_user(chat_id)
     if not user:
         try:
             context.bot.send_message(chat_id=chat_id, text="Анкета пользователя не найдена")
@@ -557,36 +537,11 @@ def _send_profile_without_username(context: CallbackContext, chat_id: int, profi
     except Exception:
         viewer_is_vip = False
     if viewer_is_vip:
-        try:
-            chat = context.bot.get_chat(profile_user_id)
-            uname = f"@{chat.username}" if getattr(chat, 'username', None) else ""
-        except Exception:
-            uname = ""
+        uname = _contact(profile_user_id)
         if uname:
             text = f"{text}\nКонтакт: {uname}"
-    media = []
-    for p in (user.get('photos') or []):
-        if p and os.path.exists(p):
-            media.append(InputMediaPhoto(open(p, 'rb')))
-    for v in (user.get('videos') or []):
-        if v and os.path.exists(v):
-            media.append(InputMediaVideo(open(v, 'rb')))
     try:
-        if not media:
-            context.bot.send_message(chat_id=chat_id, text=text)
-        elif len(media) == 1:
-            first = media[0]
-            if isinstance(first, InputMediaPhoto):
-                context.bot.send_photo(chat_id=chat_id, photo=first.media, caption=text)
-            else:
-                context.bot.send_video(chat_id=chat_id, video=first.media, caption=text)
-        else:
-            first = media[0]
-            if isinstance(first, InputMediaPhoto):
-                media[0] = InputMediaPhoto(first.media, caption=text)
-            else:
-                media[0] = InputMediaVideo(first.media, caption=text)
-            context.bot.send_media_group(chat_id=chat_id, media=media)
+        _send_profile_media(context.bot, chat_id, profile_user_id, text, user.get('photos'), user.get('videos'))
     except Exception:
         pass
 
@@ -594,12 +549,7 @@ def _send_profile_without_username(context: CallbackContext, chat_id: int, profi
 def settings_menu(update: Update, context: CallbackContext):
     # Короткое меню настроек с кнопками
     user_id = update.effective_user.id
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT name, age, city, gender_interest, interests, age_min_preference, age_max_preference, city_filter_enabled FROM users WHERE telegram_id=%s", (user_id,))
-    u = cur.fetchone()
-    cur.close()
-    conn.close()
+    u = get_user(user_id)
     if not u:
         update.message.reply_text("Анкета не найдена. Нажмите /start чтобы создать.", reply_markup=get_main_menu())
         return
@@ -655,28 +605,21 @@ def on_callback(update: Update, context: CallbackContext):
     if data.startswith("like:"):
         to_user = int(data.split(":", 1)[1])
         query.answer("Лайк отправлен")
-        mutual = add_like(user_id, to_user)
+        inserted, mutual, cnt = add_like(user_id, to_user)
         if mutual:
-            # Попробуем указать username
-            try:
-                u1 = context.bot.get_chat(user_id); u1n = f"@{u1.username}" if getattr(u1, 'username', None) else str(user_id)
-            except Exception:
-                u1n = str(user_id)
-            try:
-                u2 = context.bot.get_chat(to_user); u2n = f"@{u2.username}" if getattr(u2, 'username', None) else str(to_user)
-            except Exception:
-                u2n = str(to_user)
+            # username берём из кэша, без запросов к Telegram
+            u1n = _contact(user_id, str(user_id))
+            u2n = _contact(to_user, str(to_user))
             context.bot.send_message(chat_id=user_id, text=f"Взаимная симпатия с {u2n}!")
             context.bot.send_message(chat_id=to_user, text=f"Взаимная симпатия с {u1n}!")
-        # Уведомление получателю лайка с кнопкой "Посмотреть"
-        try:
-            likes = get_new_likes(to_user) or []
-            cnt = len(likes)
-            note = "Кому-то понравилась ваша анкета" if cnt < 3 else f"Кому-то понравилась ваша анкета (ещё {cnt})"
-            kb = InlineKeyboardMarkup([[InlineKeyboardButton("Посмотреть", callback_data="see_likes")]])
-            context.bot.send_message(chat_id=to_user, text=note, reply_markup=kb)
-        except Exception:
-            pass
+        # Уведомление получателю лайка с кнопкой "Посмотреть" (на повторный лайк не шлём)
+        if inserted:
+            try:
+                note = "Кому-то понравилась ваша анкета" if cnt < 3 else f"Кому-то понравилась ваша анкета (ещё {cnt})"
+                kb = InlineKeyboardMarkup([[InlineKeyboardButton("Посмотреть", callback_data="see_likes")]])
+                context.bot.send_message(chat_id=to_user, text=note, reply_markup=kb)
+            except Exception:
+                pass
         return
     if data.startswith("complain:"):
         reported_id = int(data.split(":", 1)[1])
@@ -699,6 +642,12 @@ def on_callback(update: Update, context: CallbackContext):
         query.answer()
         _send_full_profile(context, rid, target)
         return
+    if data.startswith("likes_page:"):
+        query.answer()
+        # курсор — created_at (ISO, содержит ':') и from_user последней показанной строки
+        ts, from_id = data.split(":", 1)[1].rsplit(":", 1)
+        show_likes(update, context, before=(ts, int(from_id)))
+        return
     if data == "see_likes":
         query.answer()
         rows = get_unseen_likes(user_id)
@@ -717,7 +666,7 @@ def on_callback(update: Update, context: CallbackContext):
     if data.startswith("likes:like:"):
         to_like = int(data.split(":", 2)[2])
         query.answer("Лайк")
-        mutual = add_like(user_id, to_like)
+        _, mutual, _ = add_like(user_id, to_like)
         # пометим просмотренным
         try:
             mark_inbox_seen(user_id, to_like)
@@ -725,10 +674,7 @@ def on_callback(update: Update, context: CallbackContext):
             pass
         if mutual:
             # раскроем username через отдельное сообщение
-            try:
-                u = context.bot.get_chat(to_like); uname = f"@{u.username}" if getattr(u, 'username', None) else str(to_like)
-            except Exception:
-                uname = str(to_like)
+            uname = _contact(to_like, str(to_like))
             context.bot.send_message(chat_id=user_id, text=f"Взаимная симпатия с {uname}!")
         # показать следующий из очереди
         queue = context.user_data.get('likes_queue', [])
@@ -791,12 +737,7 @@ def admin_block(update: Update, context: CallbackContext):
     except (IndexError, ValueError):
         update.message.reply_text("Использование: /block <user_id>")
         return
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute("UPDATE users SET blocked = TRUE WHERE telegram_id = %s", (user_id,))
-    conn.commit()
-    cur.close()
-    conn.close()
+    set_blocked(user_id, True)
     update.message.reply_text(f"Пользователь {user_id} заблокирован.")
 
 def admin_unblock(update: Update, context: CallbackContext):
@@ -808,12 +749,7 @@ def admin_unblock(update: Update, context: CallbackContext):
     except (IndexError, ValueError):
         update.message.reply_text("Использование: /unblock <user_id>")
         return
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute("UPDATE users SET blocked = FALSE WHERE telegram_id = %s", (user_id,))
-    conn.commit()
-    cur.close()
-    conn.close()
+    set_blocked(user_id, False)
     update.message.reply_text(f"Пользователь {user_id} разблокирован.")
 
 def admin_send(update: Update, context: CallbackContext):
@@ -941,8 +877,11 @@ def admin_stats(update: Update, context: CallbackContext):
     comp = cur.fetchone()["c"]
     cur.close()
     conn.close()
+    media = get_media_ingest_stats()
     update.message.reply_text(
-        f"Пользователи: {total}\nVIP: {vip}\nЗаблокировано: {blocked}\nЖалобы: {comp}",
+        f"Пользователи: {total}\nVIP: {vip}\nЗаблокировано: {blocked}\nЖалобы: {comp}\n"
+        f"Загрузка медиа: в очереди {media['pending']}, скачано {media['done']} "
+        f"({media['bytes_per_sec'] // 1024} КБ/с), ошибок {media['failed']}",
         reply_markup=get_main_menu(True),
     )
 
@@ -1097,6 +1036,8 @@ def admin_views_history(update: Update, context: CallbackContext):
     if update.effective_user.id not in ADMIN_IDS:
         update.message.reply_text("Нет доступа.")
         return
+    # допишем просмотры из буфера, чтобы история была актуальной
+    flush_views()
     conn = get_connection()
     cur = conn.cursor()
     cur.execute("SELECT viewer_id, viewed_id, created_at FROM views ORDER BY created_at DESC LIMIT 20")
@@ -1136,3 +1077,23 @@ def admin_view_reports(update: Update, context: CallbackContext):
         created_at = r.get('created_at') if isinstance(r, dict) else r[4]
         text += f"От {reporter_id} — {reason} ({created_at})\n"
     update.message.reply_text(text)
+
+
+def duplicates_command(update: Update, context: CallbackContext):
+    # Анкеты с теми же фото/видео, что у пользователя: помогает находить фейковые анкеты
+    if (update.effective_user.id not in ADMIN_IDS) and (update.effective_user.id not in MODERATOR_IDS):
+        update.message.reply_text("Нет доступа.")
+        return
+    try:
+        target_id = int(context.args[0])
+    except (IndexError, ValueError):
+        update.message.reply_text("Использование: /dupes <user_id>")
+        return
+    rows = find_duplicate_media(target_id)
+    if not rows:
+        update.message.reply_text("Анкет с такими же фото нет.")
+        return
+    text = f"Общие фото/видео с {target_id}:\n"
+    for r in rows:
+        text += f"{r['telegram_id']} ({r['name']}) — {r['shared']} шт.{' [заблокирован]' if r['blocked'] else ''}\n"
+    update.message.reply_text(text)
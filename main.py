@@ -1,18 +1,27 @@
 import logging
 import os
 from telegram.ext import (
-    Updater, CommandHandler, MessageHandler, Filters, CallbackContext, CallbackQueryHandler, PreCheckoutQueryHandler
+    Updater, CommandHandler, MessageHandler, Filters, CallbackContext, CallbackQueryHandler, PreCheckoutQueryHandler,
+    TypeHandler,
 )
+from telegram import Update
 from handlers import (
-    start, skip_video, menu_handler,
+    start, skip_video, menu_handler, track_username,
     complain_command, on_callback,
     admin_command, admin_block, admin_unblock, admin_send, admin_broadcast,
     complaints_list, users_csv, admin_view_reports, moder_command,
-    admin_add_moder, admin_del_moder,
+    admin_add_moder, admin_del_moder, duplicates_command,
     precheckout_callback, successful_payment_callback
 )
-from db import init_db
+from db import init_db, close_pool, get_pool_stats, close_write_buffers, get_views_buffer_stats, get_profile_cache_stats, reshuffle_random_keys, reconcile_unseen_likes, load_match_entries, set_match_engine, add_user_change_listener, remember_username, set_username_refresher, MATCH_SAMPLING, RAND_KEY_RESHUFFLE_INTERVAL, UNSEEN_LIKES_RECONCILE_INTERVAL
 from registration import build_conversation_handler
+from deck import shutdown as deck_shutdown
+from media_ingest import (
+    shutdown as media_shutdown, get_stats as get_media_ingest_stats, collect_garbage as collect_media_garbage,
+    MEDIA_GC_INTERVAL,
+)
+from matching import MatchEngine
+from usernames import UsernameRefresher
 from settings_handlers import register_settings_handlers
 
 TOKEN = os.getenv("TELEGRAM_TOKEN", "")
@@ -24,12 +33,36 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+def reshuffle_job(context: CallbackContext):
+    try:
+        reshuffle_random_keys()
+    except Exception:
+        logger.exception("Не удалось перемешать rand_key")
+
+def unseen_likes_job(context: CallbackContext):
+    try:
+        reconcile_unseen_likes()
+    except Exception:
+        logger.exception("Не удалось сверить счётчики непросмотренных лайков")
+
+def media_gc_job(context: CallbackContext):
+    try:
+        collect_media_garbage()
+    except Exception:
+        logger.exception("Не удалось удалить неиспользуемые медиафайлы")
+
 def main():
     if not TOKEN:
         raise RuntimeError("TELEGRAM_TOKEN is not set")
     updater = Updater(TOKEN, use_context=True)
     dp = updater.dispatcher
 
+    # @username отправителя каждого апдейта — в кэш (группа -1 выполняется до остальных обработчиков)
+    dp.add_handler(TypeHandler(Update, track_username), group=-1)
+    # Неизвестные и устаревшие username обновляются в фоне с ограничением частоты запросов
+    username_refresher = UsernameRefresher(updater.bot, remember_username)
+    set_username_refresher(username_refresher.request)
+
     # Регистрация через ConversationHandler (обрабатывает /start)
     dp.add_handler(build_conversation_handler())
 
@@ -68,6 +101,7 @@ def main():
     dp.add_handler(CommandHandler("complaints", complaints_list))
     dp.add_handler(CommandHandler("users_csv", users_csv))
     dp.add_handler(CommandHandler("view_reports", admin_view_reports))
+    dp.add_handler(CommandHandler("dupes", duplicates_command))
     # Общий обработчик всех прочих callback'ов
     dp.add_handler(CallbackQueryHandler(on_callback))
     # Telegram Payments
@@ -77,9 +111,40 @@ def main():
     # Инициализация базы
     init_db()
 
+    # Периодическое перемешивание ключей случайной выборки (memory использует indexed, пока строится индекс)
+    if MATCH_SAMPLING in ("indexed", "memory"):
+        updater.job_queue.run_repeating(reshuffle_job, interval=RAND_KEY_RESHUFFLE_INTERVAL, first=RAND_KEY_RESHUFFLE_INTERVAL)
+
+    # Сверка счётчиков непросмотренных лайков
+    updater.job_queue.run_repeating(unseen_likes_job, interval=UNSEEN_LIKES_RECONCILE_INTERVAL, first=60)
+
+    # Удаление файлов хранилища, на которые не ссылается ни одна анкета
+    updater.job_queue.run_repeating(media_gc_job, interval=MEDIA_GC_INTERVAL, first=MEDIA_GC_INTERVAL)
+
+    # Индекс анкет в памяти: строится в фоне, обновляется после каждой записи в users
+    engine = None
+    if MATCH_SAMPLING == "memory":
+        engine = MatchEngine(load_match_entries)
+        add_user_change_listener(engine.update)
+        set_match_engine(engine)
+        engine.start()
+
     logger.info("Бот запущен!")
     updater.start_polling()
     updater.idle()
 
+    deck_shutdown()
+    media_shutdown()
+    logger.info("Загрузка медиа: %s", get_media_ingest_stats())
+    username_refresher.close()
+    if engine is not None:
+        engine.close()
+        logger.info("Индекс анкет в памяти: %s", engine.snapshot())
+    close_write_buffers()
+    logger.info("Буфер просмотров: %s", get_views_buffer_stats())
+    logger.info("Кэш анкет: %s", get_profile_cache_stats())
+    logger.info("Статистика пула соединений: %s", get_pool_stats())
+    close_pool()
+
 if __name__ == "__main__":
     main()
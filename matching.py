@@ -0,0 +1,251 @@
+import os
+import time
+import random
+import logging
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+
+logger = logging.getLogger(__name__)
+
+# Движок выборки анкет в памяти (MATCH_SAMPLING=memory).
+# Незаблокированные анкеты разложены по корзинам (пол, город); в каждой корзине — отсортированные
+# по возрасту массивы возрастов, telegram_id, масок интересов и привлекательности отдельно для VIP и обычных анкет.
+# Ступени поиска отвечаются бинарным поиском по возрасту и случайной выборкой без SQL;
+# выбранная пачка упорядочивается по числу общих интересов с ищущим, затем по привлекательности
+# (она берётся из user_stats при сборке и обновлении анкеты, между сверками может немного отставать).
+MATCH_ENGINE_RECONCILE_INTERVAL = int(os.getenv("MATCH_ENGINE_RECONCILE_INTERVAL", "600"))  # полная сверка с БД (сек)
+
+_ANY = None  # ключ корзины «любой пол» / «любой город»
+
+
+class _Group:
+    """Анкеты одной корзины, отсортированные по возрасту: параллельные массивы возрастов, id,
+    масок интересов и привлекательности."""
+    __slots__ = ("ages", "ids", "masks", "scores")
+
+    def __init__(self):
+        self.ages = array("H")
+        self.ids = array("q")
+        self.masks = array("L")
+        self.scores = array("f")
+
+    def add(self, age: int, telegram_id: int, mask: int, score: float):
+        pos = bisect_right(self.ages, age)
+        self.ages.insert(pos, age)
+        self.ids.insert(pos, telegram_id)
+        self.masks.insert(pos, mask)
+        self.scores.insert(pos, score)
+
+    def extend_sorted(self, rows: list):
+        # rows — (age, telegram_id, mask, score), уже отсортированные по возрасту; только для пустой группы
+        self.ages = array("H", (r[0] for r in rows))
+        self.ids = array("q", (r[1] for r in rows))
+        self.masks = array("L", (r[2] for r in rows))
+        self.scores = array("f", (r[3] for r in rows))
+
+    def remove(self, age: int, telegram_id: int):
+        lo, hi = bisect_left(self.ages, age), bisect_right(self.ages, age)
+        for pos in range(lo, hi):
+            if self.ids[pos] == telegram_id:
+                del self.ages[pos]
+                del self.ids[pos]
+                del self.masks[pos]
+                del self.scores[pos]
+                return
+
+    def sample(self, min_age, max_age, exclude: int, k: int, mask: int = 0) -> list:
+        lo = 0 if min_age is None else bisect_left(self.ages, min_age)
+        hi = len(self.ages) if max_age is None else bisect_right(self.ages, max_age)
+        if hi <= lo or k <= 0:
+            return []
+        # берём на одну больше, чтобы после исключения себя осталось k
+        picked = random.sample(range(lo, hi), min(k + 1, hi - lo))
+        masks, scores = self.masks, self.scores
+        if mask:
+            picked.sort(key=lambda p: (bin(masks[p] & mask).count("1"), scores[p]), reverse=True)
+        else:
+            picked.sort(key=scores.__getitem__, reverse=True)
+        return [tid for tid in (self.ids[p] for p in picked) if tid != exclude][:k]
+
+
+class _Bucket:
+    __slots__ = ("vip", "regular")
+
+    def __init__(self):
+        self.vip = _Group()
+        self.regular = _Group()
+
+
+def _bucket_keys(gender, city):
+    # без повторов: при пустом поле или городе ключи совпадают, а анкета должна попасть в корзину один раз
+    return tuple(dict.fromkeys(((gender, city), (gender, _ANY), (_ANY, city), (_ANY, _ANY))))
+
+
+def _entry(row):
+    age = row["age"] or 0
+    return (row["gender"], row["normalized_city"], max(0, min(age, 65535)), bool(row["vip"]), row["interests_mask"] or 0,
+            row["desirability"])
+
+
+class _Index:
+    def __init__(self):
+        self.buckets = {}
+        self.entries = {}  # telegram_id -> (gender, city, age, vip, interests_mask, desirability)
+
+    def add(self, telegram_id: int, entry: tuple):
+        gender, city, age, vip, mask, score = entry
+        for key in _bucket_keys(gender, city):
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = _Bucket()
+            (bucket.vip if vip else bucket.regular).add(age, telegram_id, mask, score)
+        self.entries[telegram_id] = entry
+
+    def load(self, rows):
+        """Заполнить пустой индекс строками loader: раскладываем по корзинам списками
+        и сортируем каждый один раз, без вставок в середину массивов."""
+        groups = {}
+        for row in rows:
+            telegram_id = row["telegram_id"]
+            entry = _entry(row)
+            gender, city, age, vip, mask, score = entry
+            for key in _bucket_keys(gender, city):
+                groups.setdefault((key, vip), []).append((age, telegram_id, mask, score))
+            self.entries[telegram_id] = entry
+        for (key, vip), items in groups.items():
+            items.sort(key=lambda r: r[0])
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = _Bucket()
+            (bucket.vip if vip else bucket.regular).extend_sorted(items)
+
+    def remove(self, telegram_id: int):
+        entry = self.entries.pop(telegram_id, None)
+        if entry is None:
+            return
+        gender, city, age, vip, _, _ = entry
+        for key in _bucket_keys(gender, city):
+            bucket = self.buckets.get(key)
+            if bucket is not None:
+                (bucket.vip if vip else bucket.regular).remove(age, telegram_id)
+
+
+class MatchEngine:
+    """Индекс анкет в памяти процесса. loader(telegram_id=None) возвращает строки
+    telegram_id, gender, normalized_city, age, vip, interests_mask, desirability незаблокированных анкет (все или одну)."""
+
+    def __init__(self, loader, reconcile_interval: float = MATCH_ENGINE_RECONCILE_INTERVAL):
+        self._loader = loader
+        self._interval = reconcile_interval
+        self._index = None
+        self._lock = threading.Lock()
+        self._pending = set()  # изменения, пришедшие во время полной пересборки
+        self._rebuilding = False
+        self._stop = threading.Event()
+        self._thread = None
+        self.stats = {"rebuilds": 0, "updates": 0, "lookups": 0, "failed": 0, "size": 0, "built_at": None}
+
+    @property
+    def ready(self) -> bool:
+        return self._index is not None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="match-engine", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.rebuild()
+            except Exception:
+                with self._lock:
+                    self.stats["failed"] += 1
+                logger.exception("Не удалось построить индекс анкет в памяти")
+            if self._stop.wait(self._interval):
+                return
+
+    def rebuild(self):
+        """Полная сборка индекса из БД и атомарная подмена старого."""
+        with self._lock:
+            self._rebuilding = True
+            self._pending.clear()
+        started = time.monotonic()
+        try:
+            index = _Index()
+            index.load(self._loader())
+            # анкеты, изменившиеся во время сборки, перечитываем заново — пока очередь не опустеет;
+            # флаг сборки снимаем и индекс подменяем под той же блокировкой, что и проверку пустой очереди,
+            # иначе update() между ними обновил бы старый индекс и не попал в новый
+            while True:
+                with self._lock:
+                    pending, self._pending = self._pending, set()
+                    if not pending:
+                        self._rebuilding = False
+                        self._index = index
+                        self.stats["rebuilds"] += 1
+                        self.stats["size"] = len(index.entries)
+                        self.stats["built_at"] = time.time()
+                        break
+                for telegram_id in pending:
+                    self._reload(index, telegram_id)
+        except Exception:
+            with self._lock:
+                self._rebuilding = False
+            raise
+        logger.info("Индекс анкет в памяти: %d анкет за %.2fс", len(index.entries), time.monotonic() - started)
+
+    def _reload(self, index: _Index, telegram_id: int):
+        rows = self._loader(telegram_id)
+        with self._lock:
+            index.remove(telegram_id)
+            if rows:
+                index.add(telegram_id, _entry(rows[0]))
+
+    def update(self, telegram_id: int):
+        """Перечитать одну анкету из БД (вызывается после каждой записи в users)."""
+        with self._lock:
+            if self._rebuilding:
+                self._pending.add(telegram_id)
+            index = self._index
+        if index is None:
+            return
+        try:
+            self._reload(index, telegram_id)
+        except Exception:
+            with self._lock:
+                self.stats["failed"] += 1
+            logger.exception("Не удалось обновить анкету %s в индексе", telegram_id)
+            return
+        with self._lock:
+            self.stats["updates"] += 1
+            self.stats["size"] = len(index.entries)
+
+    def sample(self, params: dict, tier: str, k: int) -> list:
+        """До k случайных telegram_id для ступени поиска db._search_tiers: VIP идут первыми,
+        внутри групп — по убыванию числа общих интересов и привлекательности."""
+        if tier == "city":
+            key, min_age, max_age = (params["gender"], params["norm_city"]), params["min_age"], params["max_age"]
+        elif tier == "age":
+            key, min_age, max_age = (params["gender"], _ANY), params["min_age"], params["max_age"]
+        else:
+            key, min_age, max_age = (params["gender"], _ANY), None, None
+        with self._lock:
+            self.stats["lookups"] += 1
+            bucket = self._index.buckets.get(key)
+            if bucket is None:
+                return []
+            mask = params.get("mask", 0)
+            ids = bucket.vip.sample(min_age, max_age, params["me"], k, mask)
+            if len(ids) < k:
+                ids += bucket.regular.sample(min_age, max_age, params["me"], k - len(ids), mask)
+        return ids
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return dict(self.stats)
+
+    def close(self, timeout: float = 5.0):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
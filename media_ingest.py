@@ -0,0 +1,164 @@
+import os
+import hashlib
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from cache import LRUCache
+from db import (
+    remove_user_media, save_media_file_ids, register_media_blob, resolve_media_path,
+    collect_media_garbage,
+)
+from utils import media_path, content_path
+
+logger = logging.getLogger(__name__)
+
+# Загрузка фото/видео из Telegram в BASE_MEDIA_DIR в фоне: обработчик получает путь сразу
+# и отвечает пользователю, не дожидаясь скачивания. Число потоков, предел очереди
+# (сверх него файл скачивается прямо в обработчике) и число повторов при ошибке.
+MEDIA_DOWNLOAD_WORKERS = int(os.getenv("MEDIA_DOWNLOAD_WORKERS", "4"))
+MEDIA_DOWNLOAD_QUEUE = int(os.getenv("MEDIA_DOWNLOAD_QUEUE", "200"))
+MEDIA_DOWNLOAD_RETRIES = int(os.getenv("MEDIA_DOWNLOAD_RETRIES", "2"))
+# Файл без ссылок из анкет удаляется с диска, если его не трогали столько секунд
+# (запас на незаконченную регистрацию, где фото ещё не записаны в users)
+MEDIA_GC_GRACE = float(os.getenv("MEDIA_GC_GRACE", "86400"))
+MEDIA_GC_INTERVAL = int(os.getenv("MEDIA_GC_INTERVAL", "3600"))
+
+_executor = ThreadPoolExecutor(max_workers=MEDIA_DOWNLOAD_WORKERS, thread_name_prefix="media-download")
+_lock = threading.Lock()
+_pending = 0
+_stats = {
+    "submitted": 0, "inline": 0, "done": 0, "failed": 0, "retries": 0, "deduplicated": 0,
+    "bytes": 0, "seconds": 0.0, "collected": 0,
+}
+# Пути, которые так и не удалось скачать: анкеты в процессе заполнения отфильтровывают их перед сохранением
+_failed = LRUCache(10000)
+
+
+def _hash_file(path: str):
+    digest = hashlib.sha256()
+    size = 0
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+            size += len(chunk)
+    return digest.hexdigest(), size
+
+
+def _download(telegram_id: int, tg_media, path: str):
+    # Скачиваем во временный файл, по sha256 содержимого кладём в хранилище (одинаковые файлы — один раз)
+    # и заменяем исходный путь на итоговый в media и в анкете
+    tmp = path + ".part"
+    started = time.monotonic()
+    try:
+        tg_media.get_file().download(custom_path=tmp)
+        digest, size = _hash_file(tmp)
+        stored = content_path(digest, os.path.splitext(path)[1])
+        register_media_blob(digest, stored, size)
+        duplicate = os.path.exists(stored)
+        if duplicate:
+            os.remove(tmp)
+        else:
+            os.makedirs(os.path.dirname(stored), exist_ok=True)
+            os.replace(tmp, stored)
+    except Exception:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+    resolve_media_path(telegram_id, path, stored)
+    with _lock:
+        _stats["done"] += 1
+        _stats["deduplicated"] += int(duplicate)
+        _stats["bytes"] += size
+        _stats["seconds"] += time.monotonic() - started
+
+
+def _run(telegram_id: int, tg_media, path: str):
+    global _pending
+    try:
+        for attempt in range(MEDIA_DOWNLOAD_RETRIES + 1):
+            try:
+                _download(telegram_id, tg_media, path)
+                return
+            except Exception as e:
+                if attempt == MEDIA_DOWNLOAD_RETRIES:
+                    logger.warning("Не удалось скачать %s для %s: %s", path, telegram_id, e)
+                    break
+                with _lock:
+                    _stats["retries"] += 1
+                time.sleep(2 ** attempt)
+        with _lock:
+            _stats["failed"] += 1
+        _failed.set(path, True)
+        try:
+            remove_user_media(telegram_id, path)
+        except Exception:
+            logger.exception("Не удалось убрать %s из анкеты %s", path, telegram_id)
+    finally:
+        with _lock:
+            _pending -= 1
+
+
+def enqueue(telegram_id: int, tg_media, path: str):
+    """Скачать фото/видео (PhotoSize или Video из сообщения) в path в фоне.
+    При переполненной очереди файл скачивается сразу, в текущем потоке."""
+    global _pending
+    with _lock:
+        inline = _pending >= MEDIA_DOWNLOAD_QUEUE
+        _pending += 1
+        _stats["inline" if inline else "submitted"] += 1
+    if inline:
+        _run(telegram_id, tg_media, path)
+    else:
+        _executor.submit(_run, telegram_id, tg_media, path)
+
+
+def ingest(telegram_id: int, kind: str, items: list, first_index: int) -> list:
+    """Принять пачку фото/видео из сообщений (PhotoSize или Video): пути и file_id сохраняются сразу
+    (file_id одним запросом), файлы скачиваются в фоне. Возвращает пути в порядке items."""
+    paths = [media_path(telegram_id, kind, first_index + i) for i in range(len(items))]
+    save_media_file_ids(
+        telegram_id, [(path, kind, item.file_id, item.file_unique_id) for path, item in zip(paths, items)]
+    )
+    for path, item in zip(paths, items):
+        enqueue(telegram_id, item, path)
+    return paths
+
+
+def without_failed(paths: list) -> list:
+    """paths без файлов, скачать которые не удалось."""
+    return [p for p in paths if _failed.get(p) is None]
+
+
+def _remove_file(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def collect_garbage():
+    """Удалить с диска файлы хранилища, на которые больше не ссылается ни одна анкета."""
+    removed = collect_media_garbage(MEDIA_GC_GRACE, _remove_file)
+    with _lock:
+        _stats["collected"] += removed
+    if removed:
+        logger.info("Удалено неиспользуемых медиафайлов: %d", removed)
+    return removed
+
+
+def get_stats() -> dict:
+    with _lock:
+        data = dict(_stats)
+        data["pending"] = _pending
+    data["avg_ms"] = round(data["seconds"] * 1000 / data["done"], 1) if data["done"] else 0.0
+    data["bytes_per_sec"] = int(data["bytes"] / data["seconds"]) if data["seconds"] else 0
+    return data
+
+
+def shutdown(wait: bool = True):
+    # Дождаться начатых загрузок, чтобы пути в анкетах не остались без файлов
+    _executor.shutdown(wait=wait)
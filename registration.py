@@ -1,12 +1,14 @@
 from telegram import Update, ReplyKeyboardRemove
 from telegram.ext import CallbackContext, ConversationHandler, MessageHandler, Filters, CommandHandler, CallbackQueryHandler
-from db import add_user, update_user_photos, update_user_videos, is_blocked as db_is_blocked, get_user
+from db import (
+    add_user, update_user_photos, update_user_videos, is_blocked as db_is_blocked, get_user,
+)
+from albums import collect as collect_album, flush as flush_albums
+from media_ingest import ingest as ingest_media, without_failed
 from utils import (
     validate_name,
     validate_age,
     validate_city,
-    save_photo,
-    save_video,
     get_gender_self_keyboard,
     get_gender_interest_keyboard,
     get_interests_inline_keyboard,
@@ -147,8 +149,40 @@ def interests_callback(update: Update, context: CallbackContext):
     query.answer()
     return R_INTERESTS
 
+def _add_photos(user_data: dict, key: str, telegram_id: int, photos: list) -> list:
+    # Пути и file_id сохраняются сразу, файлы скачиваются в фоне
+    current = user_data.setdefault(key, [])
+    paths = ingest_media(telegram_id, 'photo', photos, len(current) + 1)
+    current.extend(paths)
+    return current
+
+
+def _album_photos_text(added: int, skipped: int, total: int) -> str:
+    text = f"Сохранено фото из альбома: {added} (всего {total})."
+    if skipped:
+        # видео из альбома на шаге фото не сохраняем — одним сообщением, а не ответом на каждое
+        text += f" Видео из альбома пропущены: {skipped}, их можно добавить на следующем шаге."
+    return text
+
+
+def _on_photo_album(bot, album):
+    if 'photos' not in album.user_data:
+        # регистрация уже завершена или сброшена
+        return
+    items = [m.photo[-1] for m in album.messages if m.photo]
+    photos = _add_photos(album.user_data, 'photos', album.user_id, items) if items else album.user_data.get('photos', [])
+    bot.send_message(
+        chat_id=album.chat_id,
+        text=_album_photos_text(len(items), len(album.messages) - len(items), len(photos))
+             + " Можно отправить ещё или нажать 'Готово'.",
+        reply_markup=get_done_keyboard(),
+    )
+
+
 def r_photos(update: Update, context: CallbackContext):
     if update.message.text and update.message.text.strip().lower() == "готово":
+        # альбом мог ещё собираться — учитываем его до проверки
+        flush_albums(context.bot, update.effective_user.id)
         photos = context.user_data.get('photos', [])
         if len(photos) < 3:
             update.message.reply_text("Нужно минимум 3 фото. Продолжайте отправлять фотографии.")
@@ -157,15 +191,13 @@ def r_photos(update: Update, context: CallbackContext):
         context.user_data['videos'] = []
         return R_VIDEOS
 
+    # фото из альбома обрабатываются пачкой, с одним ответом на весь альбом (видео в нём пропускаются)
+    if (update.message.photo or update.message.video) and collect_album(update, context, _on_photo_album):
+        return R_PHOTOS
     if update.message.photo:
-        photo_file = update.message.photo[-1].get_file()
-        photo_index = len(context.user_data.get('photos', [])) + 1
-        path = save_photo(photo_file, update.effective_user.id, photo_index)
-        photos = context.user_data.get('photos', [])
-        photos.append(path)
-        context.user_data['photos'] = photos
+        photos = _add_photos(context.user_data, 'photos', update.effective_user.id, [update.message.photo[-1]])
         update.message.reply_text(
-            f"Фото {photo_index} сохранено. Можно отправить следующее или нажать 'Готово'.",
+            f"Фото {len(photos)} сохранено. Можно отправить следующее или нажать 'Готово'.",
             reply_markup=get_done_keyboard(),
         )
         return R_PHOTOS
@@ -180,9 +212,8 @@ def r_videos(update: Update, context: CallbackContext):
         return R_HABITS
 
     if update.message.video:
-        video_file = update.message.video.get_file()
         video_index = len(context.user_data.get('videos', [])) + 1
-        path = save_video(video_file, update.effective_user.id, video_index)
+        path = ingest_media(update.effective_user.id, 'video', [update.message.video], video_index)[0]
         videos = context.user_data.get('videos', [])
         videos.append(path)
         context.user_data['videos'] = videos
@@ -274,8 +305,8 @@ def r_habits(update: Update, context: CallbackContext):
                 drinking=data.get('drinking'),
                 relationship=data.get('relationship'),
             )
-            update_user_photos(update.effective_user.id, data.get('photos', []))
-            update_user_videos(update.effective_user.id, data.get('videos', []))
+            update_user_photos(update.effective_user.id, without_failed(data.get('photos', [])))
+            update_user_videos(update.effective_user.id, without_failed(data.get('videos', [])))
         except Exception as e:
             update.message.reply_text("Ошибка сохранения анкеты. Попробуйте позже.")
             return ConversationHandler.END
@@ -302,7 +333,7 @@ def build_conversation_handler():
                 MessageHandler(Filters.text & (~Filters.command), r_interests),
                 CallbackQueryHandler(interests_callback, pattern=r"^(intsel:\d+|intdone)$"),
             ],
-            R_PHOTOS: [MessageHandler((Filters.photo | Filters.text) & (~Filters.command), r_photos)],
+            R_PHOTOS: [MessageHandler((Filters.photo | Filters.video | Filters.text) & (~Filters.command), r_photos)],
             R_VIDEOS: [MessageHandler((Filters.video | Filters.text) & (~Filters.command), r_videos)],
             R_HABITS: [MessageHandler(Filters.text & (~Filters.command), r_habits)],
         },
@@ -0,0 +1,88 @@
+import os
+import math
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+# Исключение уже просмотренных анкет из поиска.
+# Для каждого пользователя держим Bloom-фильтр по telegram_id просмотренных анкет. Размер считается
+# при каждой пересборке из числа загруженных просмотров (не больше SEEN_MAX_ENTRIES) и доли ложных
+# срабатываний SEEN_BLOOM_FP_RATE: ложное срабатывание прячет непросмотренную анкету, поэтому
+# фильтр фиксированного размера не годится — у активных пользователей он бы переполнялся.
+SEEN_WINDOW_DAYS = int(os.getenv("SEEN_WINDOW_DAYS", "7"))  # через сколько дней анкета может показаться снова; 0 — не исключать
+SEEN_BLOOM_FP_RATE = float(os.getenv("SEEN_BLOOM_FP_RATE", "0.01"))
+SEEN_BLOOM_HEADROOM = int(os.getenv("SEEN_BLOOM_HEADROOM", "1000"))  # запас под просмотры до следующей пересборки
+SEEN_REBUILD_INTERVAL = int(os.getenv("SEEN_REBUILD_INTERVAL", "3600"))  # пересборка из views (сек), чтобы старые просмотры «выпадали»
+SEEN_MAX_ENTRIES = int(os.getenv("SEEN_MAX_ENTRIES", "20000"))  # сколько последних просмотров загружать при пересборке (~24 КБ фильтра при 1%)
+SEEN_MAX_USERS = int(os.getenv("SEEN_MAX_USERS", "10000"))
+
+
+class BloomFilter:
+    __slots__ = ("bits", "size", "hashes")
+
+    def __init__(self, size: int, hashes: int):
+        self.size = size
+        self.hashes = hashes
+        self.bits = bytearray((size + 7) // 8)
+
+    @classmethod
+    def for_capacity(cls, capacity: int, fp_rate: float = SEEN_BLOOM_FP_RATE):
+        """Фильтр на capacity элементов с долей ложных срабатываний не выше fp_rate:
+        m = -n·ln p / ln²2 бит, k = m/n·ln 2 хешей."""
+        capacity = max(capacity, 1)
+        size = max(64, math.ceil(-capacity * math.log(fp_rate) / math.log(2) ** 2))
+        hashes = max(1, round(size / capacity * math.log(2)))
+        return cls(size, hashes)
+
+    def _positions(self, item: int):
+        digest = hashlib.blake2b(int(item).to_bytes(8, "little", signed=True), digest_size=8).digest()
+        h1 = int.from_bytes(digest[:4], "little")
+        h2 = int.from_bytes(digest[4:], "little") | 1
+        for i in range(self.hashes):
+            yield (h1 + i * h2) % self.size
+
+    def add(self, item: int):
+        for pos in self._positions(item):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, item: int) -> bool:
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(item))
+
+
+_filters = OrderedDict()  # viewer_id -> (BloomFilter, время сборки)
+_lock = threading.Lock()
+
+
+def get_seen_filter(viewer_id: int, loader):
+    """Фильтр просмотренных анкет пользователя. loader() возвращает telegram_id
+    анкет, просмотренных в пределах окна SEEN_WINDOW_DAYS, и вызывается только при (пере)сборке."""
+    now = time.monotonic()
+    with _lock:
+        item = _filters.get(viewer_id)
+        if item and now - item[1] < SEEN_REBUILD_INTERVAL:
+            _filters.move_to_end(viewer_id)
+            return item[0]
+    viewed = list(loader())
+    bloom = BloomFilter.for_capacity(min(len(viewed), SEEN_MAX_ENTRIES) + SEEN_BLOOM_HEADROOM)
+    for viewed_id in viewed:
+        bloom.add(viewed_id)
+    with _lock:
+        _filters[viewer_id] = (bloom, now)
+        _filters.move_to_end(viewer_id)
+        while len(_filters) > SEEN_MAX_USERS:
+            _filters.popitem(last=False)
+    return bloom
+
+
+def mark_seen(viewer_id: int, viewed_id: int):
+    # Если фильтра ещё нет, он соберётся из views при следующем поиске
+    with _lock:
+        item = _filters.get(viewer_id)
+        if item:
+            item[0].add(viewed_id)
+
+
+def forget(viewer_id: int):
+    with _lock:
+        _filters.pop(viewer_id, None)
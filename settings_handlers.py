@@ -5,7 +5,10 @@ from db import (
     update_user_field, update_user_interests, delete_user, update_user_photos,
     set_age_preference, set_city_filter_enabled, set_user_city, get_user,
 )
-from utils import get_interests_inline_keyboard, INTERESTS_LIST, get_main_menu, get_done_keyboard, save_photo
+from utils import get_interests_inline_keyboard, INTERESTS_LIST, get_main_menu, get_done_keyboard
+from albums import collect as collect_album, flush as flush_albums
+from media_ingest import ingest as ingest_media, without_failed
+from deck import invalidate_deck
 
 
 def _parse_arg(text: str) -> str:
@@ -28,6 +31,7 @@ def set_age(update: Update, context: CallbackContext):
         update.message.reply_text("Возраст от 18 до 99. Пример: /setage 25")
         return
     update_user_field(update.effective_user.id, "age", int(value))
+    invalidate_deck(update.effective_user.id)
     update.message.reply_text("Возраст обновлён.", reply_markup=get_main_menu())
 
 
@@ -38,6 +42,7 @@ def set_city(update: Update, context: CallbackContext):
         return
     # Обновим город с нормализацией
     set_user_city(update.effective_user.id, value)
+    invalidate_deck(update.effective_user.id)
     update.message.reply_text("Город обновлён.", reply_markup=get_main_menu())
 
 
@@ -53,6 +58,7 @@ def set_gi(update: Update, context: CallbackContext):
         update.message.reply_text("Пример: /setgi Парни|Девушки|Без разницы")
         return
     update_user_field(update.effective_user.id, "gender_interest", norm)
+    invalidate_deck(update.effective_user.id)
     update.message.reply_text("Предпочтения обновлены.", reply_markup=get_main_menu())
 
 
@@ -100,6 +106,7 @@ def edit_age_step(update: Update, context: CallbackContext):
         update.message.reply_text("Возраст от 18 до 99. Попробуйте снова.")
         return EDIT_AGE
     update_user_field(update.effective_user.id, 'age', int(value))
+    invalidate_deck(update.effective_user.id)
     update.message.reply_text("Возраст обновлён.", reply_markup=get_main_menu())
     return ConversationHandler.END
 
@@ -115,6 +122,7 @@ def edit_city_step(update: Update, context: CallbackContext):
         update.message.reply_text("Слишком короткое название. Попробуйте снова.")
         return EDIT_CITY
     set_user_city(update.effective_user.id, value)
+    invalidate_deck(update.effective_user.id)
     update.message.reply_text("Город обновлён.", reply_markup=get_main_menu())
     return ConversationHandler.END
 
@@ -206,6 +214,7 @@ def agepref_input_step(update: Update, context: CallbackContext):
         update.message.reply_text("Неверный формат. Пример: 20-30")
         return AGE_PREF_INPUT
     set_age_preference(update.effective_user.id, a1, a2)
+    invalidate_deck(update.effective_user.id)
     update.message.reply_text("Фильтр возраста обновлён.", reply_markup=get_main_menu())
     return ConversationHandler.END
 
@@ -215,6 +224,7 @@ def cityfilter_toggle_cb(update: Update, context: CallbackContext):
     u = get_user(uid)
     cur = bool(u.get('city_filter_enabled') if u and (u.get('city_filter_enabled') is not None) else True)
     set_city_filter_enabled(uid, not cur)
+    invalidate_deck(uid)
     query.answer("Переключено")
     new_state = "Вкл" if not cur else "Выкл"
     query.edit_message_text(f"Фильтр города: {new_state}. Откройте настройки снова для обновления меню.")
@@ -246,25 +256,45 @@ def change_photos_start(update: Update, context: CallbackContext):
     )
     return CP_PHOTOS
 
+def _add_new_photos(user_data: dict, telegram_id: int, photos: list) -> list:
+    arr = user_data.setdefault('new_photos', [])
+    arr.extend(ingest_media(telegram_id, 'photo', photos, len(arr) + 1))
+    return arr
+
+
+def _on_photo_album(bot, album):
+    if 'new_photos' not in album.user_data:
+        # смена фото уже завершена — не создаём список заново, иначе фото попадут в следующую смену
+        return
+    items = [m.photo[-1] for m in album.messages if m.photo]
+    arr = _add_new_photos(album.user_data, album.user_id, items) if items else album.user_data.get('new_photos', [])
+    text = f"Сохранено фото из альбома: {len(items)} (всего {len(arr)})."
+    if len(album.messages) > len(items):
+        text += f" Видео из альбома пропущены: {len(album.messages) - len(items)}."
+    bot.send_message(
+        chat_id=album.chat_id,
+        text=text + " Можете отправить ещё или нажать 'Готово'.",
+        reply_markup=get_done_keyboard(),
+    )
+
+
 def change_photos_step(update: Update, context: CallbackContext):
     if update.message.text and update.message.text.strip().lower() == 'готово':
+        flush_albums(context.bot, update.effective_user.id)
         photos = context.user_data.get('new_photos', [])
         if not photos:
             update.message.reply_text("Вы не добавили ни одного фото. Загрузка отменена.", reply_markup=get_main_menu())
             return ConversationHandler.END
-        update_user_photos(update.effective_user.id, photos)
+        update_user_photos(update.effective_user.id, without_failed(photos))
         update.message.reply_text("Фото обновлены.", reply_markup=get_main_menu())
         context.user_data.pop('new_photos', None)
         return ConversationHandler.END
 
+    if (update.message.photo or update.message.video) and collect_album(update, context, _on_photo_album):
+        return CP_PHOTOS
     if update.message.photo:
-        photo_file = update.message.photo[-1].get_file()
-        idx = len(context.user_data.get('new_photos', [])) + 1
-        path = save_photo(photo_file, update.effective_user.id, idx)
-        arr = context.user_data.get('new_photos', [])
-        arr.append(path)
-        context.user_data['new_photos'] = arr
-        update.message.reply_text(f"Фото {idx} сохранено. Можете отправить ещё или нажать 'Готово'.", reply_markup=get_done_keyboard())
+        arr = _add_new_photos(context.user_data, update.effective_user.id, [update.message.photo[-1]])
+        update.message.reply_text(f"Фото {len(arr)} сохранено. Можете отправить ещё или нажать 'Готово'.", reply_markup=get_done_keyboard())
         return CP_PHOTOS
 
     update.message.reply_text("Пожалуйста, отправьте фото или нажмите 'Готово'.", reply_markup=get_done_keyboard())
@@ -314,7 +344,7 @@ def register_settings_handlers(dp):
     # Photos change via inline
     dp.add_handler(ConversationHandler(
         entry_points=[CallbackQueryHandler(change_photos_start_cb, pattern=r'^photos:change$')],
-        states={CP_PHOTOS: [MessageHandler((Filters.photo | Filters.text) & (~Filters.command), change_photos_step)]},
+        states={CP_PHOTOS: [MessageHandler((Filters.photo | Filters.video | Filters.text) & (~Filters.command), change_photos_step)]},
         fallbacks=[], allow_reentry=True,
     ))
     # Delete via inline
@@ -324,7 +354,7 @@ def register_settings_handlers(dp):
     dp.add_handler(ConversationHandler(
         entry_points=[CommandHandler('change_photos', change_photos_start)],
         states={
-            CP_PHOTOS: [MessageHandler((Filters.photo | Filters.text) & (~Filters.command), change_photos_step)],
+            CP_PHOTOS: [MessageHandler((Filters.photo | Filters.video | Filters.text) & (~Filters.command), change_photos_step)],
         },
         fallbacks=[],
         allow_reentry=True,
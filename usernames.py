@@ -0,0 +1,80 @@
+import os
+import logging
+import threading
+from collections import OrderedDict
+
+from cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+# Фоновое обновление @username через get_chat для неизвестных и устаревших записей кэша.
+# Запросы к Telegram идут из отдельного потока не чаще USERNAME_REFRESH_RATE в секунду,
+# поэтому показ анкет и симпатий никогда не ждёт сети.
+USERNAME_REFRESH_RATE = float(os.getenv("USERNAME_REFRESH_RATE", "5"))
+USERNAME_REFRESH_QUEUE = int(os.getenv("USERNAME_REFRESH_QUEUE", "10000"))
+# Повторно не запрашиваем одного и того же пользователя чаще, чем раз в столько секунд (в том числе после ошибки)
+USERNAME_RETRY_INTERVAL = float(os.getenv("USERNAME_RETRY_INTERVAL", "3600"))
+
+
+class UsernameRefresher:
+    """Очередь telegram_id на обновление username. store(telegram_id, username) сохраняет результат."""
+
+    def __init__(self, bot, store, rate: float = USERNAME_REFRESH_RATE, max_pending: int = USERNAME_REFRESH_QUEUE):
+        self._bot = bot
+        self._store = store
+        self._delay = 1.0 / max(rate, 0.01)
+        self._max_pending = max_pending
+        self._pending = OrderedDict()
+        self._attempted = LRUCache(max_pending, USERNAME_RETRY_INTERVAL)
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self.stats = {"requested": 0, "refreshed": 0, "failed": 0, "dropped": 0}
+
+    def request(self, telegram_id: int):
+        if self._attempted.get(telegram_id) is not None:
+            return
+        with self._lock:
+            if telegram_id in self._pending:
+                return
+            if len(self._pending) >= self._max_pending:
+                self.stats["dropped"] += 1
+                return
+            self._pending[telegram_id] = None
+            self.stats["requested"] += 1
+            if self._thread is None and not self._stop.is_set():
+                self._thread = threading.Thread(target=self._run, name="username-refresher", daemon=True)
+                self._thread.start()
+        self._wakeup.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            with self._lock:
+                telegram_id = self._pending.popitem(last=False)[0] if self._pending else None
+                if telegram_id is None:
+                    self._wakeup.clear()
+            if telegram_id is None:
+                self._wakeup.wait(self._delay * 10)
+                continue
+            self._attempted.set(telegram_id, True)
+            try:
+                chat = self._bot.get_chat(telegram_id)
+                self._store(telegram_id, getattr(chat, "username", None))
+                self.stats["refreshed"] += 1
+            except Exception as e:
+                self.stats["failed"] += 1
+                logger.debug("get_chat(%s) не удался: %s", telegram_id, e)
+            self._stop.wait(self._delay)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            data = dict(self.stats)
+            data["pending"] = len(self._pending)
+        return data
+
+    def close(self, timeout: float = 5.0):
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
@@ -30,6 +30,16 @@ INTERESTS_LIST = [
 def validate_interests(selected: list) -> bool:
     return all(item in INTERESTS_LIST for item in selected)
 
+# Интересы в виде битовой маски: бит i соответствует INTERESTS_LIST[i].
+# Новые интересы добавлять только в конец списка, иначе сохранённые маски поменяют смысл.
+_INTEREST_BITS = {item: 1 << i for i, item in enumerate(INTERESTS_LIST)}
+
+def interests_to_mask(selected) -> int:
+    mask = 0
+    for item in selected or ():
+        mask |= _INTEREST_BITS.get(item, 0)
+    return mask
+
 # Клавиатура выбора интересов (многострочная)
 def get_interests_keyboard():
     keyboard = []
@@ -205,19 +215,19 @@ def _unique_file_name(prefix: str, index: int, ext: str) -> str:
     return f"{prefix}_{index}_{uuid4().hex[:8]}{ext}"
 
 
-def save_photo(tg_file, telegram_id: int, index: int) -> str:
-    user_dir = BASE_MEDIA_DIR / str(telegram_id) / 'photos'
+def media_path(telegram_id: int, kind: str, index: int) -> str:
+    """Путь для нового фото (kind='photo') или видео (kind='video') пользователя; каталог создаётся.
+    Путь записывается в анкету сразу, а файла по нему нет: media_ingest скачивает его в фоне
+    и заменяет путь на итоговый в хранилище (db.resolve_media_path)."""
+    user_dir = BASE_MEDIA_DIR / str(telegram_id) / (kind + 's')
     user_dir.mkdir(parents=True, exist_ok=True)
-    filename = _unique_file_name(str(telegram_id), index, '.jpg')
-    dest = user_dir / filename
-    tg_file.download(custom_path=str(dest))
-    return str(dest)
+    filename = _unique_file_name(str(telegram_id), index, '.jpg' if kind == 'photo' else '.mp4')
+    return str(user_dir / filename)
 
 
-def save_video(tg_file, telegram_id: int, index: int) -> str:
-    user_dir = BASE_MEDIA_DIR / str(telegram_id) / 'videos'
-    user_dir.mkdir(parents=True, exist_ok=True)
-    filename = _unique_file_name(str(telegram_id), index, '.mp4')
-    dest = user_dir / filename
-    tg_file.download(custom_path=str(dest))
-    return str(dest)
+# Хранилище по содержимому: user_media/store/ab/cd/<sha256><ext>
+CONTENT_DIR = BASE_MEDIA_DIR / 'store'
+
+
+def content_path(digest: str, ext: str) -> str:
+    return str(CONTENT_DIR / digest[:2] / digest[2:4] / (digest + ext))